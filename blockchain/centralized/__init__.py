@@ -0,0 +1,7 @@
+"""
+The centralized node, a single node holding the chain of chores
+
+Run it from the blockchain directory, so that the common package is found:
+
+    python -m centralized.blockchain -p 5000
+"""
@@ -1,48 +1,274 @@
-import hashlib
-import json
-from time import time
+import os
+import threading
+from contextlib import contextmanager
+from random import random
+from time import monotonic, perf_counter, sleep, time
 from urllib.parse import urlparse
 from uuid import uuid4
 
 import requests
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
+
+from common import encoding, events, ledger, mempool, merkle, metrics, mining, profiling, records, sealing, storage
 
 HOST = "127.0.0.1"
 PORT = "5000"
 REWARD = 0.25
+# Number of processes used to mine a block, 0 uses every core of the machine
+MINER_WORKERS = 1
+# Target time in seconds spent finding the proof of a block
+BLOCK_INTERVAL = 5
+# Number of recent blocks looked at when adjusting the difficulty
+RETARGET_WINDOW = 10
+# Bounds of the number of leading hex zeroes required in a proof
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 8
+# Mine the blocks in a background thread instead of inside the review request
+BACKGROUND_MINING = True
+# Longest time in seconds a /mining/status request can wait for a block
+MINING_STATUS_MAX_WAIT = 30
+# When the reviewed transactions are handed over to the miner, the ones not reviewed yet staying for the next Block:
+# 'reviewed' once every transaction is reviewed, 'count' and 'bytes' once the reviewed ones fill a Block,
+# 'timer' at most SEAL_INTERVAL seconds after a transaction is reviewed
+SEALING_POLICY = 'reviewed'
+# Most transactions, and bytes of transactions, in a Block sealed by the count and bytes policies
+SEAL_MAX_TRANSACTIONS = 100
+SEAL_MAX_BYTES = 64 * 1024
+# Seconds between two Blocks sealed by the timer policy
+SEAL_INTERVAL = 60
+# Directory where the chain and the pending transactions are kept, None to keep them in memory only
+DATA_DIR = "data"
+# Let several processes serve DATA_DIR at once, eg. the workers of gunicorn -w 4 centralized.blockchain:app,
+# every change then locks the directory and reads the changes of the other processes first.
+# Off by default, a single process doesn't pay for the file lock and the reads of the log
+SHARED_DATA = False
+# Transactions in a page of the history of a person, by default and at most
+HISTORY_PAGE = 50
+HISTORY_MAX_PAGE = 500
+# Largest page of /chain and /transactions, when a limit is given
+PAGE_MAX_LIMIT = 1000
+# Most transactions and reviews sent at once to /transactions/batch
+BATCH_MAX_ITEMS = 1000
+# Number of recent events kept for the clients of /events coming back after a disconnection
+EVENTS_HISTORY = 1000
+# Seconds between two comments keeping an idle /events stream open
+EVENTS_KEEPALIVE = 15
+# Longest time in seconds a long-poll on /events is held
+EVENTS_MAX_WAIT = 30
+# Seconds between two reads of the changes of the other processes sharing the data directory, while waiting for events
+EVENTS_SHARED_POLL = 1
+# Record the measures served on /metrics, while disabled recording costs close to nothing
+METRICS = True
+# Profile the requests asking for it with an X-Profile header or a ?profile= flag, cprofile or sample. Off unless
+# started with --profiling: anyone reaching the node could slow it down with profiled requests and read their stacks
+PROFILING = False
+# Share of the other requests profiled by sampling their stack, 0 to profile none
+PROFILE_SAMPLE_RATE = 0.0
+# Number of recent profiles kept for /debug/profiles
+PROFILE_HISTORY = 50
+
+metrics.registry.enabled = METRICS
+
+# Measures of the hot paths of the node
+MINING_SECONDS = metrics.registry.histogram('chores_mining_seconds', 'Seconds spent finding the proof of a block')
+MINING_NONCES = metrics.registry.histogram('chores_mining_nonces', 'Nonces tried to find the proof of a block', buckets=metrics.NONCE_BUCKETS)
+REQUEST_SECONDS = metrics.registry.histogram('chores_http_request_seconds', 'Seconds spent answering a request, until its body starts', ('method', 'route', 'status'))
 
 class Blockchain:
-    def __init__(self):
-      self.chain = []
-      self.current_transactions = []
-      
-      # Create the genesis block
-      self.new_block(previous_hash='1', proof=100)
+    def __init__(self, miner=None, data_dir=DATA_DIR, sealing_policy=None):
+      self.miner = miner or mining.make_miner(MINER_WORKERS)
+      self.mining_jobs = mining.MiningJobs(self.mine_block, BACKGROUND_MINING)
+      self.sealing_policy = sealing_policy or sealing.make_policy(SEALING_POLICY, SEAL_MAX_TRANSACTIONS, SEAL_MAX_BYTES, SEAL_INTERVAL, time())
+      # Changes of the node, pushed to the clients of /events
+      self.events = events.EventLog(EVENTS_HISTORY)
+
+      # Lists of reviewed transactions waiting for their Block to be mined
+      self.sealing = []
+      # Changes made to the transactions since they were last saved, see storage.PendingSnapshot.replay
+      self.journal = []
+
+      # Every change to the node holds its lock, see changing, the requests read snapshots instead
+      self.lock = storage.DataLock(data_dir if SHARED_DATA else None)
+      # Copy of the current transactions read by the requests, until the next change
+      self._transactions_snapshot = None
+
+      with self.lock:
+        if data_dir is None:
+          self.pending_snapshot = None
+          self.chain = storage.MemoryChain()
+          self.current_transactions = mempool.Mempool()
+        else:
+          # Pick up the chain and the transactions from where the node left them
+          self.pending_snapshot = storage.PendingSnapshot(data_dir)
+          self.chain = storage.ChainLog(data_dir, shared=self.lock.shared)
+          pending = self.pending_snapshot.load()
+          self.current_transactions = mempool.Mempool(pending['transactions'])
+          self.sealing = pending['sealing']
+
+        # Balance and history of every person, counted from the chain when they are first read, see follow_ledger
+        self.ledger = ledger.Ledger()
+
+        if not self.chain:
+          # Create the genesis block
+          self.new_block(previous_hash='1', proof=100)
+
+        self.resume_sealing()
+
+      # The timer of the policy seals the reviewed transactions even when no request comes
+      if self.sealing_policy.interval:
+        threading.Thread(target=self.seal_periodically, name='sealing-timer', daemon=True).start()
+
+    @contextmanager
+    def changing(self):
+      """
+      Hold the lock of the node while changing it
+
+      The changes saved by the other processes sharing the data directory
+      are read first. The copy of the current transactions read by the
+      requests is dropped once the change is made.
+      """
+
+      with self.lock:
+        if self.lock.shared and self.lock.depth == 1:
+          self.reload()
+        try:
+          yield
+        finally:
+          self._transactions_snapshot = None
+
+    def reload(self):
+      """
+      Read the blocks and the transactions saved by the other processes sharing the data directory
+      """
+
+      length = len(self.chain)
+      self.chain.refresh()
+      if self.pending_snapshot.changed():
+        pending = self.pending_snapshot.load()
+        self.current_transactions = mempool.Mempool(pending['transactions'])
+        self.sealing = pending['sealing']
+        self.journal = []
+        self.events.publish('transactions_replaced', length=len(self.current_transactions))
+
+      # The events of the other processes are their own, the Blocks they added are told again here
+      for position in range(length, len(self.chain)):
+        self.block_sealed(self.chain[position], self.chain.hash(position))
+
+    def refresh(self):
+      """
+      Pick up the changes of the other processes sharing the data directory before a read, if there are any
+      """
+
+      if self.lock.shared and (self.chain.changed() or self.pending_snapshot.changed()):
+        with self.changing():
+          pass
+
+    def follow_ledger(self):
+      """
+      Count the new blocks of the chain in the ledger, before a balance or a history is read
+
+      The ledger is only brought in step with the chain when it is read, so
+      starting the node, or picking up the blocks of the other processes,
+      doesn't count every block again.
+      """
+
+      while True:
+        try:
+          self.ledger.follow(self.chain_snapshot())
+          return
+        except storage.ChainChanged:
+          # The ledger takes out what it counted of the replaced blocks on the next try
+          continue
+
+    def chain_snapshot(self):
+      """
+      :return: <ChainSnapshot> The chain as it is now, read without waiting for the changes being made
+      """
+
+      self.refresh()
+      return self.chain.snapshot()
+
+    def transactions_snapshot(self):
+      """
+      The current transactions as read by the requests, without waiting for the changes being made
+
+      The copy is made by the first read after a change and shared by the
+      reads that follow, so reads only take the lock once per change.
+
+      :return: <list> Copy of the current transactions, not to be changed
+      """
+
+      self.refresh()
+      snapshot = self._transactions_snapshot
+      if snapshot is None:
+        with self.lock:
+          snapshot = self._transactions_snapshot
+          if snapshot is None:
+            snapshot = self._transactions_snapshot = self.current_transactions.to_dicts()
+      return snapshot
+
+    def resume_sealing(self):
+      """
+      Queue again the Blocks that were waiting to be mined when the node stopped
+      """
+
+      sealing, self.sealing = self.sealing, []
+      for transactions in sealing:
+        # The Block may have been added right before the node stopped
+        if transactions != self.last_block['transactions']:
+          self.seal(transactions)
+      self.save_pending()
       
-    def new_block(self, proof, previous_hash):
+    def new_block(self, proof, previous_hash, difficulty=None, transactions=None, mining_started=None):
       """
       Create a new Block in the Blockchain
       
       :param proof: The proof given by the Proof of Work algorithm
       :param previous_hash: Hash of previous Block
+      :param difficulty: Difficulty the proof was mined with, the next difficulty if not given
+      :param transactions: Transactions of the Block, the current transactions if not given
+      :param mining_started: <float> Time the search for the proof started, the next difficulty is retargeted from it
       :return: New Block
       """
       
-      block = {
-        'index': len(self.chain) + 1,
-        'timestamp': time(),
-        'transactions': self.current_transactions,
-        'proof': proof,
-        'previous_hash': previous_hash or self.hash(self.chain[-1])
-      }
-      
-      # Reset the current list of transactions
-      self.current_transactions = []
+      with self.changing():
+        if difficulty is None:
+          difficulty = self.next_difficulty()
+
+        if transactions is None:
+          transactions = self.current_transactions.to_dicts()
 
-      self.chain.append(block)
+          # Reset the current list of transactions
+          self.current_transactions = mempool.Mempool()
+          self.save_pending()
+
+        block = {
+          'index': len(self.chain) + 1,
+          'timestamp': time(),
+          'transactions': transactions,
+          'merkle_root': merkle.root(transactions),
+          'proof': proof,
+          'difficulty': difficulty,
+          'previous_hash': previous_hash or self.chain.hash(-1)
+        }
+        if mining_started is not None:
+          block['mining_started'] = mining_started
+
+        self.chain.append(block)
+        self.block_sealed(block, self.chain.hash(-1))
       
       return block
 
+    def block_sealed(self, block, block_hash):
+      """
+      Tell the clients of /events that a Block was added at the end of the chain
+
+      :param block: <dict> The Block
+      :param block_hash: <str> Its hash
+      """
+
+      self.events.publish('block_sealed', index=block['index'], hash=block_hash, transactions=len(block['transactions']), block_timestamp=block['timestamp'])
+
     def new_transaction(self, doer, task, duration):
       """
       Creates a new transaction to go into the next mined Block
@@ -53,17 +279,12 @@ class Blockchain:
       :return: The index of the Block that will hold this transaction
       """
       
-      self.current_transactions.append({
-            'index': len(self.current_transactions) + 1,
-            'doer': doer,
-            'task': task,
-            'duration': duration,
-            'status': 'pending',
-            'reviewer': '',
-            'timestamp': time()
-      })
-      
-      return self.last_block['index'] + 1
+      # The index must be read and taken in one go, or two transactions could get the same one
+      with self.changing():
+        self.append_transaction(doer, task, duration)
+        self.save_pending(journaled=True)
+        
+        return self.next_block_index
 
     def change_transaction_status(self, ix_list, status, reviewer):
       """
@@ -71,92 +292,299 @@ class Blockchain:
       
       :param ix: list of transactions indexes which status needs to be changed
       :param status: New status
-      :return: The index of the Block that will hold this transaction
+      :return: The index of the Block that will hold this transaction and the mining ticket of the last Block sealed, None if none is mined yet
       """
       
+      with self.changing():
+        self.review_transactions(ix_list, status, reviewer)
+          
+        # Mine new Blocks with the reviewed transactions, when the sealing policy lets them go
+        index = self.next_block_index
+        sealed = self.take_sealed()
+        self.save_pending(journaled=True)
+
+      # The Blocks are queued once the lock is left, a Block mined in the calling thread doesn't hold it
+      tickets = [self.mining_jobs.submit(transactions) for transactions in sealed]
+      return index, tickets[-1] if tickets else None
+
+    def apply_batch(self, items):
+      """
+      Add and review many transactions at once, as if every item was sent on its own, in order
+
+      The lock is taken once and the transactions are saved once.
+
+      :param items: <list> transactions to add, with a doer, a task and a duration, and reviews, with an ix_list, a status and a reviewer
+      :return: <list> For every item, the index of the transaction added or the number of transactions reviewed,
+               and the index of the Block that will hold them; and the mining tickets of the Blocks sealed
+      """
+
+      with self.changing():
+        results = []
+        for item in items:
+          if 'ix_list' in item:
+            reviewed = self.review_transactions(item['ix_list'], item['status'], item['reviewer'])
+            results.append({'reviewed': reviewed, 'block': self.next_block_index})
+          else:
+            index = self.append_transaction(item['doer'], item['task'], item['duration'])
+            results.append({'index': index, 'block': self.next_block_index})
+
+        sealed = self.take_sealed()
+        self.save_pending(journaled=True)
+
+      tickets = [self.mining_jobs.submit(transactions) for transactions in sealed]
+      return results, tickets
+
+    def append_transaction(self, doer, task, duration):
+      """
+      Add a new transaction to the current transactions, the lock of the node must be held
+
+      :param doer: identificator of the person who carried out the task
+      :param task: description of the task done
+      :param duration: duration spent in doing the task
+      :return: <int> The index of the transaction, used to review it
+      """
+
+      transaction = self.current_transactions.append(records.Transaction(
+            index=self.current_transactions.next_index,
+            doer=doer,
+            task=task,
+            duration=duration,
+            status=records.PENDING,
+            reviewer='',
+            timestamp=time()
+      ))
+      self.journal.append({'change': 'add', 'transaction': transaction.to_dict()})
+      self.events.publish('transaction_added', transaction=self.journal[-1]['transaction'])
+      return transaction.index
+
+    def review_transactions(self, ix_list, status, reviewer):
+      """
+      Change the status of the given transactions and credit the reviewer, the lock of the node must be held
+
+      :param ix_list: list of transactions indexes which status needs to be changed
+      :param status: New status
+      :param reviewer: identificator of the person who reviewed the transactions
+      :return: <int> Number of transactions whose status changed
+      """
+
+      # The records hold the status as a small int, compared as such
+      code = records.status_code(status)
+
       current_transactions = self.current_transactions
       reviewed_transactions = 0
-      for i in range (0, len(current_transactions)):
-        if ((current_transactions[i]['index'] in ix_list) and (current_transactions[i]['doer'] != reviewer) and (current_transactions[i]['status'] != status) and (current_transactions[i]['reviewer'] != reviewer)):
-          current_transactions[i]['status'] = status
-          reviewed_transactions += 1
-          current_transactions[i]['reviewer'] = reviewer
+      # Only the transactions with the given indexes are looked at, through the index of the list
+      for ix in dict.fromkeys(ix_list):
+        for transaction in current_transactions.with_index(ix):
+          if ((transaction.doer != reviewer) and (transaction.status != code) and (transaction.reviewer != reviewer)):
+            current_transactions.set_status(transaction, code, reviewer)
+            reviewed_transactions += 1
+            self.journal.append({'change': 'status', 'position': current_transactions.position(transaction), 'status': records.status_name(code), 'reviewer': reviewer})
+            self.events.publish('status_changed', index=transaction.index, status=records.status_name(code), reviewer=reviewer)
                         
       # In this blockchain, instead of giving credits for the effort of mining, we give credits for the effort of reviewing the transactions
       if reviewed_transactions > 0:
-        self.current_transactions.append({
-          'index': len(self.current_transactions) + 1,
-          'doer': reviewer,
-          'status': "accepted",
-          'task': "Task list review",
-          'duration': reviewed_transactions*REWARD, 
-          'timestamp': time()
-        })
-        
-      # If all transactions have been accepted or rejected, mine a new block with all transactions
-      required_status = ['accepted', 'rejected']
-      count = 0
-      for i in range (0, len(current_transactions)):
-        if current_transactions[i]['status'] in required_status:
-          count = count + 1
-      if count == len(current_transactions):
-        last_block = self.last_block
-        proof = self.proof_of_work(last_block)
-        previous_hash = self.hash(last_block)
-        block = self.new_block(proof, previous_hash)
-             
-      return self.last_block['index'] + 1
+        reward = current_transactions.append(records.Transaction(
+          index=current_transactions.next_index,
+          doer=reviewer,
+          status=records.ACCEPTED,
+          task=ledger.REVIEW_TASK,
+          duration=reviewed_transactions*REWARD, 
+          timestamp=time()
+        ))
+        self.journal.append({'change': 'add', 'transaction': reward.to_dict()})
+        self.events.publish('transaction_added', transaction=self.journal[-1]['transaction'])
+
+      return reviewed_transactions
+
+    def take_sealed(self):
+      """
+      Hand the transactions the sealing policy lets go over to the miner, the other ones staying for the next Block
+
+      The lock of the node must be held. The transactions handed over and the
+      ones left must then be saved at once, so that a crash can't lose them.
+
+      :return: <list> The transactions of every Block to mine, to be queued once the lock is left
+      """
+
+      sealed = []
+      while True:
+        now = time()
+        selected = self.sealing_policy.select(self.current_transactions, now)
+        if not selected:
+          return sealed
+
+        transactions = [transaction.to_dict() for transaction in selected]
+        self.journal.append({'change': 'seal', 'positions': [self.current_transactions.position(transaction) for transaction in selected]})
+        self.current_transactions = self.current_transactions.excluding(selected)
+        self.sealing.append(transactions)
+        self.sealing_policy.sealed(now)
+        sealed.append(transactions)
+        self.events.publish('transactions_sealed', indexes=[transaction.get('index') for transaction in transactions], block=self.next_block_index - 1)
+
+    def seal_periodically(self):
+      """
+      Seal the reviewed transactions whenever the timer of the sealing policy is over, run by a background thread
+      """
+
+      while True:
+        sleep(self.sealing_policy.wait(time()))
+        with self.changing():
+          sealed = self.take_sealed()
+          if sealed:
+            self.save_pending(journaled=True)
+        for transactions in sealed:
+          self.mining_jobs.submit(transactions)
+
+    def seal(self, transactions):
+      """
+      Queue a new Block holding the given transactions to be mined
+
+      :param transactions: list of reviewed transactions
+      :return: The mining ticket of the Block
+      """
+
+      with self.changing():
+        self.sealing.append(transactions)
+        self.save_pending()
+      return self.mining_jobs.submit(transactions)
+
+    def mine_block(self, transactions):
+      """
+      Find the proof of a new Block holding the given transactions and add it to the chain
+
+      :param transactions: list of reviewed transactions
+      :return: New Block
+      """
+
+      while True:
+        with self.changing():
+          # Another process sharing the data directory may have mined them first, eg. when both resumed them
+          if transactions not in self.sealing:
+            return next(block for block in reversed(self.chain) if block['transactions'] == transactions)
+
+          last_block = self.last_block
+          difficulty = self.next_difficulty()
+          previous_hash = self.chain.hash(-1)
+
+        # The proof is searched for without holding the lock
+        mining_started = time()
+        proof = self.proof_of_work(last_block, difficulty, previous_hash)
+
+        with self.changing():
+          # Another process may have added a Block meanwhile, the Block then has to be mined again on top of it
+          if self.chain.hash(-1) != previous_hash:
+            continue
+
+          block = self.new_block(proof, previous_hash, difficulty, transactions, mining_started)
+          # Compared by value, the lists read back from the snapshot saved by another process are other objects
+          self.journal.append({'change': 'mined', 'positions': [position for position, sealing in enumerate(self.sealing) if sealing == transactions]})
+          self.sealing = [sealing for sealing in self.sealing if sealing != transactions]
+          self.save_pending(journaled=True)
+          return block
+
+    def save_pending(self, journaled=False):
+      """
+      Save the transactions that are not in the chain yet, if the node keeps its data on disk
+
+      :param journaled: <bool> True if every change made to them since they were last saved is in self.journal, only
+                        the changes are then appended to the journal of the snapshot, unless it is full
+      """
+
+      journal, self.journal = self.journal, []
+      if self.pending_snapshot is None:
+        return
+      if not (journaled and self.pending_snapshot.record(journal)):
+        self.pending_snapshot.save({'transactions': self.current_transactions.to_dicts(), 'sealing': self.sealing})
 
     @property
     def last_block(self):
       return self.chain[-1]
 
+    @property
+    def next_block_index(self):
+      """
+      Index of the Block that will hold the current transactions, after the Blocks waiting to be mined
+      """
+
+      return self.last_block['index'] + 1 + len(self.sealing)
+
+    def next_difficulty(self):
+      """
+      Difficulty for the next Block, retargeted from the time the recent Blocks took to mine, see mining.latencies
+
+      :return: <int>
+      """
+
+      if not self.chain:
+        return max(MIN_DIFFICULTY, min(MAX_DIFFICULTY, mining.DIFFICULTY))
+
+      latencies = mining.latencies(self.chain[-RETARGET_WINDOW:])
+      difficulty = self.last_block.get('difficulty', mining.DIFFICULTY)
+      return mining.retarget(difficulty, latencies, BLOCK_INTERVAL, MIN_DIFFICULTY, MAX_DIFFICULTY)
+
     @staticmethod
     def hash(block):
       """
-      Creates a SHA-256 hash of a Block
+      Creates a SHA-256 hash of a Block, of its header only if it has a Merkle root
       
       :param block: Block
       """
       
-      # We must make sure that the Dictionary is Ordered, or we'll have inconsistent hashes
-      block_string = json.dumps(block, sort_keys=True).encode()
-      return hashlib.sha256(block_string).hexdigest()
+      return encoding.block_hash(block)
     
-    def proof_of_work(self, last_block):
+    def proof_of_work(self, last_block, difficulty=None, last_hash=None):
       """
       Simple Proof of Work Algorithm:
       
-      - Find a number p' such that hash(pp') contains leading 4 zeroes
+      - Find a number p' such that hash(pp') contains as many leading zeroes as the difficulty
       - Where p is the previous proof, and p' is the new proof
       
       :param last_block: <dict> last Block
+      :param difficulty: <int> Number of leading zeroes, the next difficulty if not given
+      :param last_hash: <str> Hash of the last Block, computed again if not given
       :return: <int>
       """
       
+      if difficulty is None:
+        difficulty = self.next_difficulty()
+
       last_proof = last_block['proof']
-      last_hash = self.hash(last_block)
+      if last_hash is None:
+        last_hash = self.hash(last_block)
       
-      proof = 0
-      while self.valid_proof(last_proof, proof, last_hash) is False:
-        proof += 1
-        
-        return proof
+      with profiling.span('proof_of_work'), MINING_SECONDS.time():
+        proof, tried = self.miner.mine_counted(last_proof, last_hash, difficulty)
+
+      MINING_NONCES.observe(tried)
+      return proof
       
     @staticmethod
-    def valid_proof(last_proof, proof, last_hash):
+    def valid_proof(last_proof, proof, last_hash, difficulty=mining.DIFFICULTY):
       """
       Validates the Proof
         
       :param last_proof: <int> Previous Proof
       :param proof: <int> Current Proof
       :param last_hash: <str> The hash of the Previous Block
+      :param difficulty: <int> Number of leading zeroes required
       :return: <bool> True if correct, False if not.
       """
         
-      guess = f'{last_proof}{proof}{last_hash}'.encode()
-      guess_hash = hashlib.sha256(guess).hexdigest()
-      return guess_hash[:4] == "0000"
+      return mining.valid_proof(last_proof, proof, last_hash, difficulty)
+
+    @staticmethod
+    def valid_proof_many(last_proof, proofs, last_hash, difficulty=mining.DIFFICULTY):
+      """
+      Validates several Proofs against the same previous Block
+        
+      :param last_proof: <int> Previous Proof
+      :param proofs: <list> Proofs to check
+      :param last_hash: <str> The hash of the Previous Block
+      :param difficulty: <int> Number of leading zeroes required
+      :return: <list> One bool per proof, True if correct, False if not.
+      """
+        
+      return mining.valid_proof_many(last_proof, proofs, last_hash, difficulty)
      
 # Instantiate our Node
 app = Flask(__name__)
@@ -164,8 +592,112 @@ app = Flask(__name__)
 # Generate a globally unique address for this node
 node_identifier = str(uuid4()).replace('-', '')
 
+# Recent profiles of the requests
+profiles = profiling.Profiles(PROFILE_HISTORY)
+
 # Instantiate the Blockchain
 blockchain = Blockchain()
+
+def mempool_sizes():
+  """
+  :return: <dict> Number of transactions waiting to go into a Block in every status, read from the index of the pool
+  """
+
+  current_transactions = blockchain.current_transactions
+  return {(status,): current_transactions.count_status(status) for status in records.STATUSES}
+
+metrics.registry.gauge('chores_mempool_transactions', 'Transactions waiting to go into a block', mempool_sizes, ('status',))
+metrics.registry.gauge('chores_mining_jobs_pending', 'Blocks queued or being mined', lambda: blockchain.mining_jobs.pending())
+metrics.registry.gauge('chores_chain_length', 'Blocks in the chain', lambda: len(blockchain.chain))
+
+@app.before_request
+def start_request_timer():
+  if metrics.registry.enabled:
+    g.request_start = perf_counter()
+
+@app.after_request
+def observe_request(response):
+  # Streamed bodies are sent after this, their time is the time to the first byte
+  start = g.pop('request_start', None)
+  if start is not None:
+    route = request.url_rule.rule if request.url_rule is not None else 'unknown'
+    REQUEST_SECONDS.observe(perf_counter() - start, request.method, route, str(response.status_code))
+  return response
+
+@app.before_request
+def start_profile():
+  flag = request.headers.get('X-Profile', request.args.get('profile'))
+  if flag is None and PROFILE_SAMPLE_RATE and random() < PROFILE_SAMPLE_RATE:
+    flag = 'sample'
+  if not PROFILING or flag in (None, '0', 'false') or request.path.startswith('/debug/'):
+    return
+
+  # Any other flag, eg. 1, profiles every call
+  mode = flag if flag in profiling.MODES else 'cprofile'
+  profiling.Profile(request.method, request.full_path.rstrip('?'), mode).start()
+
+@app.after_request
+def stop_profile(response):
+  profile = profiling.current()
+  if profile is not None:
+    profile.stop(response.status_code)
+    profiles.add(profile)
+    response.headers['X-Profile-Id'] = profile.id
+  return response
+
+@app.teardown_request
+def drop_profile(error=None):
+  # A request that raised never went through stop_profile, its thread must not stay profiled
+  profile = profiling.current()
+  if profile is not None:
+    profile.stop(500)
+    profiles.add(profile)
+
+def page(length):
+  """
+  Read the page asked for with ?from=&limit=, the items being numbered from 1
+
+  :param length: <int> Number of items in the list
+  :return: <range> Positions of the items of the page, None if the limit is wrong
+  """
+
+  args = request.args
+  start = max(args.get("from", default=1, type=int), 1) - 1
+  limit = args.get("limit", type=int)
+  if limit is None:
+    return range(length)[start:]
+  if limit < 1:
+    return None
+  return range(length)[start:start + min(limit, PAGE_MAX_LIMIT)]
+
+def next_page(positions, length):
+  """
+  :return: <int> Value of ?from= for the page following the given one, None if it was the last one
+  """
+
+  return positions.stop + 1 if positions.stop < length else None
+
+def streamed(documents):
+  """
+  Send the given JSON documents one per line, as they are read, instead of building the whole list in memory
+
+  :param documents: encoded documents
+  """
+
+  def lines():
+    try:
+      for document in documents:
+        yield document + b'\n'
+    except storage.ChainChanged:
+      # The answer has started and can't turn into a 503, it ends with an error record instead
+      # so that the client doesn't take the blocks read before the chain was replaced for all of them
+      yield encoding.canonical({'error': 'The chain was replaced while it was read, please try again'}) + b'\n'
+
+  return Response(lines(), mimetype='application/x-ndjson')
+
+@app.errorhandler(storage.ChainChanged)
+def chain_changed(error):
+  return 'The chain was replaced while it was read, please try again', 503
   
 @app.route('/transactions/new', methods=['POST'])
 def new_transaction():
@@ -184,10 +716,20 @@ def new_transaction():
 
 @app.route('/transactions', methods=['GET'])
 def transactions():
+  current_transactions = blockchain.transactions_snapshot()
+  positions = page(len(current_transactions))
+  if positions is None:
+    return 'Wrong limit value', 400
+
+  if request.args.get("format") == 'ndjson':
+    return streamed(encoding.canonical(transaction) for transaction in current_transactions[positions.start:positions.stop]), 200
+
   response = {
-    'transactions': blockchain.current_transactions,
-    'length': len(blockchain.current_transactions),
+    'transactions': current_transactions[positions.start:positions.stop],
+    'length': len(current_transactions),
   }
+  if request.args.get("limit") is not None:
+    response['next'] = next_page(positions, len(current_transactions))
   return jsonify(response), 200
 
 @app.route('/transactions/status/update', methods=['POST'])
@@ -204,29 +746,274 @@ def change_transaction_status():
     return 'Wrong status value, please only use accepted, rejected or pending', 400
   
   # Change the status of the inputted transactions
-  index = blockchain.change_transaction_status(values['ix_list'], values['status'], values['reviewer'])
+  index, ticket = blockchain.change_transaction_status(values['ix_list'], values['status'], values['reviewer'])
+  current_transactions = blockchain.transactions_snapshot()
   response = {
-    'transactions': blockchain.current_transactions,
-    'length': len(blockchain.current_transactions),
+    'transactions': current_transactions,
+    'length': len(current_transactions),
     'message': f'Transaction will be added to Block {index}'
   }
+
+  # All the transactions have been reviewed, tell how to follow the mining of the block
+  if ticket is not None:
+    response['mining'] = blockchain.mining_jobs.status(ticket)
   return jsonify(response), 201  
+
+def batch_item_error(item):
+  """
+  :param item: Item of a batch, a transaction to add or a review
+  :return: <str> What is wrong with the item, None if nothing is
+  """
+
+  if not isinstance(item, dict):
+    return 'Not an object'
+
+  if 'ix_list' in item:
+    if not all(k in item for k in ['ix_list', 'status', 'reviewer']):
+      return 'Missing values'
+    if not isinstance(item['ix_list'], list) or not all(isinstance(ix, int) for ix in item['ix_list']):
+      return 'Wrong ix_list value, please use a list of transaction indexes'
+    if not item['status'] in ['accepted', 'rejected', 'pending']:
+      return 'Wrong status value, please only use accepted, rejected or pending'
+    return None
+
+  if not all(k in item for k in ['doer', 'task', 'duration']):
+    return 'Missing values'
+  return None
+
+@app.route('/transactions/batch', methods=['POST'])
+def transactions_batch():
+  values = request.get_json()
+
+  items = values.get('items') if isinstance(values, dict) else None
+  if not isinstance(items, list) or not items:
+    return 'Missing items', 400
+  if len(items) > BATCH_MAX_ITEMS:
+    return f'Too many items, please send at most {BATCH_MAX_ITEMS}', 400
+
+  # Every item is checked before any is applied, so that a batch is applied whole or not at all
+  for position, item in enumerate(items):
+    error = batch_item_error(item)
+    if error is not None:
+      return f'Item {position}: {error}', 400
+
+  # Add and review the transactions, saving them once for the whole batch
+  results, tickets = blockchain.apply_batch(items)
+  response = {
+    'results': results,
+    'length': len(blockchain.transactions_snapshot()),
+  }
+
+  # Reviews sealed some blocks, tell how to follow their mining
+  if tickets:
+    response['mining'] = [blockchain.mining_jobs.status(ticket) for ticket in tickets]
+  return jsonify(response), 201
+
+@app.route('/mining/status', methods=['GET'])
+def mining_status():
+  args = request.args
+  ticket = args.get("ticket")
+  wait = args.get("wait", default=0, type=float)
+
+  if ticket is None:
+    response = {
+      'pending': blockchain.mining_jobs.pending(),
+      'jobs': blockchain.mining_jobs.status(),
+    }
+    return jsonify(response), 200
+
+  # Long-poll: hold the request until the block is mined or the wait is over
+  if wait > 0:
+    job = blockchain.mining_jobs.wait(ticket, min(wait, MINING_STATUS_MAX_WAIT))
+  else:
+    job = blockchain.mining_jobs.status(ticket)
+
+  if job is None:
+    return 'Unknown mining ticket', 404
+
+  return jsonify(job), 200
+
+def read_events(cursor, wait, kinds):
+  """
+  Read the events after the cursor, waiting for one at most the given seconds
+
+  The changes of the other processes sharing the data directory are read
+  every EVENTS_SHARED_POLL seconds meanwhile, they publish their events
+  in their own process only.
+
+  :return: <list> The events and <str> the cursor to read the next ones from
+  """
+
+  deadline = monotonic() + wait
+  while True:
+    blockchain.refresh()
+    remaining = max(deadline - monotonic(), 0.0)
+    if blockchain.lock.shared:
+      found, cursor = blockchain.events.read(cursor, min(remaining, EVENTS_SHARED_POLL), kinds)
+    else:
+      found, cursor = blockchain.events.read(cursor, remaining, kinds)
+    if found or monotonic() >= deadline:
+      return found, cursor
+
+@app.route('/events', methods=['GET'])
+def event_stream():
+  args = request.args
+  kinds = None
+  if args.get("types"):
+    kinds = set(args.get("types").split(','))
+    if not kinds <= set(events.KINDS):
+      return f'Wrong types value, please only use {", ".join(events.KINDS)}', 400
+
+  # A client coming back sends the cursor of the last event it got, the others get the events from now on
+  cursor = request.headers.get('Last-Event-ID', args.get("after"))
+  if cursor is None:
+    cursor = blockchain.events.cursor
+  session = blockchain.events.session
+
+  if 'text/event-stream' in request.headers.get('Accept', ''):
+    def stream(cursor):
+      while True:
+        found, cursor = read_events(cursor, EVENTS_KEEPALIVE, kinds)
+        for event in found:
+          yield events.server_sent(event, session)
+        if not found:
+          # A comment, ignored by the client, keeps the connection from being closed by the proxies
+          yield b': keepalive\n\n'
+
+    # Sent as they come, without being cached or buffered on the way
+    return Response(stream(cursor), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}), 200
+
+  # Long-poll: hold the request until an event comes or the wait is over
+  wait = min(max(args.get("wait", default=0, type=float), 0.0), EVENTS_MAX_WAIT)
+  found, cursor = read_events(cursor, wait, kinds)
+  return jsonify({'events': found, 'cursor': cursor}), 200
   
   
-@app.route('/chain', methods=['GET'])
-def full_chain():
+@app.route('/doers/<doer>/balance', methods=['GET'])
+def doer_balance(doer):
+  blockchain.follow_ledger()
+  return jsonify(blockchain.ledger.balance(doer)), 200
+
+@app.route('/doers/<doer>/history', methods=['GET'])
+def doer_history(doer):
+  args = request.args
+  cursor = args.get("cursor", default=0, type=int)
+  limit = args.get("limit", default=HISTORY_PAGE, type=int)
+  if cursor < 0 or limit < 1:
+    return 'Wrong cursor or limit value', 400
+  limit = min(limit, HISTORY_MAX_PAGE)
+
+  # Only the transactions of the page are read from the chain, which holds at least the blocks counted in the ledger
+  blockchain.follow_ledger()
+  positions = blockchain.ledger.history(doer, cursor, limit)
+  chain = blockchain.chain_snapshot()
+  history = [{
+    'block': index,
+    'position': position,
+    'transaction': chain[index - 1]['transactions'][position],
+  } for index, position in positions]
+
+  response = {
+    'doer': doer,
+    'history': history,
+    'next_cursor': cursor + len(history) if len(history) == limit else None,
+  }
+  return jsonify(response), 200
+
+@app.route('/blocks/<int:index>/proof/<int:position>', methods=['GET'])
+def transaction_proof(index, position):
+  chain = blockchain.chain_snapshot()
+  if not 1 <= index <= len(chain):
+    return 'Unknown block', 404
+  block = chain[index - 1]
+  if 'merkle_root' not in block:
+    return 'Block mined without a Merkle root', 404
+  if not 0 <= position < len(block['transactions']):
+    return 'Unknown transaction', 404
+
+  # Enough for a client holding the headers to check that the transaction is in the chain
   response = {
-    'chain': blockchain.chain,
-    'length': len(blockchain.chain)
+    'block': index,
+    'position': position,
+    'transaction': block['transactions'][position],
+    'header': encoding.header(block),
+    'proof': merkle.proof(block['transactions'], position),
   }
   return jsonify(response), 200
 
+@app.route('/chain', methods=['GET'])
+def full_chain():
+  chain = blockchain.chain_snapshot()
+  # The chain only changes with its last block, whose hash tags the answer
+  tip = chain.tip
+  if request.if_none_match.contains(tip):
+    response = Response(status=304)
+    response.set_etag(tip)
+    return response
+
+  # Only send the blocks of the page asked for, the whole chain by default
+  positions = page(len(chain))
+  if positions is None:
+    return 'Wrong limit value', 400
+
+  # Blocks are sent as the canonical bytes they were stored with, without encoding them again
+  if request.args.get("format") == 'ndjson':
+    response = streamed(chain.raw(height) for height in positions)
+  else:
+    members = {'length': len(chain)}
+    if request.args.get("limit") is not None:
+      members['next'] = next_page(positions, len(chain))
+    blocks = [chain.raw(height) for height in positions]
+    response = Response(encoding.chain_document(blocks, **members), mimetype='application/json')
+
+  response.set_etag(tip)
+  return response, 200
+
+@app.route('/metrics', methods=['GET'])
+def export_metrics():
+  return Response(metrics.registry.expose(), content_type='text/plain; version=0.0.4; charset=utf-8'), 200
+
+@app.route('/debug/profiles', methods=['GET'])
+def list_profiles():
+  if not PROFILING:
+    return 'Profiling is off, start the node with --profiling', 404
+  return jsonify({'profiles': profiles.summaries()}), 200
+
+@app.route('/debug/profiles/<profile_id>', methods=['GET'])
+def show_profile(profile_id):
+  if not PROFILING:
+    return 'Profiling is off, start the node with --profiling', 404
+  profile = profiles.get(profile_id)
+  if profile is None:
+    return 'Unknown profile', 404
+
+  # The calls as printed by pstats, or the sampled stacks folded for flame graph tools
+  output = request.args.get("format")
+  if output == 'text':
+    text = profile.text()
+  elif output == 'folded':
+    text = profile.folded()
+  else:
+    return jsonify(profile.document()), 200
+
+  if text is None:
+    return f'No {output} output for a profile taken with {profile.mode}', 404
+  return Response(text, mimetype='text/plain'), 200
+
 if __name__ == '__main__':
   from argparse import ArgumentParser
   
   parser = ArgumentParser()
   parser.add_argument('-p', '--port', default=PORT, type=int, help='port to listen on')
+  parser.add_argument('-w', '--workers', default=MINER_WORKERS, type=int, help='number of mining processes, 0 for one per core')
+  parser.add_argument('--no-metrics', action='store_true', help='stop recording the measures served on /metrics')
+  parser.add_argument('--profiling', action='store_true', help='profile the requests asking for it, served on /debug/profiles')
   args = parser.parse_args()
   port = args.port
   
+  blockchain.miner = mining.make_miner(args.workers)
+  if args.no_metrics:
+    metrics.registry.enabled = False
+  PROFILING = args.profiling
+  
   app.run(host=HOST, port=port)
\ No newline at end of file
@@ -0,0 +1,6 @@
+"""
+Modules shared by the centralized and the decentralized nodes
+
+The nodes are packages next to this one, run from the blockchain
+directory, and import these as `from common import storage`.
+"""
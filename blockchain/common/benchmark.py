@@ -0,0 +1,296 @@
+"""
+Benchmarks of the Blockchain core and of the HTTP endpoints of the node
+
+Run it from the blockchain directory, for either node:
+
+    python -m common.benchmark [--node decentralized] [--quick] [--output results.json] [--baseline baseline.json]
+
+Results are printed as JSON, one flat value per measure, so that two runs
+can be compared key by key. Times are the best of a few repeats.
+"""
+import hashlib
+import importlib
+import json
+import os
+import platform
+import shutil
+import tempfile
+import tracemalloc
+from argparse import ArgumentParser
+from itertools import count
+from time import perf_counter, time
+from timeit import repeat
+
+# The node creates its data directory and its Blockchain when it is imported, away from the real data
+_cwd = os.getcwd()
+_workdir = tempfile.mkdtemp(prefix='chores-benchmark-')
+os.chdir(_workdir)
+
+from . import encoding
+from . import mempool
+from . import merkle
+from . import metrics
+from . import mining
+from . import records
+
+REPEAT = 5
+# Module of the node benchmarked, see load_node
+node = None
+
+
+def load_node(name):
+  """
+  Import a node, from its package next to the common package
+
+  :param name: 'centralized' or 'decentralized'
+  :return: The module of the node
+  """
+
+  return importlib.import_module(f'{name}.blockchain')
+
+
+def best(function, number=1):
+  """
+  :return: <float> Best time in seconds of one call of the function
+  """
+
+  return min(repeat(function, repeat=REPEAT, number=number)) / number
+
+
+def chore(index, doer='doer', status='pending', reviewer=''):
+  return {
+    'id': f'{index:032x}',
+    'index': index,
+    'doer': doer,
+    'task': 'Clean the kitchen',
+    'duration': 1.5,
+    'status': status,
+    'reviewer': reviewer,
+    'timestamp': time(),
+  }
+
+
+def new_node():
+  """
+  :return: <Blockchain> A node kept in memory, mining in the calling thread
+  """
+
+  blockchain = node.Blockchain(miner=mining.SerialMiner(), data_dir=None)
+  blockchain.mining_jobs = mining.MiningJobs(blockchain.mine_block, background=False)
+  return blockchain
+
+
+def bench_valid_proof(results, quick):
+  proofs = range(20000 if quick else 200000)
+  last_hash = '0' * 64
+
+  seconds = best(lambda: [mining.valid_proof(100, proof, last_hash, 8) for proof in proofs])
+  results['valid_proof.reference.hashes_per_second'] = len(proofs) / seconds
+
+  validator = mining.ProofValidator(100, last_hash, 8)
+  seconds = best(lambda: validator.find(proofs.start, proofs.stop))
+  results['valid_proof.validator.hashes_per_second'] = len(proofs) / seconds
+
+
+def bench_hash(results, quick):
+  for size in (1, 10, 100) if quick else (1, 10, 100, 1000):
+    transactions = [chore(index, status='accepted', reviewer='reviewer') for index in range(size)]
+    block = {
+      'index': 2,
+      'timestamp': time(),
+      'transactions': transactions,
+      'merkle_root': merkle.root(transactions),
+      'proof': 35293,
+      'difficulty': 4,
+      'previous_hash': '0' * 64,
+    }
+    results[f'hash.{size}_transactions.seconds'] = best(lambda: node.Blockchain.hash(block), 100)
+    results[f'merkle_root.{size}_transactions.seconds'] = best(lambda: merkle.root(transactions), 10)
+    results[f'canonical.{size}_transactions.seconds'] = best(lambda: encoding.canonical(block), 10)
+
+    # A /chain answer of a hundred such blocks, decoded, and built from their canonical bytes
+    data = encoding.canonical(block)
+    stored = [data] * 100
+    results[f'loads.{size}_transactions.seconds'] = best(lambda: encoding.loads(data), 10)
+    results[f'chain_document.100_blocks.{size}_transactions.seconds'] = best(lambda: encoding.chain_document(stored, length=len(stored)), 10)
+
+
+def build_chain(length):
+  """
+  Mine a chain of blocks of ten chores, each one at the difficulty the node retargets for it
+
+  Every block declares that its proof took sixteen times the target interval
+  to find, so the difficulty steps down to the lowest one within a few
+  blocks and the chain is quick to build.
+
+  :param length: <int> Number of blocks, the genesis block included
+  :return: <Blockchain> The node holding the chain
+  """
+
+  blockchain = new_node()
+  for height in range(1, length):
+    last_block = blockchain.last_block
+    previous_hash = blockchain.chain.hash(-1)
+    difficulty = blockchain.next_difficulty()
+    proof = blockchain.proof_of_work(last_block, difficulty, previous_hash)
+    transactions = [chore(height * 10 + index, status='accepted', reviewer='reviewer') for index in range(10)]
+    blockchain.new_block(proof, previous_hash, difficulty, transactions, time() - 16 * node.BLOCK_INTERVAL)
+  return blockchain
+
+
+def bench_valid_chain(results, quick):
+  # Only the decentralized node validates the chains of other nodes
+  if not hasattr(node.Blockchain, 'valid_chain'):
+    return
+
+  for length in (10, 100) if quick else (10, 100, 1000):
+    # A node with another genesis block shares nothing with the chain and checks all of it
+    chain = list(build_chain(length).chain)
+    other = new_node()
+    assert other.valid_chain(chain)
+    results[f'valid_chain.{length}_blocks.seconds'] = best(lambda: other.valid_chain(chain))
+
+
+def bench_mempool(results, quick):
+  for size in (10, 1000) if quick else (10, 1000, 100000):
+    transactions = [chore(index, doer=f'doer {index % 10}') for index in range(1, size + 1)]
+    results[f'mempool.{size}_pending.build.seconds'] = best(lambda: mempool.Mempool(transactions))
+
+    pool = mempool.Mempool(transactions)
+    results[f'mempool.{size}_pending.with_index.seconds'] = best(lambda: pool.with_index(size // 2), 1000)
+    results[f'mempool.{size}_pending.reviewed.seconds'] = best(lambda: pool.reviewed(), 1000)
+    results[f'mempool.{size}_pending.count_status.seconds'] = best(lambda: pool.count_status('pending'), 1000)
+
+    # Review ten chores at a time, the last one stays pending so that the pool is never fully reviewed
+    blockchain = new_node()
+    blockchain.current_transactions = mempool.Mempool(chore(index) for index in range(1, size + 2))
+    ix_lists = [list(range(start, min(start + 10, size + 1))) for start in range(1, size + 1, 10)]
+    reviews = count()
+
+    def review():
+      review = next(reviews)
+      status = ('accepted', 'rejected')[review // len(ix_lists) % 2]
+      blockchain.change_transaction_status(ix_lists[review % len(ix_lists)], status, f'reviewer {review}')
+    results[f'mempool.{size}_pending.change_transaction_status.seconds'] = best(review, 10)
+
+
+def bench_http(results, quick):
+  requests = 200 if quick else 2000
+  node.blockchain = new_node()
+  client = node.app.test_client()
+
+  # The first chore is never reviewed, so that the pool is never fully reviewed and no block is mined
+  client.post('/transactions/new', json={'doer': 'doer', 'task': 'Take out the trash', 'duration': 0.5})
+
+  start = perf_counter()
+  for index in range(requests):
+    response = client.post('/transactions/new', json={'doer': 'doer', 'task': 'Clean the kitchen', 'duration': 1.5})
+    assert response.status_code == 201
+  results['http.transactions_new.requests_per_second'] = requests / (perf_counter() - start)
+
+  start = perf_counter()
+  for index in range(2, requests + 2):
+    response = client.post('/transactions/status/update', json={'ix_list': [index], 'status': 'accepted', 'reviewer': 'reviewer'})
+    assert response.status_code == 201
+  results['http.transactions_status_update.requests_per_second'] = requests / (perf_counter() - start)
+
+
+def bench_records(results, quick):
+  # Memory of the chores decoded from JSON, kept as dicts and as records, and the cost of the converters
+  size = 10000 if quick else 100000
+  data = json.dumps([chore(index, doer=f'doer {index % 10}', status='accepted', reviewer=f'doer {index % 7}') for index in range(size)])
+  for name, convert in (('dict', None), ('record', records.Transaction.from_dict)):
+    tracemalloc.start()
+    transactions = json.loads(data)
+    if convert is not None:
+      transactions = [convert(transaction) for transaction in transactions]
+    results[f'records.{name}.bytes_per_chore'] = tracemalloc.get_traced_memory()[0] / size
+    tracemalloc.stop()
+
+  # Scan of the statuses of the chores, compared as strings in the dicts and as small ints in the records
+  dicts = json.loads(data)
+  transactions = [records.Transaction.from_dict(transaction) for transaction in dicts]
+  results['records.dict.status_scan.seconds'] = best(lambda: sum(1 for transaction in dicts if transaction['status'] != 'pending'))
+  results['records.record.status_scan.seconds'] = best(lambda: sum(1 for transaction in transactions if transaction.status != records.PENDING))
+
+  block = {
+    'index': 2,
+    'timestamp': time(),
+    'transactions': json.loads(data)[:100],
+    'merkle_root': '0' * 64,
+    'proof': 35293,
+    'difficulty': 4,
+    'previous_hash': '0' * 64,
+  }
+  record = records.Block.from_dict(block)
+  results['records.100_transactions.from_dict.seconds'] = best(lambda: records.Block.from_dict(block), 10)
+  results['records.100_transactions.to_dict.seconds'] = best(lambda: record.to_dict(), 10)
+
+
+def bench_metrics(results, quick):
+  # Cost of the measures on the hottest hook, hashing a block, against the bare hash
+  transactions = [chore(index, status='accepted', reviewer='reviewer') for index in range(10)]
+  block = {
+    'index': 2,
+    'timestamp': time(),
+    'transactions': transactions,
+    'merkle_root': merkle.root(transactions),
+    'proof': 35293,
+    'difficulty': 4,
+    'previous_hash': '0' * 64,
+  }
+  number = 1000 if quick else 10000
+  histogram = metrics.registry.histogram('chores_benchmark_seconds', 'Values recorded by the benchmark')
+  enabled = metrics.registry.enabled
+  try:
+    results['metrics.hash.bare.seconds'] = best(lambda: hashlib.sha256(encoding.canonical(encoding.hashed(block))).hexdigest(), number)
+    for state in ('enabled', 'disabled'):
+      metrics.registry.enabled = state == 'enabled'
+      results[f'metrics.hash.{state}.seconds'] = best(lambda: encoding.block_hash(block), number)
+      results[f'metrics.observe.{state}.seconds'] = best(lambda: histogram.observe(0.1), number)
+  finally:
+    metrics.registry.enabled = enabled
+
+
+BENCHMARKS = [bench_valid_proof, bench_hash, bench_valid_chain, bench_mempool, bench_records, bench_metrics, bench_http]
+
+
+if __name__ == '__main__':
+  parser = ArgumentParser()
+  parser.add_argument('--node', default='centralized', choices=('centralized', 'decentralized'), help='node to benchmark')
+  parser.add_argument('--quick', action='store_true', help='smaller sizes, for a quick check')
+  parser.add_argument('--output', help='file to write the results to, besides printing them')
+  parser.add_argument('--baseline', help='results of an earlier run to compare with')
+  parser.add_argument('-k', '--only', default='', help='run only the benchmarks whose name contains this')
+  args = parser.parse_args()
+
+  node = load_node(args.node)
+  results = {}
+  try:
+    for benchmark in BENCHMARKS:
+      if args.only in benchmark.__name__:
+        benchmark(results, args.quick)
+  finally:
+    os.chdir(_cwd)
+    shutil.rmtree(_workdir, ignore_errors=True)
+
+  report = {
+    'python': platform.python_version(),
+    'machine': platform.machine(),
+    'node': args.node,
+    'json_backend': encoding.BACKEND,
+    'quick': args.quick,
+    'results': results,
+  }
+
+  # Ratio of every measure to the baseline, above 1 is faster for rates and slower for times
+  if args.baseline:
+    with open(args.baseline) as baseline:
+      before = json.load(baseline)['results']
+    report['ratios'] = {key: value / before[key] for key, value in results.items() if before.get(key)}
+
+  output = json.dumps(report, indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as results_file:
+      results_file.write(output + '\n')
+  print(output)
@@ -0,0 +1,97 @@
+import hashlib
+import json
+
+from . import metrics
+
+# orjson decodes several times faster than the json module when it is installed. Its output is
+# not byte for byte the one of json.dumps, so it is never used to produce the canonical bytes
+try:
+  import orjson
+except ImportError:
+  orjson = None
+
+BACKEND = 'orjson' if orjson is not None else 'json'
+
+# The encoder is built once instead of on every call, blocks have no cycles to check for
+_encoder = json.JSONEncoder(sort_keys=True, check_circular=False)
+
+# Every hash of a block is timed here, the ones of the storage and the headers included
+HASH_SECONDS = metrics.registry.histogram('chores_block_hash_seconds', 'Seconds spent hashing a block, its count is the number of hashes')
+
+
+def canonical(block):
+  """
+  Canonical bytes of a Block, the ones that are hashed, stored and sent to other nodes
+
+  They are exactly the bytes of json.dumps(block, sort_keys=True), so the
+  hashes of the blocks don't change.
+
+  :param block: <dict> Block
+  :return: <bytes>
+  """
+
+  # We must make sure that the Dictionary is Ordered, or we'll have inconsistent hashes
+  return _encoder.encode(block).encode()
+
+
+def header(block):
+  """
+  :param block: <dict> Block
+  :return: <dict> The Block without its transactions, which its Merkle root stands for
+  """
+
+  return {key: value for key, value in block.items() if key != 'transactions'}
+
+
+def hashed(block):
+  """
+  :param block: <dict> Block
+  :return: <dict> The part of the Block covered by its hash, its header if it has a Merkle root
+  """
+
+  return header(block) if 'merkle_root' in block else block
+
+
+def block_hash(block, data=None):
+  """
+  SHA-256 hash of a Block
+
+  Blocks with a Merkle root are hashed without their transactions, so that
+  their headers are enough to check the chain. Older Blocks are hashed whole.
+
+  :param block: <dict> Block
+  :param data: <bytes> Canonical bytes of the Block, if they are at hand
+  :return: <str>
+  """
+
+  with HASH_SECONDS.time():
+    if 'merkle_root' in block:
+      data = canonical(header(block))
+    elif data is None:
+      data = canonical(block)
+    return hashlib.sha256(data).hexdigest()
+
+
+def loads(data):
+  """
+  :param data: <bytes> JSON document
+  :return: The decoded document
+  """
+
+  if orjson is not None:
+    return orjson.loads(data)
+  return json.loads(data)
+
+
+def chain_document(blocks, **members):
+  """
+  Body of a /chain answer built from the canonical bytes of its blocks, without encoding them again
+
+  :param blocks: canonical bytes of the blocks
+  :param members: other members of the answer. Eg. length=5
+  :return: <bytes>
+  """
+
+  document = [b'"chain": [' + b', '.join(blocks) + b']']
+  document += [_encoder.encode({name: value})[1:-1].encode() for name, value in members.items()]
+  return b'{' + b', '.join(document) + b'}'
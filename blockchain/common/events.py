@@ -0,0 +1,114 @@
+import threading
+from collections import deque
+from itertools import islice
+from time import monotonic, time
+from uuid import uuid4
+
+from . import encoding
+
+# Types of the events, what they tell about
+KINDS = (
+  'transaction_added',     # a transaction joined the current transactions
+  'status_changed',        # a current transaction was accepted, rejected or set back to pending
+  'transactions_sealed',   # reviewed transactions left the current transactions to be mined in a Block
+  'transactions_replaced', # the current transactions were read again from another node or process, they must be fetched again
+  'block_sealed',          # a Block was added at the end of the chain
+  'chain_replaced',        # the end of the chain was replaced by the one of another node
+  'reset',                 # events were missed, everything must be fetched again
+)
+
+
+class EventLog:
+    """
+    Last events of the node, numbered in the order they happened, for the clients following the node
+
+    A client reads the events after the last one it got, given by its cursor.
+    The cursor holds the session of the log, a new one every time the node
+    starts, so that a client coming back to a restarted node, or to another
+    worker process, is told with a reset event to fetch everything again, as
+    it is when the events it missed are no longer kept.
+    """
+
+    def __init__(self, size=1000):
+      """
+      :param size: <int> Number of events kept for the clients coming back after a disconnection
+      """
+
+      self.session = uuid4().hex
+      self._events = deque(maxlen=size)
+      self._seq = 0
+      self._condition = threading.Condition()
+
+    @property
+    def cursor(self):
+      """
+      :return: <str> Cursor of the last event, to read the events that follow it
+      """
+
+      return f'{self.session}:{self._seq}'
+
+    def publish(self, kind, **data):
+      """
+      :param kind: One of KINDS
+      :param data: What the event is about. Eg. index=3, status='accepted'
+      :return: <int> Number of the event
+      """
+
+      with self._condition:
+        self._seq += 1
+        self._events.append(dict(data, seq=self._seq, type=kind, timestamp=time()))
+        self._condition.notify_all()
+        return self._seq
+
+    def _position(self, cursor):
+      """
+      :return: <int> Number of the event the cursor points at, None if the events after it are no longer kept
+      """
+
+      session, _, seq = (cursor or '').partition(':')
+      if session != self.session or not seq.isdigit():
+        return None
+      seq = int(seq)
+      if seq > self._seq or seq < self._seq - len(self._events):
+        return None
+      return seq
+
+    def read(self, cursor, wait=0.0, kinds=None):
+      """
+      Read the events after the given cursor, waiting for one if there is none yet
+
+      :param cursor: <str> Cursor of the last event the client got
+      :param wait: <float> Seconds to wait at most for an event
+      :param kinds: <set> Types of the events wanted, None for all of them
+      :return: <list> The events, oldest first, a single reset event if the ones after the cursor are no longer kept;
+               and <str> the cursor to read the next events from
+      """
+
+      deadline = monotonic() + wait
+      with self._condition:
+        while True:
+          seq = self._position(cursor)
+          if seq is None:
+            return [{'seq': self._seq, 'type': 'reset', 'timestamp': time()}], self.cursor
+
+          # The events kept are numbered one after the other, up to the last one
+          start = len(self._events) - (self._seq - seq)
+          events = [event for event in islice(self._events, start, None) if kinds is None or event['type'] in kinds]
+          cursor = self.cursor
+
+          remaining = deadline - monotonic()
+          if events or remaining <= 0:
+            return events, cursor
+          self._condition.wait(remaining)
+
+
+def server_sent(event, session):
+  """
+  :param event: <dict> Event
+  :param session: <str> Session of the log of the event
+  :return: <bytes> The event in the format of Server-Sent Events, with its cursor as id so that
+           the client sends it back in Last-Event-ID when it reconnects
+  """
+
+  cursor = f"{session}:{event['seq']}"
+  return b'id: ' + cursor.encode() + b'\nevent: ' + event['type'].encode() + b'\ndata: ' + encoding.canonical(event) + b'\n\n'
@@ -0,0 +1,143 @@
+import threading
+
+# Task of the transactions that credit a reviewer for reviewing a list of transactions
+REVIEW_TASK = "Task list review"
+
+# Totals kept for every person
+TOTALS = ('accepted', 'rejected', 'rewards', 'reviewed')
+
+
+def hours(duration):
+  """
+  :param duration: Duration of a transaction as sent by the client
+  :return: <float> The duration, 0 if it is not a number
+  """
+
+  try:
+    return float(duration)
+  except (TypeError, ValueError):
+    return 0.0
+
+
+class Ledger:
+    """
+    Balance and history of every doer, kept up to date block by block
+
+    Every block only adds to the accounts of the people in it, so adding a
+    block costs as much as its transactions and reading a balance doesn't
+    depend on the length of the chain. What every block added is kept, so
+    that the blocks dropped when the chain is replaced can be taken out again.
+    """
+
+    def __init__(self):
+      self._accounts = {}
+      # Hash of every block counted and what it added to every account
+      self._hashes = []
+      self._credits = []
+      self._lock = threading.RLock()
+
+    @staticmethod
+    def _new_account(history=None):
+      account = {key: 0 for key in TOTALS}
+      account['history'] = [] if history is None else history
+      return account
+
+    def __len__(self):
+      return len(self._hashes)
+
+    def _add(self, block, block_hash):
+      credits = {}
+      for position, transaction in enumerate(block['transactions']):
+        doer = transaction['doer']
+        credit = credits.setdefault(doer, self._new_account(0))
+        account = self._accounts.setdefault(doer, self._new_account())
+
+        if transaction['status'] == 'accepted' and transaction['task'] == REVIEW_TASK:
+          credit['rewards'] += hours(transaction['duration'])
+        elif transaction['status'] in ('accepted', 'rejected'):
+          credit[transaction['status']] += hours(transaction['duration'])
+        account['history'].append((block['index'], position))
+        credit['history'] += 1
+
+        # The reviewer is credited with the review, whoever did the task
+        reviewer = transaction.get('reviewer')
+        if reviewer and transaction['task'] != REVIEW_TASK:
+          self._accounts.setdefault(reviewer, self._new_account())
+          credits.setdefault(reviewer, self._new_account(0))['reviewed'] += 1
+
+      for doer, credit in credits.items():
+        account = self._accounts[doer]
+        for key in TOTALS:
+          account[key] += credit[key]
+
+      self._hashes.append(block_hash)
+      self._credits.append(credits)
+
+    def _drop(self, height):
+      """
+      Take out the blocks from the given height on
+      """
+
+      while len(self._hashes) > height:
+        self._hashes.pop()
+        for doer, credit in self._credits.pop().items():
+          account = self._accounts[doer]
+          for key in TOTALS:
+            account[key] -= credit[key]
+          del account['history'][len(account['history']) - credit['history']:]
+          if not account['history'] and not account['reviewed']:
+            del self._accounts[doer]
+
+    def follow(self, chain):
+      """
+      Bring the ledger in step with the chain, after blocks were added to it or replaced
+
+      Blocks are chained by their hashes, so the first block the ledger
+      counted that is no longer in the chain is found with a binary search.
+
+      :param chain: <MemoryChain> or <ChainLog> The chain of the node
+      """
+
+      with self._lock:
+        low, high = 0, min(len(self._hashes), len(chain))
+        while low < high:
+          middle = (low + high) // 2
+          if self._hashes[middle] == chain.hash(middle):
+            low = middle + 1
+          else:
+            high = middle
+
+        self._drop(low)
+        for height in range(low, len(chain)):
+          self._add(chain[height], chain.hash(height))
+
+    def balance(self, doer):
+      """
+      :param doer: identificator of the person
+      :return: <dict> Hours accepted and rejected, hours credited for reviews and number of transactions reviewed
+      """
+
+      with self._lock:
+        account = self._accounts.get(doer) or self._new_account()
+        return {
+          'doer': doer,
+          'accepted': account['accepted'],
+          'rejected': account['rejected'],
+          'rewards': account['rewards'],
+          'total': account['accepted'] + account['rewards'],
+          'reviewed': account['reviewed'],
+          'transactions': len(account['history']),
+          'height': len(self._hashes),
+        }
+
+    def history(self, doer, cursor=0, limit=50):
+      """
+      :param doer: identificator of the person
+      :param cursor: <int> Number of the person's transactions already read
+      :param limit: <int> Largest number of transactions returned
+      :return: <list> Index of the block and position in it of the next transactions of the person, oldest first
+      """
+
+      with self._lock:
+        account = self._accounts.get(doer) or self._new_account()
+        return account['history'][cursor:cursor + limit]
@@ -0,0 +1,171 @@
+from . import records
+
+
+class Mempool:
+    """
+    List of the Transaction records waiting to go into a Block, indexed by transaction index, id, doer and status
+
+    Transactions given as dicts are turned into records, to_dicts gives
+    them back as the API sends them. The list is private, transactions can
+    only be added with append and their status only changed with set_status,
+    so that the indexes and the count of transactions in every status stay
+    in step with it. Transactions are taken out by building a new Mempool,
+    see excluding and without. Statuses are indexed by their small int, see
+    records.
+    """
+
+    def __init__(self, transactions=()):
+      self._transactions = []
+      # Position of every transaction in the list, by identity of the transaction
+      self._positions = {}
+      # Indexes map a key to the transactions holding it, by identity of the transaction
+      self._by_index = {}
+      self._by_id = {}
+      self._by_doer = {}
+      self._by_status = {}
+      # Largest transaction index in the list, the transactions carried over from a sealed list keep theirs
+      self._last_index = 0
+      for transaction in transactions:
+        self.append(transaction)
+
+    def __len__(self):
+      return len(self._transactions)
+
+    def __iter__(self):
+      return iter(self._transactions)
+
+    @staticmethod
+    def _add(index, key, transaction):
+      index.setdefault(key, {})[id(transaction)] = transaction
+
+    @staticmethod
+    def _discard(index, key, transaction):
+      entries = index.get(key)
+      if entries is not None:
+        entries.pop(id(transaction), None)
+        if not entries:
+          del index[key]
+
+    def append(self, transaction):
+      """
+      :param transaction: <Transaction> or <dict> Transaction, as a record or as sent by the API
+      :return: <Transaction> The record added to the list
+      """
+
+      if type(transaction) is not records.Transaction:
+        transaction = records.Transaction.from_dict(transaction)
+      self._positions[id(transaction)] = len(self._transactions)
+      self._transactions.append(transaction)
+      self._add(self._by_index, transaction.index, transaction)
+      self._add(self._by_doer, transaction.doer, transaction)
+      self._add(self._by_status, transaction.status, transaction)
+      if transaction.id is not None:
+        self._by_id[transaction.id] = transaction
+      if type(transaction.index) is int and transaction.index > self._last_index:
+        self._last_index = transaction.index
+      return transaction
+
+    @property
+    def next_index(self):
+      """
+      Index of the next transaction added, so that it doesn't take the index of a transaction carried over
+      """
+
+      return self._last_index + 1
+
+    def position(self, transaction):
+      """
+      :param transaction: <Transaction> Transaction of the list
+      :return: <int> Its position in the list
+      """
+
+      return self._positions[id(transaction)]
+
+    def set_status(self, transaction, status, reviewer):
+      """
+      :param transaction: <Transaction> Transaction of the list
+      :param status: New status, its name or its small int
+      :param reviewer: identificator of the person who reviewed the transaction
+      """
+
+      status = records.status_code(status)
+      self._discard(self._by_status, transaction.status, transaction)
+      transaction.status = status
+      transaction.reviewer = records.intern(reviewer)
+      self._add(self._by_status, status, transaction)
+
+    def to_dicts(self):
+      """
+      :return: <list> The transactions as sent by the API, saved and put in a Block
+      """
+
+      return [transaction.to_dict() for transaction in self]
+
+    def with_index(self, index):
+      """
+      :return: <list> The transactions with the given index
+      """
+
+      return list(self._by_index.get(index, {}).values())
+
+    def with_id(self, transaction_id):
+      """
+      :return: <Transaction> The transaction with the given id, None if there is none
+      """
+
+      return self._by_id.get(transaction_id)
+
+    def of_doer(self, doer):
+      """
+      :return: <list> The transactions carried out by the given person
+      """
+
+      return list(self._by_doer.get(doer, {}).values())
+
+    def with_status(self, status):
+      """
+      :param status: Status, its name or its small int
+      :return: <list> The transactions with the given status
+      """
+
+      return list(self._by_status.get(records.status_code(status), {}).values())
+
+    def count_status(self, status):
+      """
+      :param status: Status, its name or its small int
+      :return: <int> Number of transactions with the given status
+      """
+
+      return len(self._by_status.get(records.status_code(status), ()))
+
+    def reviewed(self):
+      """
+      :return: <bool> True if every transaction has been accepted or rejected
+      """
+
+      return self.count_status(records.ACCEPTED) + self.count_status(records.REJECTED) == len(self)
+
+    def reviewed_transactions(self):
+      """
+      :return: <list> The transactions accepted or rejected, in the order of the list
+      """
+
+      return [transaction for transaction in self if transaction.status == records.ACCEPTED or transaction.status == records.REJECTED]
+
+    def excluding(self, transactions):
+      """
+      :param transactions: records of the list to leave out
+      :return: <Mempool> A new list without the given transactions
+      """
+
+      left_out = {id(transaction) for transaction in transactions}
+      return Mempool(transaction for transaction in self if id(transaction) not in left_out)
+
+    def without(self, transaction_ids):
+      """
+      :param transaction_ids: ids of the transactions to leave out
+      :return: <Mempool> A new list without the given transactions
+      """
+
+      transaction_ids = set(transaction_ids)
+      return Mempool(transaction for transaction in self if transaction.id not in transaction_ids)
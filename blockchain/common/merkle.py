@@ -0,0 +1,84 @@
+import hashlib
+
+from . import encoding
+
+# Leaves and inner nodes are hashed with different prefixes, so that an inner node can't pass for a transaction
+LEAF = b'\x00'
+NODE = b'\x01'
+
+
+def _leaf(transaction):
+  return hashlib.sha256(LEAF + encoding.canonical(transaction)).digest()
+
+
+def _node(left, right):
+  return hashlib.sha256(NODE + left + right).digest()
+
+
+def levels(transactions):
+  """
+  Build the Merkle tree of a list of transactions
+
+  A node without a sibling goes up to the next level as it is.
+
+  :param transactions: <list> Transactions of a Block
+  :return: <list> The levels of the tree, from the leaves up to the root
+  """
+
+  level = [_leaf(transaction) for transaction in transactions]
+  tree = [level]
+  while len(level) > 1:
+    level = [_node(*level[i:i + 2]) if i + 1 < len(level) else level[i] for i in range(0, len(level), 2)]
+    tree.append(level)
+  return tree
+
+
+def root(transactions):
+  """
+  :param transactions: <list> Transactions of a Block
+  :return: <str> The Merkle root of the transactions
+  """
+
+  top = levels(transactions)[-1]
+  return top[0].hex() if top else hashlib.sha256(b'').hexdigest()
+
+
+def proof(transactions, position):
+  """
+  Proof that a transaction is in a Block, made of one hash per level of the tree
+
+  :param transactions: <list> Transactions of the Block
+  :param position: <int> Position of the transaction in the Block
+  :return: <list> The siblings of the transaction and of its ancestors, from the leaves up
+  """
+
+  path = []
+  for level in levels(transactions)[:-1]:
+    sibling = position ^ 1
+    if sibling < len(level):
+      path.append({'side': 'left' if sibling < position else 'right', 'hash': level[sibling].hex()})
+    position //= 2
+  return path
+
+
+def verify(transaction, path, merkle_root):
+  """
+  Check that a transaction is in a Block knowing only the header of the Block
+
+  The header itself is checked by the client: its hash, encoding.block_hash,
+  is the previous_hash of the next header of the chain.
+
+  :param transaction: <dict> The transaction
+  :param path: <list> Proof returned by proof()
+  :param merkle_root: <str> Merkle root of the header of the Block
+  :return: <bool> True if the transaction is in the Block
+  """
+
+  try:
+    digest = _leaf(transaction)
+    for step in path:
+      sibling = bytes.fromhex(step['hash'])
+      digest = _node(sibling, digest) if step['side'] == 'left' else _node(digest, sibling)
+  except (KeyError, TypeError, ValueError):
+    return False
+  return digest.hex() == merkle_root
@@ -0,0 +1,237 @@
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+# Upper bounds in seconds of the buckets of the durations, from a hash to a slow block
+LATENCY_BUCKETS = (0.00001, 0.0001, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# Upper bounds of the buckets of the nonces tried, every hex zero of difficulty makes a proof 16 times harder
+NONCE_BUCKETS = tuple(16 ** power for power in range(9))
+
+# Upper bounds of the buckets of the number of blocks looked at
+BLOCK_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+
+def _escape(value):
+  return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(names, values, extra=''):
+  pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+  if extra:
+    pairs.append(extra)
+  return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+def _number(value):
+  if value == float('inf'):
+    return '+Inf'
+  return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Timer:
+    """
+    Observes the time spent in a with block
+    """
+
+    __slots__ = ('_histogram', '_labels', '_start')
+
+    def __init__(self, histogram, labels):
+      self._histogram = histogram
+      self._labels = labels
+
+    def __enter__(self):
+      self._start = perf_counter()
+      return self
+
+    def __exit__(self, *exc_info):
+      self._histogram.observe(perf_counter() - self._start, *self._labels)
+      return False
+
+
+class _NoTimer:
+    """
+    Timer of a disabled registry, shared by every with block
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+      return self
+
+    def __exit__(self, *exc_info):
+      return False
+
+
+_NO_TIMER = _NoTimer()
+
+
+class Counter:
+    """
+    Number of times something happened, for every combination of label values
+
+    Its name ends with _total, as Prometheus expects of counters.
+    """
+
+    kind = 'counter'
+
+    def __init__(self, registry, name, documentation, labels=()):
+      self.name = name
+      self.documentation = documentation
+      self.labels = tuple(labels)
+      self._registry = registry
+      self._values = {}
+      self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+      """
+      :param labels: Value of every label of the counter, in order
+      :param amount: Number added to the counter
+      """
+
+      if not self._registry.enabled:
+        return
+      with self._lock:
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+      with self._lock:
+        values = sorted(self._values.items())
+      return [f'{self.name}{_labels(self.labels, key)} {_number(value)}' for key, value in values]
+
+
+class Histogram:
+    """
+    Distribution of a measure in buckets, with their sum and their count, for every combination of label values
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, registry, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+      self.name = name
+      self.documentation = documentation
+      self.labels = tuple(labels)
+      self.buckets = tuple(sorted(buckets))
+      self._registry = registry
+      # Count of every bucket, the last one for the values above all the bounds, then the sum of the values
+      self._values = {}
+      self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+      """
+      :param value: The measure
+      :param labels: Value of every label of the histogram, in order
+      """
+
+      if not self._registry.enabled:
+        return
+      position = bisect_left(self.buckets, value)
+      with self._lock:
+        counts = self._values.get(labels)
+        if counts is None:
+          counts = self._values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[position] += 1
+        counts[-1] += value
+
+    def time(self, *labels):
+      """
+      Observe the seconds spent in a with block
+
+      :param labels: Value of every label of the histogram, in order
+      :return: A context manager, that does nothing while the registry is disabled
+      """
+
+      if not self._registry.enabled:
+        return _NO_TIMER
+      return _Timer(self, labels)
+
+    def samples(self):
+      with self._lock:
+        values = sorted((key, list(counts)) for key, counts in self._values.items())
+
+      samples = []
+      for key, counts in values:
+        # Buckets are cumulative in the exposition format
+        total = 0
+        for bound, count in zip(self.buckets + (float('inf'),), counts):
+          total += count
+          bound = 'le="' + _number(bound) + '"'
+          samples.append(f'{self.name}_bucket{_labels(self.labels, key, bound)} {total}')
+        samples.append(f'{self.name}_sum{_labels(self.labels, key)} {_number(counts[-1])}')
+        samples.append(f'{self.name}_count{_labels(self.labels, key)} {total}')
+      return samples
+
+
+class Gauge:
+    """
+    Value read when the measures are exported, so that keeping it costs nothing in between
+    """
+
+    kind = 'gauge'
+
+    def __init__(self, registry, name, documentation, labels, collect):
+      self.name = name
+      self.documentation = documentation
+      self.labels = tuple(labels)
+      self._collect = collect
+
+    def samples(self):
+      values = self._collect()
+      if not isinstance(values, dict):
+        values = {(): values}
+      return [f'{self.name}{_labels(self.labels, key)} {_number(value)}' for key, value in sorted(values.items())]
+
+
+class Registry:
+    """
+    Measures of a node, exported in the text format of Prometheus
+
+    A disabled registry keeps the measures it has but records nothing more:
+    recording then costs a look at the flag, and timing a block enters and
+    leaves a shared object that doesn't read the clock.
+    """
+
+    def __init__(self, enabled=True):
+      self.enabled = enabled
+      self._metrics = {}
+      self._lock = threading.Lock()
+
+    def _register(self, metric):
+      with self._lock:
+        # A module loaded again records into the measures of its first load
+        return self._metrics.setdefault(metric.name, metric)
+
+    def counter(self, name, documentation, labels=()):
+      return self._register(Counter(self, name, documentation, labels))
+
+    def histogram(self, name, documentation, labels=(), buckets=LATENCY_BUCKETS):
+      return self._register(Histogram(self, name, documentation, labels, buckets))
+
+    def gauge(self, name, documentation, collect, labels=()):
+      """
+      :param collect: Function returning the value of the gauge, or a dict of the value for every tuple of label values
+      """
+
+      with self._lock:
+        # The function may read objects created again, the last one given is kept
+        self._metrics[name] = Gauge(self, name, documentation, labels, collect)
+        return self._metrics[name]
+
+    def expose(self):
+      """
+      :return: <str> Every measure in the text format of Prometheus
+      """
+
+      with self._lock:
+        metrics = list(self._metrics.values())
+
+      lines = []
+      for metric in metrics:
+        lines.append(f'# HELP {metric.name} {metric.documentation}')
+        lines.append(f'# TYPE {metric.name} {metric.kind}')
+        lines.extend(metric.samples())
+      return '\n'.join(lines) + '\n'
+
+
+# Measures of the node, shared by all its modules
+registry = Registry()
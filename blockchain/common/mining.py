@@ -0,0 +1,472 @@
+import hashlib
+import math
+import os
+import queue
+import threading
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from multiprocessing import Event
+from time import time
+from uuid import uuid4
+
+# Number of leading hex zeroes required in the hash of a valid proof
+DIFFICULTY = 4
+
+# Number of nonces handed to a worker in one go
+CHUNK_SIZE = 50000
+
+# Number of nonces a worker tries between two looks at the cancellation flag
+CHECK_INTERVAL = 1024
+
+# Cancellation flag shared with the worker processes, see _init_worker
+_found = None
+
+
+def valid_proof(last_proof, proof, last_hash, difficulty=DIFFICULTY):
+  """
+  Validates the Proof
+
+  :param last_proof: <int> Previous Proof
+  :param proof: <int> Current Proof
+  :param last_hash: <str> The hash of the Previous Block
+  :param difficulty: <int> Number of leading hex zeroes required
+  :return: <bool> True if correct, False if not.
+  """
+
+  # A negative difficulty would cut the end of the hash off, no proof is valid then
+  if difficulty < 0:
+    return False
+
+  guess = f'{last_proof}{proof}{last_hash}'.encode()
+  guess_hash = hashlib.sha256(guess).hexdigest()
+  return guess_hash[:difficulty] == "0" * difficulty
+
+
+def difficulty_target(difficulty):
+  """
+  Digest bound matching a hash whose hex form starts with the given number of zeroes
+
+  A hex digest starts with d zeroes exactly when the digest, read as a big
+  endian number, is lower than 16 ** (64 - d).
+
+  :param difficulty: <int> Number of leading hex zeroes
+  :return: <bytes> The bound, None when every digest is valid
+  """
+
+  if difficulty == 0:
+    return None
+  # Like in valid_proof, no digest is valid at a negative difficulty nor with more zeroes than a hex digest holds
+  if difficulty < 0 or difficulty > 64:
+    return bytes(32)
+  return (16 ** (64 - difficulty)).to_bytes(32, 'big')
+
+
+class ProofValidator:
+    """
+    Fast check of many proofs against the same previous block
+
+    Gives the same answers as valid_proof: the guess bytes are the same, only
+    the fixed parts are encoded once and the raw digest is compared against a
+    precomputed bound instead of building the hex digest.
+
+    The hash state of the fixed prefix isn't carried over from one proof to
+    the next: the previous proof comes first in the guess and never fills a
+    64 byte SHA-256 block, and moving the hash of the previous block first
+    would change the hash of every proof.
+    """
+
+    def __init__(self, last_proof, last_hash, difficulty=DIFFICULTY):
+      self._prefix = f'{last_proof}'.encode()
+      self._suffix = f'{last_hash}'.encode()
+      self._target = difficulty_target(difficulty)
+
+    def __call__(self, proof):
+      """
+      Validates the Proof
+
+      :param proof: <int> Current Proof
+      :return: <bool> True if correct, False if not.
+      """
+
+      if self._target is None:
+        return True
+
+      guess = self._prefix + f'{proof}'.encode() + self._suffix
+      return hashlib.sha256(guess).digest() < self._target
+
+    def find(self, start, stop):
+      """
+      Look for the first valid proof in the nonce range [start, stop)
+
+      :param start: <int> First nonce to try
+      :param stop: <int> Nonce where the search ends (excluded)
+      :return: <int> The first valid proof of the range, None if there is none
+      """
+
+      prefix, suffix, target = self._prefix, self._suffix, self._target
+      if target is None:
+        return start if start < stop else None
+
+      sha256 = hashlib.sha256
+      for proof in range(start, stop):
+        if sha256(b'%s%d%s' % (prefix, proof, suffix)).digest() < target:
+          return proof
+
+      return None
+
+
+def valid_proof_many(last_proof, proofs, last_hash, difficulty=DIFFICULTY):
+  """
+  Validates several Proofs against the same previous block
+
+  :param last_proof: <int> Previous Proof
+  :param proofs: <list> Proofs to check
+  :param last_hash: <str> The hash of the Previous Block
+  :param difficulty: <int> Number of leading hex zeroes required
+  :return: <list> One bool per proof, True if correct, False if not.
+  """
+
+  validator = ProofValidator(last_proof, last_hash, difficulty)
+  return [validator(proof) for proof in proofs]
+
+
+def search(last_proof, last_hash, difficulty, start, stop):
+  """
+  Look for a valid proof in the nonce range [start, stop)
+
+  The search gives up as soon as another worker has flagged a valid proof.
+
+  :param last_proof: <int> Previous Proof
+  :param last_hash: <str> The hash of the Previous Block
+  :param difficulty: <int> Number of leading hex zeroes required
+  :param start: <int> First nonce to try
+  :param stop: <int> Nonce where the search ends (excluded)
+  :return: <int> The first valid proof of the range, None if there is none, and <int> the number of nonces tried
+  """
+
+  validator = ProofValidator(last_proof, last_hash, difficulty)
+  tried = 0
+  for base in range(start, stop, CHECK_INTERVAL):
+    if _found is not None and _found.is_set():
+      return None, tried
+    end = min(base + CHECK_INTERVAL, stop)
+    proof = validator.find(base, end)
+    if proof is not None:
+      return proof, tried + proof - base + 1
+    tried += end - base
+
+  return None, tried
+
+
+def _init_worker(found):
+  global _found
+  _found = found
+
+
+class SerialMiner:
+    """
+    Tries the nonces one by one in the current process
+    """
+
+    workers = 1
+
+    def mine(self, last_proof, last_hash, difficulty=DIFFICULTY):
+      """
+      Find the lowest proof accepted by valid_proof
+
+      :param last_proof: <int> Previous Proof
+      :param last_hash: <str> The hash of the Previous Block
+      :param difficulty: <int> Number of leading hex zeroes required
+      :return: <int>
+      """
+
+      return self.mine_counted(last_proof, last_hash, difficulty)[0]
+
+    def mine_counted(self, last_proof, last_hash, difficulty=DIFFICULTY):
+      """
+      Find the lowest proof accepted by valid_proof, counting the nonces tried
+
+      :return: <int> The proof, and <int> the number of nonces hashed to find it
+      """
+
+      validator = ProofValidator(last_proof, last_hash, difficulty)
+      start = 0
+      while True:
+        proof = validator.find(start, start + CHECK_INTERVAL)
+        if proof is not None:
+          return proof, proof + 1
+        start += CHECK_INTERVAL
+
+    def close(self):
+      pass
+
+
+class ProcessPoolMiner:
+    """
+    Splits the nonce space in chunks and spreads them over a pool of processes
+    """
+
+    def __init__(self, workers=None, chunk_size=CHUNK_SIZE):
+      self.workers = workers or os.cpu_count() or 1
+      self.chunk_size = chunk_size
+      self._found = Event()
+      self._pool = None
+      # Only one block is mined at a time, the cancellation flag is shared by all the workers
+      self._lock = threading.Lock()
+
+    def _get_pool(self):
+      # The pool is started lazily and kept alive, starting processes for every block is too slow
+      if self._pool is None:
+        self._pool = ProcessPoolExecutor(max_workers=self.workers, initializer=_init_worker, initargs=(self._found,))
+      return self._pool
+
+    def mine(self, last_proof, last_hash, difficulty=DIFFICULTY):
+      """
+      Find a proof accepted by valid_proof using all the workers of the pool
+
+      Every worker scans its own chunk of nonces, once one of them finds a valid
+      proof the rest are told to stop and no more chunks are handed out.
+
+      :param last_proof: <int> Previous Proof
+      :param last_hash: <str> The hash of the Previous Block
+      :param difficulty: <int> Number of leading hex zeroes required
+      :return: <int>
+      """
+
+      return self.mine_counted(last_proof, last_hash, difficulty)[0]
+
+    def mine_counted(self, last_proof, last_hash, difficulty=DIFFICULTY):
+      """
+      Find a proof accepted by valid_proof using all the workers of the pool, counting the nonces tried
+
+      The workers still running when the proof is found hash a few more nonces
+      before they stop, they are counted as well: they are work the pool did.
+
+      :return: <int> The proof, and <int> the number of nonces hashed by all the workers to find it
+      """
+
+      with self._lock:
+        pool = self._get_pool()
+        self._found.clear()
+
+        # Keep two chunks per worker queued so that no worker sits idle
+        next_start = 0
+        pending = set()
+        for _ in range(self.workers * 2):
+          pending.add(pool.submit(search, last_proof, last_hash, difficulty, next_start, next_start + self.chunk_size))
+          next_start += self.chunk_size
+
+        proofs = []
+        tried = 0
+        while pending:
+          done, pending = wait(pending, return_when=FIRST_COMPLETED)
+          for future in done:
+            if future.cancelled():
+              continue
+            proof, chunk_tried = future.result()
+            tried += chunk_tried
+            if proof is not None:
+              proofs.append(proof)
+
+          if proofs:
+            # Stop the running workers and drop the chunks not started yet
+            self._found.set()
+            for future in pending:
+              future.cancel()
+          else:
+            for _ in done:
+              pending.add(pool.submit(search, last_proof, last_hash, difficulty, next_start, next_start + self.chunk_size))
+              next_start += self.chunk_size
+
+        self._found.clear()
+
+        return min(proofs), tried
+
+    def close(self):
+      if self._pool is not None:
+        self._pool.shutdown(cancel_futures=True)
+        self._pool = None
+
+
+def latencies(blocks):
+  """
+  Time spent finding the proof of the given Blocks
+
+  Only the search itself counts: the time the reviewed transactions waited
+  to be sealed or queued for the miner would lower the difficulty of a node
+  that seals on a timer, not because proofs got harder to find.
+
+  :param blocks: <list> Blocks or their headers, those mined before they held the start of their mining are skipped
+  :return: <list> Seconds
+  """
+
+  return [block['timestamp'] - block['mining_started'] for block in blocks if 'mining_started' in block]
+
+
+def retarget(difficulty, latencies, interval, min_difficulty=1, max_difficulty=64):
+  """
+  Difficulty for the next block so that mining takes about the given interval
+
+  Every extra hex zero makes a proof 16 times harder to find, so the
+  difficulty moves towards the base 16 logarithm of the ratio between the
+  target and the mean observed latency, one step at a time to smooth out
+  lucky blocks.
+
+  :param difficulty: <int> Difficulty of the last block
+  :param latencies: <list> Recent mining latencies in seconds
+  :param interval: <float> Target mean latency in seconds
+  :param min_difficulty: <int> Lowest difficulty allowed
+  :param max_difficulty: <int> Highest difficulty allowed
+  :return: <int>
+  """
+
+  if latencies:
+    mean = sum(latencies) / len(latencies)
+    if mean > 0:
+      step = round(math.log(interval / mean, 16))
+      difficulty += max(-1, min(1, step))
+    else:
+      difficulty += 1
+
+  return max(min_difficulty, min(max_difficulty, difficulty))
+
+
+class MiningJobs:
+    """
+    Queue of blocks waiting to be mined, sealed one after the other by a background thread
+
+    Every submitted job gets a ticket that can be used to follow it until its
+    block is sealed. The last finished jobs are kept so that late readers can
+    still find out what happened to their ticket.
+    """
+
+    def __init__(self, seal, background=True, history=100):
+      """
+      :param seal: Function mining and adding a block, called with the arguments given to submit
+      :param background: False to seal the blocks in the calling thread
+      :param history: Number of finished jobs remembered
+      """
+
+      self.background = background
+      self._seal = seal
+      self._history = history
+      self._queue = queue.Queue()
+      self._jobs = OrderedDict()
+      self._unfinished = 0
+      self._condition = threading.Condition()
+      self._thread = None
+
+    def submit(self, *args):
+      """
+      Queue a new block to be mined
+
+      :return: <str> The ticket of the job
+      """
+
+      job = {
+        'ticket': uuid4().hex,
+        'status': 'queued',
+        'block': None,
+        'submitted': time(),
+        'finished': None,
+      }
+
+      with self._condition:
+        self._jobs[job['ticket']] = job
+        self._unfinished += 1
+
+      if self.background:
+        self._start()
+        self._queue.put((job, args))
+      else:
+        self._process(job, args)
+
+      return job['ticket']
+
+    def pending(self):
+      """
+      :return: <int> Number of jobs queued or being mined
+      """
+
+      return self._unfinished
+
+    def status(self, ticket=None):
+      """
+      :param ticket: <str> Ticket of the job, None for all the known jobs
+      :return: <dict> The job, None if the ticket is unknown
+      """
+
+      with self._condition:
+        if ticket is None:
+          return [dict(job) for job in self._jobs.values()]
+        job = self._jobs.get(ticket)
+        return dict(job) if job is not None else None
+
+    def wait(self, ticket, timeout=None):
+      """
+      Block until the job is finished or the timeout expires
+
+      :param ticket: <str> Ticket of the job
+      :param timeout: <float> Seconds to wait at most, None to wait forever
+      :return: <dict> The job, None if the ticket is unknown
+      """
+
+      with self._condition:
+        self._condition.wait_for(lambda: self._finished(ticket), timeout)
+        job = self._jobs.get(ticket)
+        return dict(job) if job is not None else None
+
+    def _finished(self, ticket):
+      job = self._jobs.get(ticket)
+      return job is None or job['finished'] is not None
+
+    def _start(self):
+      with self._condition:
+        if self._thread is None:
+          self._thread = threading.Thread(target=self._run, name='mining-jobs', daemon=True)
+          self._thread.start()
+
+    def _run(self):
+      while True:
+        job, args = self._queue.get()
+        self._process(job, args)
+
+    def _process(self, job, args):
+      with self._condition:
+        job['status'] = 'mining'
+
+      try:
+        block = self._seal(*args)
+      except Exception as exception:
+        status, index, error = 'failed', None, str(exception)
+      else:
+        status, index, error = 'sealed', block['index'], None
+
+      with self._condition:
+        job['status'] = status
+        job['block'] = index
+        job['finished'] = time()
+        if error is not None:
+          job['error'] = error
+        self._unfinished -= 1
+
+        # Forget the oldest finished jobs
+        finished = [ticket for ticket, old in self._jobs.items() if old['finished'] is not None]
+        for ticket in finished[:max(0, len(finished) - self._history)]:
+          del self._jobs[ticket]
+
+        self._condition.notify_all()
+
+
+def make_miner(workers):
+  """
+  Build the miner for the given number of workers
+
+  :param workers: <int> Number of processes, 0 uses every core of the machine
+  :return: A miner
+  """
+
+  if workers == 1:
+    return SerialMiner()
+
+  return ProcessPoolMiner(workers or None)
@@ -0,0 +1,295 @@
+import cProfile
+import io
+import os
+import pstats
+import sys
+import threading
+from collections import Counter, OrderedDict
+from time import perf_counter, time
+from uuid import uuid4
+
+# Ways of profiling a request: every call with cProfile, or the stack of the request thread read at intervals
+MODES = ('cprofile', 'sample')
+
+# Seconds between two reads of the stack of a sampled request
+SAMPLE_INTERVAL = 0.005
+
+# Number of functions or stacks listed in a profile
+TOP = 30
+
+# Spans and functions of the request profiled by the current thread
+_local = threading.local()
+
+
+class _NoSpan:
+    """
+    Span of a thread that profiles nothing, shared by every with block
+    """
+
+    __slots__ = ()
+
+    def __enter__(self):
+      return self
+
+    def __exit__(self, *exc_info):
+      return False
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _Span:
+    __slots__ = ('_profile', '_name', '_start')
+
+    def __init__(self, profile, name):
+      self._profile = profile
+      self._name = name
+
+    def __enter__(self):
+      self._start = perf_counter()
+      return self
+
+    def __exit__(self, *exc_info):
+      self._profile.add_span(self._name, self._start, perf_counter(), exc_info[0] is not None)
+      return False
+
+
+def current():
+  """
+  :return: <Profile> The profile of the request handled by the current thread, None if it isn't profiled
+  """
+
+  return getattr(_local, 'profile', None)
+
+
+def span(name):
+  """
+  Time a part of the request in its profile
+
+  :param name: Name of the part. Eg. 'proof_of_work'
+  :return: A context manager, that does nothing when the request isn't profiled
+  """
+
+  profile = getattr(_local, 'profile', None)
+  if profile is None:
+    return _NO_SPAN
+  return _Span(profile, name)
+
+
+def bind(function):
+  """
+  Make the spans of a function run by another thread, eg. a thread pool, go to the profile of the current request
+
+  :param function: Function called by the other thread
+  :return: The function itself when the request isn't profiled
+  """
+
+  profile = current()
+  if profile is None:
+    return function
+
+  def bound(*args, **kwargs):
+    previous = current()
+    _local.profile = profile
+    try:
+      return function(*args, **kwargs)
+    finally:
+      _local.profile = previous
+
+  return bound
+
+
+def _frame_name(frame):
+  code = frame.f_code
+  return f'{os.path.basename(code.co_filename)}:{code.co_name}'
+
+
+class _Sampler:
+    """
+    Reads the stack of a thread at intervals, the stacks seen the most are where its time goes
+    """
+
+    def __init__(self, thread_id, interval):
+      self._thread_id = thread_id
+      self._interval = interval
+      self._stopped = threading.Event()
+      self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+      self.stacks = Counter()
+
+    def start(self):
+      self._thread.start()
+
+    def stop(self):
+      self._stopped.set()
+      self._thread.join()
+
+    def _run(self):
+      while not self._stopped.wait(self._interval):
+        frame = sys._current_frames().get(self._thread_id)
+        stack = []
+        while frame is not None:
+          stack.append(_frame_name(frame))
+          frame = frame.f_back
+        if stack:
+          self.stacks[';'.join(reversed(stack))] += 1
+
+
+class Profile:
+    """
+    Profile of a single request, with the time of its named spans
+    """
+
+    def __init__(self, method, path, mode='cprofile', interval=SAMPLE_INTERVAL):
+      """
+      :param method: HTTP method of the request
+      :param path: Path of the request, with its query
+      :param mode: One of MODES
+      :param interval: Seconds between two reads of the stack, when sampling
+      """
+
+      if mode not in MODES:
+        raise ValueError(f'Unknown profiling mode {mode}')
+
+      self.id = uuid4().hex
+      self.method = method
+      self.path = path
+      self.mode = mode
+      self.interval = interval
+      self.started = time()
+      self.duration = None
+      self.status = None
+      self.spans = []
+      self._start = None
+      self._profiler = None
+      self._sampler = None
+      self._stats = None
+      self._lock = threading.Lock()
+
+    def start(self):
+      """
+      Profile the current thread until stop is called by it
+      """
+
+      _local.profile = self
+      self._start = perf_counter()
+      if self.mode == 'cprofile':
+        self._profiler = cProfile.Profile()
+        self._profiler.enable()
+      else:
+        self._sampler = _Sampler(threading.get_ident(), self.interval)
+        self._sampler.start()
+
+    def stop(self, status):
+      """
+      :param status: <int> Status of the answer to the request
+      """
+
+      if self._profiler is not None:
+        self._profiler.disable()
+        self._stats = pstats.Stats(self._profiler)
+        self._profiler = None
+      if self._sampler is not None:
+        self._sampler.stop()
+      self.duration = perf_counter() - self._start
+      self.status = status
+      _local.profile = None
+
+    def add_span(self, name, start, end, failed=False):
+      with self._lock:
+        self.spans.append({
+          'name': name,
+          'thread': threading.current_thread().name,
+          'start': start - self._start,
+          'duration': end - start,
+          'failed': failed,
+        })
+
+    def summary(self):
+      """
+      :return: <dict> What the request was and how long it took
+      """
+
+      return {
+        'id': self.id,
+        'method': self.method,
+        'path': self.path,
+        'mode': self.mode,
+        'started': self.started,
+        'duration': self.duration,
+        'status': self.status,
+      }
+
+    def document(self, top=TOP):
+      """
+      :param top: <int> Number of functions or stacks listed
+      :return: <dict> The summary, the spans and where the time went
+      """
+
+      document = self.summary()
+      with self._lock:
+        document['spans'] = sorted(self.spans, key=lambda span: span['start'])
+
+      if self._stats is not None:
+        functions = sorted(self._stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:top]
+        document['functions'] = [{
+          'function': f'{os.path.basename(filename)}:{line}({name})',
+          'calls': calls,
+          'own': own,
+          'cumulative': cumulative,
+        } for (filename, line, name), (primitive, calls, own, cumulative, callers) in functions]
+
+      if self._sampler is not None:
+        document['samples'] = sum(self._sampler.stacks.values())
+        document['stacks'] = [{'stack': stack, 'samples': samples} for stack, samples in self._sampler.stacks.most_common(top)]
+
+      return document
+
+    def text(self, top=TOP):
+      """
+      :return: <str> The functions taking the most time, as printed by pstats, None when the request was sampled
+      """
+
+      if self._stats is None:
+        return None
+      output = io.StringIO()
+      pstats.Stats(stream=output).add(self._stats).sort_stats('cumulative').print_stats(top)
+      return output.getvalue()
+
+    def folded(self):
+      """
+      :return: <str> One line per stack seen and its number of samples, the input of flame graph tools, None when cProfile was used
+      """
+
+      if self._sampler is None:
+        return None
+      return ''.join(f'{stack} {samples}\n' for stack, samples in self._sampler.stacks.items())
+
+
+class Profiles:
+    """
+    Ring buffer of the last profiles taken
+    """
+
+    def __init__(self, size=50):
+      self.size = size
+      self._profiles = OrderedDict()
+      self._lock = threading.Lock()
+
+    def add(self, profile):
+      with self._lock:
+        self._profiles[profile.id] = profile
+        while len(self._profiles) > self.size:
+          self._profiles.popitem(last=False)
+
+    def get(self, profile_id):
+      with self._lock:
+        return self._profiles.get(profile_id)
+
+    def summaries(self):
+      """
+      :return: <list> Summary of every profile kept, the last taken first
+      """
+
+      with self._lock:
+        profiles = list(self._profiles.values())
+      return [profile.summary() for profile in reversed(profiles)]
@@ -0,0 +1,166 @@
+import sys
+
+# Statuses of a transaction, held in the records as their position in this tuple
+STATUSES = ('pending', 'accepted', 'rejected')
+PENDING, ACCEPTED, REJECTED = range(len(STATUSES))
+
+_CODES = {name: code for code, name in enumerate(STATUSES)}
+
+# Keys of a transaction and of a block, in the order of the slots of their records
+TRANSACTION_KEYS = ('id', 'index', 'doer', 'task', 'duration', 'status', 'reviewer', 'timestamp')
+BLOCK_KEYS = ('index', 'timestamp', 'transactions', 'merkle_root', 'proof', 'difficulty', 'mining_started', 'previous_hash')
+
+
+def status_code(status):
+  """
+  :param status: Status as sent by the client or read from a block. Eg. 'accepted'
+  :return: The small int of the status, the status itself if it isn't a known one
+  """
+
+  return _CODES.get(status, status) if type(status) is str else status
+
+
+def status_name(status):
+  """
+  :param status: Status as held in a record
+  :return: The status as sent by the API. Eg. 'accepted'
+  """
+
+  return STATUSES[status] if type(status) is int else status
+
+
+def intern(value):
+  """
+  :param value: identificator of a person, as sent by the client
+  :return: The same string shared by every record of the person
+  """
+
+  return sys.intern(value) if type(value) is str else value
+
+
+def _extra(document, keys, values):
+  """
+  :return: <dict> The members of the document a record can't hold in its slots, None if there are none
+
+  They are the members of unknown keys, the members set to null and the
+  statuses that aren't strings, kept so that the document is written back
+  exactly as it was read.
+  """
+
+  if len(document) == len(values) - values.count(None):
+    return None
+  return {key: value for key, value in document.items() if key not in keys or values[keys.index(key)] is None} or None
+
+
+class Transaction:
+    """
+    A chore, as held in memory
+
+    People are interned strings, shared by all the records of the same
+    person, and the status a small int. from_dict and to_dict give back
+    the exact JSON shape read, so the API and the hashes don't change.
+    A missing key is None in the record.
+    """
+
+    __slots__ = TRANSACTION_KEYS + ('extra',)
+
+    def __init__(self, id=None, index=None, doer=None, task=None, duration=None, status=PENDING, reviewer=None, timestamp=None, extra=None):
+      self.id = id
+      self.index = index
+      self.doer = intern(doer)
+      self.task = task
+      self.duration = duration
+      self.status = status_code(status)
+      self.reviewer = intern(reviewer)
+      self.timestamp = timestamp
+      self.extra = extra
+
+    @classmethod
+    def from_dict(cls, transaction):
+      """
+      :param transaction: <dict> Transaction as sent by the API
+      :return: <Transaction>
+      """
+
+      get = transaction.get
+      status = get('status')
+      if status is not None and type(status) is not str:
+        # Left to the extra members, an int would read as a known status
+        status = None
+      values = (get('id'), get('index'), get('doer'), get('task'), get('duration'), status, get('reviewer'), get('timestamp'))
+      return cls(*values, extra=_extra(transaction, TRANSACTION_KEYS, values))
+
+    def to_dict(self):
+      """
+      :return: <dict> The transaction as sent by the API
+      """
+
+      status = self.status
+      values = (
+        self.id, self.index, self.doer, self.task, self.duration,
+        STATUSES[status] if type(status) is int else status,
+        self.reviewer, self.timestamp,
+      )
+      if None in values:
+        transaction = {key: value for key, value in zip(TRANSACTION_KEYS, values) if value is not None}
+      else:
+        transaction = dict(zip(TRANSACTION_KEYS, values))
+      if self.extra:
+        transaction.update(self.extra)
+      return transaction
+
+
+def transactions_from(transactions):
+  """
+  :param transactions: <list> Transactions as sent by the API, or their records
+  :return: <tuple> The records of the transactions
+  """
+
+  return tuple(transaction if type(transaction) is Transaction else Transaction.from_dict(transaction) for transaction in transactions)
+
+
+class Block:
+    """
+    A block, as held in memory, with its transactions as Transaction records
+
+    Like the transactions, from_dict and to_dict keep the exact JSON shape.
+    A header without its transactions has None as transactions.
+    """
+
+    __slots__ = BLOCK_KEYS + ('extra',)
+
+    def __init__(self, index=None, timestamp=None, transactions=None, merkle_root=None, proof=None, difficulty=None, mining_started=None, previous_hash=None, extra=None):
+      self.index = index
+      self.timestamp = timestamp
+      self.transactions = None if transactions is None else transactions_from(transactions)
+      self.merkle_root = merkle_root
+      self.proof = proof
+      self.difficulty = difficulty
+      self.mining_started = mining_started
+      self.previous_hash = previous_hash
+      self.extra = extra
+
+    @classmethod
+    def from_dict(cls, block):
+      """
+      :param block: <dict> Block as sent by the API
+      :return: <Block>
+      """
+
+      get = block.get
+      values = (get('index'), get('timestamp'), get('transactions'), get('merkle_root'), get('proof'), get('difficulty'), get('mining_started'), get('previous_hash'))
+      return cls(*values, extra=_extra(block, BLOCK_KEYS, values))
+
+    def to_dict(self):
+      """
+      :return: <dict> The block as sent by the API, hashed and stored
+      """
+
+      transactions = self.transactions
+      if transactions is not None:
+        transactions = [transaction.to_dict() for transaction in transactions]
+      values = (self.index, self.timestamp, transactions, self.merkle_root, self.proof, self.difficulty, self.mining_started, self.previous_hash)
+      block = {key: value for key, value in zip(BLOCK_KEYS, values) if value is not None}
+      if self.extra:
+        block.update(self.extra)
+      return block
@@ -0,0 +1,161 @@
+from . import encoding
+from . import records
+
+# Names of the sealing policies, see make_policy
+POLICIES = ('reviewed', 'count', 'bytes', 'timer')
+
+
+def size(transaction):
+  """
+  :param transaction: <Transaction> Record of a transaction
+  :return: <int> Number of bytes the transaction takes in a Block
+  """
+
+  return len(encoding.canonical(transaction.to_dict()))
+
+
+class FullReview:
+    """
+    Seal the whole list of current transactions once every one of them is accepted or rejected
+
+    It is how the node always sealed its Blocks: a single transaction left
+    unreviewed holds the list open, however long it grows.
+    """
+
+    # Seconds between two checks made without any change to the transactions, None for no check
+    interval = None
+
+    def select(self, pool, now):
+      """
+      :param pool: <Mempool> The current transactions
+      :param now: <float> Current time
+      :return: <list> The records of the transactions to hand over to the miner, None if it isn't time yet
+      """
+
+      if pool and pool.reviewed():
+        return list(pool)
+      return None
+
+    def sealed(self, now):
+      """
+      Tell the policy that transactions were handed over to the miner, by our node or by another one
+
+      :param now: <float> Current time
+      """
+
+    def wait(self, now):
+      """
+      :return: <float> Seconds until the next check made without any change to the transactions
+      """
+
+      return self.interval
+
+
+class Threshold(FullReview):
+    """
+    Seal the reviewed transactions, oldest first, as soon as they fill a Block
+
+    A Block holds at most max_count transactions and max_bytes bytes of
+    transactions, the transactions not reviewed yet stay for the next one.
+    A list reviewed in full is sealed at once, in as many Blocks as needed.
+    """
+
+    def __init__(self, max_count=None, max_bytes=None):
+      """
+      :param max_count: <int> Most transactions in a Block, None for no bound
+      :param max_bytes: <int> Most bytes of transactions in a Block, None for no bound
+      """
+
+      self.max_count = max_count
+      self.max_bytes = max_bytes
+
+    def fill(self, transactions, complete=False):
+      """
+      :param transactions: <list> Records of reviewed transactions, oldest first
+      :param complete: True to seal them even if they don't fill a Block
+      :return: <list> The ones going into the next Block, None if they don't fill it
+      """
+
+      count = len(transactions) if self.max_count is None else min(len(transactions), self.max_count)
+      filled = count == self.max_count
+
+      if self.max_bytes is not None:
+        total = 0
+        for position in range(count):
+          total += size(transactions[position])
+          if total >= self.max_bytes:
+            # A transaction larger than a whole Block goes alone
+            count = position + 1 if total == self.max_bytes or position == 0 else position
+            filled = True
+            break
+
+      if filled or complete:
+        return transactions[:count]
+      return None
+
+    def select(self, pool, now):
+      if not pool:
+        return None
+
+      # The count comes from the index of the list, the reviewed transactions are only listed when they may fill a Block
+      reviewed = pool.count_status(records.ACCEPTED) + pool.count_status(records.REJECTED)
+      if reviewed < len(pool) and self.max_bytes is None and (self.max_count is None or reviewed < self.max_count):
+        return None
+
+      return self.fill(pool.reviewed_transactions(), complete=reviewed == len(pool))
+
+
+class Timer(Threshold):
+    """
+    Seal the reviewed transactions interval seconds after the last transactions were sealed
+
+    Like with Threshold, a list reviewed in full is sealed at once and the
+    reviewed transactions are sealed early when they fill a Block, if
+    max_count or max_bytes are given. The timer starts again when it is
+    over with nothing reviewed.
+    """
+
+    def __init__(self, interval, max_count=None, max_bytes=None, now=0.0):
+      """
+      :param interval: <float> Longest time in seconds a reviewed transaction waits for its Block
+      :param now: <float> Time the timer starts from
+      """
+
+      super().__init__(max_count, max_bytes)
+      self.interval = interval
+      self.last_sealed = now
+
+    def select(self, pool, now):
+      selected = super().select(pool, now)
+      if selected is None and now - self.last_sealed >= self.interval:
+        selected = self.fill(pool.reviewed_transactions(), complete=True) or None
+        if selected is None:
+          self.last_sealed = now
+      return selected
+
+    def sealed(self, now):
+      self.last_sealed = now
+
+    def wait(self, now):
+      return max(self.last_sealed + self.interval - now, 0.0)
+
+
+def make_policy(name, max_count=None, max_bytes=None, interval=None, now=0.0):
+  """
+  Build the sealing policy of the given name
+
+  :param name: One of POLICIES: 'reviewed' seals once every transaction is reviewed, 'count' and 'bytes' once the
+               reviewed ones fill a Block of max_count transactions or max_bytes bytes, 'timer' every interval seconds
+  :param now: <float> Time the timer starts from
+  :return: A sealing policy
+  """
+
+  if name == 'reviewed':
+    return FullReview()
+  if name == 'count':
+    return Threshold(max_count=max_count)
+  if name == 'bytes':
+    return Threshold(max_bytes=max_bytes)
+  if name == 'timer':
+    return Timer(interval, now=now)
+  raise ValueError(f'Unknown sealing policy {name}')
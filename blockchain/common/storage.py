@@ -0,0 +1,726 @@
+import json
+import mmap
+import os
+import struct
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+from uuid import uuid4
+
+from . import encoding
+from . import records
+
+# Processes sharing a data directory lock it with flock, where the OS has it
+try:
+  import fcntl
+except ImportError:
+  fcntl = None
+
+# Every entry of the index is the offset, the length and the SHA-256 hash of a block in the log,
+# the entry of block n sits at n * size
+INDEX_ENTRY = struct.Struct('<QI32s')
+
+# The log is fsynced after this many blocks, or FSYNC_INTERVAL seconds after the first unsynced block
+FSYNC_BATCH = 16
+FSYNC_INTERVAL = 1.0
+
+# Number of decoded blocks kept in memory
+CACHE_SIZE = 256
+
+# The pending transactions are saved whole once their journal holds this many changes
+JOURNAL_LIMIT = 1024
+
+
+class DataLock:
+    """
+    Lock of the state of a node, taken by every change to it
+
+    Threads of a process take a re-entrant lock. When a data directory is
+    given, and the OS has flock, the processes sharing the directory, like
+    the workers of a WSGI server, also take an exclusive lock on a file of
+    it, so a single thread of a single process changes the data at a time.
+    """
+
+    def __init__(self, directory=None):
+      """
+      :param directory: Data directory shared with other processes, None if the process is alone
+      """
+
+      self._lock = threading.RLock()
+      self._file = None
+      # Number of times the owner thread took the lock
+      self.depth = 0
+      if directory is not None and fcntl is not None:
+        os.makedirs(directory, exist_ok=True)
+        self._file = open(os.path.join(directory, 'lock'), 'a+b')
+
+    @property
+    def shared(self):
+      """
+      True when other processes may change the data as well
+      """
+
+      return self._file is not None
+
+    def __enter__(self):
+      self._lock.acquire()
+      self.depth += 1
+      if self.depth == 1 and self._file is not None:
+        try:
+          fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        except BaseException:
+          self.depth -= 1
+          self._lock.release()
+          raise
+      return self
+
+    def __exit__(self, *exc_info):
+      self.depth -= 1
+      if self.depth == 0 and self._file is not None:
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+      self._lock.release()
+      return False
+
+
+class ChainChanged(LookupError):
+    """
+    The blocks of a snapshot were dropped from the chain while it was read
+    """
+
+
+class DataInUse(RuntimeError):
+    """
+    The chain log is written by another process that doesn't share it
+    """
+
+
+class ChainSnapshot:
+    """
+    The chain as it was when the snapshot was taken, read without taking the lock of the node
+
+    Blocks are only appended to a chain, except when a fork replaces its
+    end, which bumps its generation before any block is dropped and again
+    once they are, so that a snapshot taken meanwhile isn't taken for one
+    of the new chain. Reads go to
+    the chain itself and the generation is checked after every read, so a
+    read that may have seen a block of the new chain raises ChainChanged
+    instead of mixing the two chains. So does a read of a block dropped
+    meanwhile, which the chain can't find anymore.
+    """
+
+    def __init__(self, chain):
+      """
+      :param chain: <MemoryChain>, <ChainLog> or <HeaderChain>
+      """
+
+      self._chain = chain
+      while True:
+        self.generation = chain.generation
+        self.length = len(chain)
+        try:
+          self.tip = chain.hash(self.length - 1) if self.length else None
+        except (IndexError, struct.error):
+          # The last block was dropped meanwhile, the generation tells
+          if chain.generation == self.generation:
+            raise
+          continue
+        if chain.generation == self.generation:
+          break
+
+    def __len__(self):
+      return self.length
+
+    def _read(self, read, height):
+      if height < 0:
+        height += self.length
+      if not 0 <= height < self.length:
+        raise IndexError('block index out of range')
+
+      try:
+        value = read(height)
+      except (IndexError, struct.error) as error:
+        # The entry or the bytes of the block went with the end of the chain
+        if self._chain.generation != self.generation:
+          raise ChainChanged('The chain was replaced while it was read') from error
+        raise
+      if self._chain.generation != self.generation:
+        raise ChainChanged('The chain was replaced while it was read')
+      return value
+
+    def hash(self, height):
+      return self._read(self._chain.hash, height)
+
+    def header(self, height):
+      return self._read(self._chain.header, height)
+
+    def raw(self, height):
+      return self._read(self._chain.raw, height)
+
+    def __getitem__(self, height):
+      if isinstance(height, slice):
+        return [self[i] for i in range(*height.indices(self.length))]
+      return self._read(self._chain.__getitem__, height)
+
+    def __iter__(self):
+      return (self[height] for height in range(self.length))
+
+
+class MemoryChain(Sequence):
+    """
+    Chain kept in memory only, with the hash and the canonical bytes of every block next to it
+
+    Blocks are held as Block records and read back as dicts, a new one on
+    every read, like the blocks decoded by ChainLog.
+    """
+
+    def __init__(self, blocks=(), hashes=None):
+      self._blocks = []
+      self._hashes = []
+      self._encoded = []
+      # Bumped whenever blocks are dropped, see ChainSnapshot
+      self.generation = 0
+      self.extend(blocks, hashes)
+
+    def snapshot(self):
+      """
+      :return: <ChainSnapshot> The chain as it is now
+      """
+
+      return ChainSnapshot(self)
+
+    def __len__(self):
+      return len(self._blocks)
+
+    def __getitem__(self, height):
+      if isinstance(height, slice):
+        return [block.to_dict() for block in self._blocks[height]]
+      return self._blocks[height].to_dict()
+
+    def hash(self, height):
+      """
+      :param height: <int> Position of the block in the chain
+      :return: <str> The hash of the block
+      """
+
+      return self._hashes[height]
+
+    def header(self, height):
+      """
+      :param height: <int> Position of the block in the chain
+      :return: <dict> The part of the block covered by its hash
+      """
+
+      return encoding.hashed(self[height])
+
+    def raw(self, height):
+      """
+      :param height: <int> Position of the block in the chain
+      :return: <bytes> The canonical bytes of the block
+      """
+
+      return self._encoded[height]
+
+    def append(self, block, block_hash=None):
+      data = encoding.canonical(block)
+      record = records.Block.from_dict(block)
+      # The length is read from the blocks without the lock, see ChainSnapshot, the block is only
+      # counted once its hash and its bytes can be read
+      self._encoded.append(data)
+      self._hashes.append(block_hash or encoding.block_hash(block, data))
+      self._blocks.append(record)
+
+    def extend(self, blocks, hashes=None):
+      for position, block in enumerate(blocks):
+        self.append(block, hashes[position] if hashes else None)
+
+    def truncate(self, height):
+      if height >= len(self):
+        return
+      self.generation += 1
+      del self._blocks[height:]
+      del self._hashes[height:]
+      del self._encoded[height:]
+      self.generation += 1
+
+    def replace(self, blocks, start=0, hashes=None):
+      """
+      Replace the chain from the given height on
+
+      :param blocks: A valid blockchain, or the part of it starting at the given height
+      :param start: <int> Height of the first of the given blocks
+      :param hashes: <list> Hash of every given block, computed again if not given
+      """
+
+      self.truncate(start)
+      self.extend(blocks, hashes)
+
+
+class ChainLog(Sequence):
+    """
+    Append-only log of blocks on disk that behaves like the chain list
+
+    The blocks are stored one JSON document per line in chain.log, and
+    chain.idx holds the position and the hash of every block in the log.
+    Opening the log only reads the index; the log itself is memory-mapped and
+    a block is only decoded when it is accessed.
+
+    A log shared with other processes is read with pread instead, a mapping
+    would crash the process if another one truncated the file, and refresh
+    picks up the blocks they appended.
+    """
+
+    def __init__(self, directory, shared=False):
+      """
+      :param directory: Directory of the log
+      :param shared: True if other processes write to the log as well
+      """
+
+      os.makedirs(directory, exist_ok=True)
+      self.shared = shared
+      # Bumped whenever blocks are dropped, see ChainSnapshot
+      self.generation = 0
+      self._lock = threading.RLock()
+      self._log = open(os.path.join(directory, 'chain.log'), 'a+b')
+      self._index = open(os.path.join(directory, 'chain.idx'), 'a+b')
+      if fcntl is not None:
+        # Processes sharing the log lock the index together, any other one must have it to itself,
+        # a second node started on the directory by mistake would write over the blocks of the first one
+        try:
+          fcntl.flock(self._index.fileno(), (fcntl.LOCK_SH if shared else fcntl.LOCK_EX) | fcntl.LOCK_NB)
+        except BlockingIOError:
+          self._log.close()
+          self._index.close()
+          raise DataInUse(f'The chain log of {directory} is used by another process')
+      self._map = None
+      self._cache = OrderedDict()
+      self._unsynced = 0
+      self._sync_timer = None
+
+      self._index.seek(0)
+      self._entries = bytearray(self._index.read())
+      self._recover()
+
+    def _recover(self):
+      """
+      Bring the index and the log back in step after a crash in the middle of an append
+      """
+
+      log_size = os.fstat(self._log.fileno()).st_size
+      indexed = len(self._entries)
+
+      # Drop a half written index entry and the entries of blocks missing from the log
+      height = len(self._entries) // INDEX_ENTRY.size
+      while height > 0:
+        offset, length, _ = self._entry(height - 1)
+        if offset + length + 1 <= log_size:
+          break
+        height -= 1
+      del self._entries[height * INDEX_ENTRY.size:]
+
+      end = 0
+      if height > 0:
+        offset, length, _ = self._entry(height - 1)
+        end = offset + length + 1
+
+      # Index the complete blocks written to the log but not to the index, and drop a half written block
+      if end < log_size:
+        self._log.seek(end)
+        for line in self._log.read().splitlines(keepends=True):
+          if not line.endswith(b'\n'):
+            break
+          digest = bytes.fromhex(encoding.block_hash(encoding.loads(line[:-1]), line[:-1]))
+          self._entries += INDEX_ENTRY.pack(end, len(line) - 1, digest)
+          end += len(line)
+        self._log.truncate(end)
+
+      if len(self._entries) != indexed:
+        self._index.truncate(0)
+        self._index.write(self._entries)
+        self._index.flush()
+
+    def _entry(self, height):
+      return INDEX_ENTRY.unpack_from(self._entries, height * INDEX_ENTRY.size)
+
+    def changed(self):
+      """
+      :return: <bool> True if another process added or dropped blocks since the log was last read
+      """
+
+      return os.fstat(self._index.fileno()).st_size != len(self._entries)
+
+    def refresh(self):
+      """
+      Read the entries written to the index by the other processes sharing the log
+
+      The index is read from our last entry on when it is still there,
+      and whole when another process rewrote the end of the log.
+
+      :return: <bool> True if the chain changed
+      """
+
+      with self._lock:
+        size = os.fstat(self._index.fileno()).st_size
+        size -= size % INDEX_ENTRY.size
+        known = len(self._entries)
+        if size == known:
+          return False
+
+        last = known - INDEX_ENTRY.size
+        if last >= 0 and size > known and os.pread(self._index.fileno(), INDEX_ENTRY.size, last) == self._entries[last:]:
+          self._entries += os.pread(self._index.fileno(), size - known, known)
+          return True
+
+        self.generation += 1
+        self._cache.clear()
+        if self._map is not None:
+          self._map.close()
+          self._map = None
+        self._entries = bytearray(os.pread(self._index.fileno(), size, 0))
+        self.generation += 1
+        return True
+
+    def snapshot(self):
+      """
+      :return: <ChainSnapshot> The chain as it is now
+      """
+
+      return ChainSnapshot(self)
+
+    def hash(self, height):
+      """
+      :param height: <int> Position of the block in the chain
+      :return: <str> The hash of the block
+      """
+
+      if height < 0:
+        height += len(self)
+      return self._entry(height)[2].hex()
+
+    def header(self, height):
+      """
+      :param height: <int> Position of the block in the chain
+      :return: <dict> The part of the block covered by its hash
+      """
+
+      return encoding.hashed(self[height])
+
+    def __len__(self):
+      return len(self._entries) // INDEX_ENTRY.size
+
+    def __getitem__(self, height):
+      if isinstance(height, slice):
+        return [self[i] for i in range(*height.indices(len(self)))]
+
+      with self._lock:
+        if height < 0:
+          height += len(self)
+        if not 0 <= height < len(self):
+          raise IndexError('block index out of range')
+
+        block = self._cache.get(height)
+        if block is not None:
+          self._cache.move_to_end(height)
+          return block
+
+        block = encoding.loads(self.raw(height))
+        self._remember(height, block)
+        return block
+
+    def raw(self, height):
+      """
+      :param height: <int> Position of the block in the chain
+      :return: <bytes> The canonical bytes of the block, as stored in the log
+      """
+
+      with self._lock:
+        if height < 0:
+          height += len(self)
+        if not 0 <= height < len(self):
+          raise IndexError('block index out of range')
+
+        offset, length, _ = self._entry(height)
+        if self.shared:
+          return os.pread(self._log.fileno(), length, offset)
+        if self._map is None or offset + length > len(self._map):
+          # The block was appended after the log was mapped
+          self._map = mmap.mmap(self._log.fileno(), 0, access=mmap.ACCESS_READ)
+
+        return self._map[offset:offset + length]
+
+    def _remember(self, height, block):
+      self._cache[height] = block
+      self._cache.move_to_end(height)
+      while len(self._cache) > CACHE_SIZE:
+        self._cache.popitem(last=False)
+
+    def append(self, block, block_hash=None):
+      """
+      Add a block at the end of the log
+
+      :param block: <dict> Block
+      :param block_hash: <str> Hash of the block, computed if not given
+      """
+
+      data = encoding.canonical(block)
+      digest = bytes.fromhex(block_hash or encoding.block_hash(block, data))
+
+      with self._lock:
+        offset = os.fstat(self._log.fileno()).st_size
+        self._log.write(data + b'\n')
+        self._log.flush()
+
+        entry = INDEX_ENTRY.pack(offset, len(data), digest)
+        self._index.write(entry)
+        self._index.flush()
+        self._entries += entry
+
+        self._remember(len(self) - 1, block)
+        self._synced_later()
+
+    def extend(self, blocks, hashes=None):
+      for position, block in enumerate(blocks):
+        self.append(block, hashes[position] if hashes else None)
+
+    def truncate(self, height):
+      """
+      Drop every block from the given height on
+
+      :param height: <int> Number of blocks to keep
+      """
+
+      with self._lock:
+        if height >= len(self):
+          return
+
+        offset = self._entry(height)[0]
+        self.generation += 1
+
+        # Truncating a file that is still mapped would make reads past the end crash the process
+        if self._map is not None:
+          self._map.close()
+          self._map = None
+
+        self._log.truncate(offset)
+        del self._entries[height * INDEX_ENTRY.size:]
+        self._index.truncate(len(self._entries))
+
+        for cached in [cached for cached in self._cache if cached >= height]:
+          del self._cache[cached]
+        self.generation += 1
+
+        self.sync()
+
+    def replace(self, blocks, start=0, hashes=None):
+      """
+      Replace the stored chain with the given one, only rewriting the blocks after the common prefix
+
+      Blocks are chained by their hashes, so once two chains hold the same
+      block at some height they share everything before it as well, and the
+      fork point can be found with a binary search.
+
+      :param blocks: A valid blockchain, or the part of it starting at the given height
+      :param start: <int> Height of the first of the given blocks
+      :param hashes: <list> Hash of every given block, computed again if not given
+      """
+
+      with self._lock:
+        low, high = start, min(len(self), start + len(blocks))
+        while low < high:
+          middle = (low + high) // 2
+          if hashes:
+            same = self.hash(middle) == hashes[middle - start]
+          else:
+            same = self[middle] == blocks[middle - start]
+          if same:
+            low = middle + 1
+          else:
+            high = middle
+
+        self.truncate(low)
+        self.extend(blocks[low - start:], hashes[low - start:] if hashes else None)
+
+    def sync(self):
+      """
+      Force the blocks written so far to disk
+      """
+
+      with self._lock:
+        if self._sync_timer is not None:
+          self._sync_timer.cancel()
+          self._sync_timer = None
+        os.fsync(self._log.fileno())
+        os.fsync(self._index.fileno())
+        self._unsynced = 0
+
+    def _synced_later(self):
+      self._unsynced += 1
+      if self._unsynced >= FSYNC_BATCH:
+        self.sync()
+      elif self._sync_timer is None:
+        self._sync_timer = threading.Timer(FSYNC_INTERVAL, self.sync)
+        self._sync_timer.daemon = True
+        self._sync_timer.start()
+
+    def close(self):
+      with self._lock:
+        self.sync()
+        if self._map is not None:
+          self._map.close()
+          self._map = None
+        self._log.close()
+        self._index.close()
+
+
+class PendingSnapshot:
+    """
+    Transactions not in the chain yet, as a snapshot replaced atomically and a journal of the changes made since
+
+    Every change is a JSON line appended to the journal and fsynced, so that
+    adding or reviewing a transaction doesn't write the whole list again. A
+    line names the snapshot it follows, loading only replays the lines of
+    the current snapshot on it: a crash between writing a new snapshot and
+    emptying the journal can't apply a change twice. The changes are the
+    ones of the list kept in memory, see replay; the transactions are named
+    by their position in it.
+    """
+
+    def __init__(self, directory):
+      os.makedirs(directory, exist_ok=True)
+      self._directory = directory
+      self._path = os.path.join(directory, 'pending.json')
+      self._journal_path = os.path.join(directory, 'pending.log')
+      self._lock = threading.Lock()
+      self._journal = open(self._journal_path, 'ab')
+      # Snapshot the journal follows, and number of its lines, as last loaded or saved by this process
+      self._generation = None
+      self._records = 0
+      # Files last loaded or saved by this process
+      self._stat = None
+
+    def _current_stat(self):
+      stats = []
+      for path in (self._path, self._journal_path):
+        try:
+          stat = os.stat(path)
+        except FileNotFoundError:
+          stats.append(None)
+        else:
+          stats.append((stat.st_ino, stat.st_size, stat.st_mtime_ns))
+      return tuple(stats)
+
+    def changed(self):
+      """
+      :return: <bool> True if another process saved a snapshot or a change since this one last loaded or saved them
+      """
+
+      return self._current_stat() != self._stat
+
+    def load(self):
+      """
+      :return: <dict> The last saved snapshot with the changes of the journal replayed on it, an empty one if there is none
+      """
+
+      with self._lock:
+        self._stat = self._current_stat()
+        try:
+          with open(self._path, 'rb') as snapshot:
+            pending = json.load(snapshot)
+        except FileNotFoundError:
+          pending = {'transactions': [], 'sealing': []}
+        self._generation = pending.pop('generation', None)
+        self._records = 0
+
+        with open(self._journal_path, 'rb') as journal:
+          for line in journal:
+            try:
+              change = json.loads(line)
+            except ValueError:
+              # The last line may have been cut by a crash, before its change was answered, the list is then saved whole
+              self._records = JOURNAL_LIMIT
+              break
+            if change.pop('generation', None) == self._generation:
+              self.replay(pending, change)
+              self._records += 1
+        return pending
+
+    @staticmethod
+    def replay(pending, change):
+      """
+      Make a change of the journal on the transactions
+
+      :param pending: <dict> Transactions waiting for review and transactions waiting to be mined
+      :param change: <dict> 'add' a transaction, change the 'status' of the one at a position, 'seal' the ones at some
+                     positions into a new list waiting to be mined, 'drop' them, or drop the lists 'mined' at some positions
+      """
+
+      kind = change['change']
+      if kind == 'add':
+        pending['transactions'].append(change['transaction'])
+      elif kind == 'status':
+        transaction = pending['transactions'][change['position']]
+        transaction['status'] = change['status']
+        transaction['reviewer'] = change['reviewer']
+      elif kind == 'seal' or kind == 'drop':
+        positions = set(change['positions'])
+        if kind == 'seal':
+          pending['sealing'].append([pending['transactions'][position] for position in change['positions']])
+        pending['transactions'] = [transaction for position, transaction in enumerate(pending['transactions']) if position not in positions]
+      elif kind == 'mined':
+        positions = set(change['positions'])
+        pending['sealing'] = [transactions for position, transactions in enumerate(pending['sealing']) if position not in positions]
+
+    def record(self, changes):
+      """
+      Append changes to the journal, the last saved snapshot with the changes recorded since must be the list in memory
+
+      :param changes: <list> Changes made to the list since it was last saved, see replay
+      :return: <bool> False if the journal is full, or follows a snapshot of another process, and the whole list must be saved instead
+      """
+
+      with self._lock:
+        if self._stat != self._current_stat() or self._records + len(changes) > JOURNAL_LIMIT:
+          return False
+        if changes:
+          self._journal.write(b''.join(json.dumps(dict(change, generation=self._generation)).encode() + b'\n' for change in changes))
+          self._journal.flush()
+          os.fsync(self._journal.fileno())
+          self._records += len(changes)
+          self._stat = self._current_stat()
+        return True
+
+    def save(self, pending):
+      """
+      :param pending: <dict> Transactions waiting for review and transactions waiting to be mined
+      """
+
+      generation = uuid4().hex
+      data = json.dumps(dict(pending, generation=generation)).encode()
+
+      with self._lock:
+        # The new snapshot is on disk before it replaces the old one, and the directory entry pointing to it after
+        temporary = f'{self._path}.tmp'
+        with open(temporary, 'wb') as snapshot:
+          snapshot.write(data)
+          snapshot.flush()
+          os.fsync(snapshot.fileno())
+        os.replace(temporary, self._path)
+        self._sync_directory()
+
+        # The lines of the journal followed the old snapshot, they are not replayed anymore
+        self._journal.truncate(0)
+        self._generation = generation
+        self._records = 0
+        self._stat = self._current_stat()
+
+    def _sync_directory(self):
+      if not hasattr(os, 'O_DIRECTORY'):
+        return
+      directory = os.open(self._directory, os.O_RDONLY | os.O_DIRECTORY)
+      try:
+        os.fsync(directory)
+      finally:
+        os.close(directory)
+
+    def close(self):
+      with self._lock:
+        self._journal.close()
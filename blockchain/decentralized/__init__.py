@@ -0,0 +1,7 @@
+"""
+The decentralized node, one of a network of nodes agreeing on the chain of chores
+
+Run it from the blockchain directory, so that the common package is found:
+
+    python -m decentralized.blockchain -p 5001
+"""
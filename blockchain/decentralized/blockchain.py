@@ -1,55 +1,269 @@
-import hashlib
-import json
-from time import time
+import os
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from random import random
+from time import monotonic, perf_counter, sleep, time
 from urllib.parse import urlparse
 from uuid import uuid4
 
-import requests
-from flask import Flask, jsonify, request
+from flask import Flask, Response, g, jsonify, request
+from werkzeug.local import LocalProxy
+
+from common import encoding, events, ledger, mempool, merkle, metrics, mining, profiling, records, sealing, storage
+
+from . import broadcast, gossip, headers, membership
 
 HOST = "127.0.0.1"
 PORT = "5000"
 REWARD = 0.25
+# Number of processes used to mine a block, 0 uses every core of the machine
+MINER_WORKERS = 1
+# Target time in seconds spent finding the proof of a block
+BLOCK_INTERVAL = 5
+# Number of recent blocks looked at when adjusting the difficulty
+RETARGET_WINDOW = 10
+# Bounds of the number of leading hex zeroes required in a proof
+MIN_DIFFICULTY = 1
+MAX_DIFFICULTY = 8
+# Mine the blocks in a background thread instead of inside the review request
+BACKGROUND_MINING = True
+# Longest time in seconds a /mining/status request can wait for a block
+MINING_STATUS_MAX_WAIT = 30
+# When the reviewed transactions are handed over to the miner, the ones not reviewed yet staying for the next Block:
+# 'reviewed' once every transaction is reviewed, 'count' and 'bytes' once the reviewed ones fill a Block,
+# 'timer' at most SEAL_INTERVAL seconds after a transaction is reviewed
+SEALING_POLICY = 'reviewed'
+# Most transactions, and bytes of transactions, in a Block sealed by the count and bytes policies
+SEAL_MAX_TRANSACTIONS = 100
+SEAL_MAX_BYTES = 64 * 1024
+# Seconds between two Blocks sealed by the timer policy, a seal gossiped by another node starts the timer again
+SEAL_INTERVAL = 60
 MASTER_NODE = "127.0.0.1:5000"
+# Directory where the chain and the pending transactions are kept, None to keep them in memory only
+DATA_DIR = f"data/{PORT}"
+# Transactions in a page of the history of a person, by default and at most
+HISTORY_PAGE = 50
+HISTORY_MAX_PAGE = 500
+# Largest page of /chain and /transactions, when a limit is given
+PAGE_MAX_LIMIT = 1000
+# Most transactions and reviews sent at once to /transactions/batch
+BATCH_MAX_ITEMS = 1000
+# Number of recent events kept for the clients of /events coming back after a disconnection
+EVENTS_HISTORY = 1000
+# Seconds between two comments keeping an idle /events stream open
+EVENTS_KEEPALIVE = 15
+# Longest time in seconds a long-poll on /events is held
+EVENTS_MAX_WAIT = 30
+# Record the measures served on /metrics, while disabled recording costs close to nothing
+METRICS = True
+# Profile the requests asking for it with an X-Profile header or a ?profile= flag, cprofile or sample. Off unless
+# started with --profiling: anyone reaching the node could slow it down with profiled requests and read their stacks
+PROFILING = False
+# Share of the other requests profiled by sampling their stack, 0 to profile none
+PROFILE_SAMPLE_RATE = 0.0
+# Number of recent profiles kept for /debug/profiles
+PROFILE_HISTORY = 50
+
+metrics.registry.enabled = METRICS
+
+# Measures of the hot paths of the node
+MINING_SECONDS = metrics.registry.histogram('chores_mining_seconds', 'Seconds spent finding the proof of a block')
+MINING_NONCES = metrics.registry.histogram('chores_mining_nonces', 'Nonces tried to find the proof of a block', buckets=metrics.NONCE_BUCKETS)
+REQUEST_SECONDS = metrics.registry.histogram('chores_http_request_seconds', 'Seconds spent answering a request, until its body starts', ('method', 'route', 'status'))
+VALID_CHAIN_SECONDS = metrics.registry.histogram('chores_valid_chain_seconds', 'Seconds spent validating the chain of another node')
+VALID_CHAIN_BLOCKS = metrics.registry.histogram('chores_valid_chain_blocks', 'Blocks of another chain checked, the ones shared with ours are skipped', buckets=metrics.BLOCK_BUCKETS)
+# Seconds to wait for another node to answer, retries of a failed call and seconds before the first retry
+PEER_TIMEOUT = 5
+PEER_RETRIES = 2
+PEER_BACKOFF = 0.2
+# Number of nodes called at the same time when broadcasting
+BROADCAST_WORKERS = 8
+# Number of transaction changes from a node kept waiting for a missing one before fetching all its transactions
+GOSSIP_MAX_GAP = 16
+# Seconds between two rounds of gossip about the nodes of the network, and number of nodes called every round
+MEMBERSHIP_INTERVAL = 1
+MEMBERSHIP_FANOUT = 3
+# Most nodes a broadcast reaches, the other ones get the changes passed on by them
+ACTIVE_PEERS = 8
+# Seconds without news of a node before it is taken for dead, and before it is forgotten
+PEER_FAIL_AFTER = 10
+PEER_REMOVE_AFTER = 30
+# Keep the headers of the blocks only and download their transactions when needed, the master node is always a full node
+LIGHT_MODE = False
 
 class Blockchain:
-    def __init__(self):
-      self.nodes = set()
+    def __init__(self, miner=None, data_dir=DATA_DIR, light=LIGHT_MODE, host=HOST, port=PORT, master_node=MASTER_NODE, transport=None, sealing_policy=None):
+      """
+      :param miner: Miner of the Blocks, one with MINER_WORKERS processes if not given
+      :param data_dir: Directory where the chain and the pending transactions are kept, None to keep them in memory only
+      :param light: True to keep the headers of the blocks only
+      :param host: Host our node listens on
+      :param port: Port our node listens on
+      :param master_node: Address of the node every node registers with. Eg. '192.168.0.5:5000'
+      :param transport: Transport used to call the other nodes, HTTP if not given
+      :param sealing_policy: When the reviewed transactions are handed over to the miner, SEALING_POLICY if not given
+      """
+
+      self.master_node = master_node
+
+      # Every change to the node holds its lock, see changing, the requests read snapshots instead
+      self.lock = storage.DataLock()
+      # Copy of the current transactions read by the requests, until the next change
+      self._transactions_snapshot = None
+      # Only one resolution of conflicts at a time, it is the only one dropping blocks of the chain
+      self._resolving = threading.Lock()
+      self.light = light and master_node != f"{host}:{port}"
+      self.miner = miner or mining.make_miner(MINER_WORKERS)
+      self.mining_jobs = mining.MiningJobs(self.mine_block, BACKGROUND_MINING)
+      self.sealing_policy = sealing_policy or sealing.make_policy(SEALING_POLICY, SEAL_MAX_TRANSACTIONS, SEAL_MAX_BYTES, SEAL_INTERVAL, time())
+      # Changes of the node, pushed to the clients of /events
+      self.events = events.EventLog(EVENTS_HISTORY)
+
+      # Lists of reviewed transactions waiting for their Block to be mined
+      self.sealing = []
+      # Changes made to the transactions since they were last saved, see storage.PendingSnapshot.replay
+      self.journal = []
+
+      if data_dir is None:
+        self.pending_snapshot = None
+        self.chain = storage.MemoryChain()
+        self.current_transactions = mempool.Mempool()
+      else:
+        # Pick up the chain and the transactions from where the node left them
+        self.pending_snapshot = storage.PendingSnapshot(data_dir)
+        self.chain = storage.ChainLog(data_dir)
+        pending = self.pending_snapshot.load()
+        self.current_transactions = mempool.Mempool(pending['transactions'])
+        self.sealing = pending['sealing']
+
+      if self.light:
+        # A light node starts from the headers of the network every time, the pending transactions are still kept
+        self.chain = headers.HeaderChain(self.block_copies)
+
+      # Balance and history of every person, counted from the chain when they are first read, see follow_ledger
+      self.ledger = ledger.Ledger()
 
-      # Add own node to the nodes registry
-      self.base_url = f"http://{HOST}:{PORT}/"
-      self.register_node(self.base_url)
+      self.peers = broadcast.Broadcaster(PEER_TIMEOUT, PEER_RETRIES, PEER_BACKOFF, BROADCAST_WORKERS, transport)
 
-      if not MASTER_NODE in list(self.nodes):
+      # Own node is the first member of the nodes registry
+      self.base_url = f"http://{host}:{port}/"
+      self.address = urlparse(self.base_url).netloc
+      self.gossip = gossip.TransactionGossip(self.address, GOSSIP_MAX_GAP)
+      self.membership = membership.Membership(self.address, MEMBERSHIP_FANOUT, ACTIVE_PEERS, PEER_FAIL_AFTER, PEER_REMOVE_AFTER, monotonic())
+      self._closed = threading.Event()
+
+      if not self.master_node in self.nodes:
         # Register instantiated node into master node registry
-        nodes = list(self.nodes)
-        requests.post(f"http://{MASTER_NODE}/nodes/register", json = {"nodes": nodes})
+        nodes = [self.address]
+        self.peers.request(self.master_node, 'POST', '/nodes/register', required=True, json = {"nodes": nodes})
 
-        # Request current transactions from master node
-        response = requests.get(f"http://{MASTER_NODE}/transactions")
-        self.current_transactions = response.json()['transactions']
+        # Request up to date chain from master node, a node that kept its chain on disk
+        # only needs to catch up with the network once it knows the other nodes
+        restarted = len(self.chain) > 0
+        if not restarted and self.light:
+          # Only the headers are downloaded, and checked since they are all a light node knows of the chain
+          response = self.peers.request(self.master_node, 'GET', '/headers', required=True)
+          chain = response.json()['headers']
+          hashes = [None] * len(chain)
+          if not self.valid_chain(chain, hashes):
+            raise ValueError(f'The master node {self.master_node} sent an invalid chain')
+          self.replace_chain(chain, 0, hashes)
+        elif not restarted:
+          response = self.peers.request(self.master_node, 'GET', '/chain', required=True)
+          self.replace_chain(response.json()['chain'])
 
-        # Request up to date chain from master node
-        response = requests.get(f"http://{MASTER_NODE}/chain")
-        self.chain = response.json()['chain']
+        # Request current transactions from master node, they are only kept, no Block index is read for them
+        response = self.peers.request(self.master_node, 'GET', '/transactions', required=True)
+        self.replace_transactions(response.json()['transactions'])
+        self.follow_gossip(self.master_node, response.json())
 
-        # Request the network node registry from master node and register them one by one
-        response = requests.get(f"http://{MASTER_NODE}/nodes")
+        # Request the network node registry from master node, and tell some of them we joined right away
+        response = self.peers.request(self.master_node, 'GET', '/nodes', required=True)
         nodes = response.json()['nodes']
         for node in nodes:
           self.register_node(node)
-      
-      else:
-        self.current_transactions = []
-        self.chain = []
+        self.gossip_members()
 
+        if restarted:
+          self.resolve_conflicts_chain()
+      
+      elif not self.chain:
         # Create the genesis block
         self.new_block(previous_hash='1', proof=100)
+
+      self.resume_sealing()
+
+      # The timer of the policy seals the reviewed transactions even when no request comes. Only the master node
+      # runs it: the timers of all the nodes would go off together and seal the same transactions in rival Blocks
+      if self.sealing_policy.interval and self.master_node == self.address:
+        threading.Thread(target=self.seal_periodically, name='sealing-timer', daemon=True).start()
+      threading.Thread(target=self.keep_membership, name='membership', daemon=True).start()
+
+    @contextmanager
+    def changing(self):
+      """
+      Hold the lock of the node while changing it
+
+      The copy of the current transactions read by the requests is dropped
+      once the change is made. The other nodes are only called once the lock
+      is left, so that two nodes calling each other can't wait on each other.
+      """
+
+      with self.lock:
+        try:
+          yield
+        finally:
+          self._transactions_snapshot = None
+
+    def chain_snapshot(self):
+      """
+      :return: <ChainSnapshot> The chain as it is now, read without waiting for the changes being made
+      """
+
+      return self.chain.snapshot()
+
+    def transactions_snapshot(self):
+      """
+      The current transactions as read by the requests, without waiting for the changes being made
+
+      The copy is made by the first read after a change and shared by the
+      reads that follow, so reads only take the lock once per change.
+
+      :return: <dict> Copy of the current transactions, not to be changed, with the gossip session and number they match
+      """
+
+      snapshot = self._transactions_snapshot
+      if snapshot is None:
+        with self.lock:
+          snapshot = self._transactions_snapshot
+          if snapshot is None:
+            snapshot = self._transactions_snapshot = {
+              'transactions': self.current_transactions.to_dicts(),
+              'session': self.gossip.session,
+              'seq': self.gossip.seq,
+            }
+      return snapshot
+
+    def resume_sealing(self):
+      """
+      Queue again the Blocks that were waiting to be mined when the node stopped
+      """
+
+      sealing, self.sealing = self.sealing, []
+      for transactions in sealing:
+        # The Block may have been added right before the node stopped
+        if transactions != self.last_block['transactions']:
+          self.seal(transactions)
+      self.save_pending()
     
     def register_node(self, address):
       """
       Add a new node to the list of nodes
 
+      The node isn't broadcast to the other nodes, it reaches them with the
+      gossip about the nodes of the network, see gossip_members.
+
       :param address: Address of node. Eg. 'http://192.168.0.5:5000'
       """
 
@@ -62,47 +276,114 @@ class Blockchain:
       else:
         raise ValueError('Invalid URL')
       
-      nodes = list(self.nodes)
-
       # Register a new node if not found in registry
-      if not address in nodes:
-        self.nodes.add(address)
+      self.membership.add(address, monotonic())
 
-        # Broadcast to all nodes the new node added to the registry 
-        for node in nodes:
-          if node != urlparse(self.base_url).netloc:
-            requests.post(f"http://{node}/nodes/register", json = {"nodes": [address]})    
+    @property
+    def nodes(self):
+      """
+      :return: <frozenset> The live nodes of the network, ours included
+      """
+
+      return self.membership.live()
+
+    def neighbours(self):
+      """
+      :return: <list> The nodes our broadcasts reach, at most ACTIVE_PEERS of the other live nodes
+      """
+
+      return self.membership.active()
+
+    def gossip_members(self):
+      """
+      Run a round of gossip about the nodes of the network
+
+      Our heartbeat is counted, the nodes that stopped beating long ago are
+      forgotten, and the nodes we know are exchanged with a few others.
+      """
+
+      for node in self.membership.beat(monotonic()):
+        self.peers.forget(node)
+      self.membership.shuffle()
+
+      # A node that lost every peer starts again from the master node
+      nodes = self.membership.pick()
+      if len(self.nodes) == 1 and self.master_node != self.address:
+        nodes.append(self.master_node)
+
+      message = {'origin': self.address, 'members': self.membership.digest()}
+      responses = self.peers.broadcast(set(nodes), 'POST', '/nodes/gossip', json = message)
+      for response in responses.values():
+        if response is not None and response.status_code == 200:
+          self.membership.merge(response.json()['members'], monotonic())
+
+    def merge_members(self, message):
+      """
+      Take the nodes sent by another node in its round of gossip
+
+      :param message: message sent by gossip_members on the other node
+      :return: <dict> The nodes we know, sent back to it
+      """
+
+      self.membership.merge(message['members'], monotonic())
+      return self.membership.digest()
+
+    def keep_membership(self):
+      """
+      Gossip about the nodes of the network every MEMBERSHIP_INTERVAL seconds, run by a background thread
+      """
+
+      while not self._closed.wait(MEMBERSHIP_INTERVAL):
+        self.gossip_members()
+
+    def close(self):
+      """
+      Stop the gossip about the nodes and close the connections to them
+      """
+
+      self._closed.set()
+      self.peers.close()
       
-    def new_block(self, proof, previous_hash):
+    def new_block(self, proof, previous_hash, difficulty=None, transactions=None, mining_started=None):
       """
       Create a new Block in the Blockchain
       
       :param proof: The proof given by the Proof of Work algorithm
       :param previous_hash: Hash of previous Block
+      :param difficulty: Difficulty the proof was mined with, the next difficulty if not given
+      :param transactions: Transactions of the Block, the current transactions if not given
+      :param mining_started: <float> Time the search for the proof started, the next difficulty is retargeted from it
       :return: New Block
       """
       
-      block = {
-        'index': len(self.chain) + 1,
-        'timestamp': time(),
-        'transactions': self.current_transactions,
-        'proof': proof,
-        'previous_hash': previous_hash or self.hash(self.chain[-1])
-      }
-      
-      # Reset the current list of transactions
-      self.current_transactions = []
+      with self.changing():
+        if difficulty is None:
+          difficulty = self.next_difficulty()
+
+        if transactions is None:
+          transactions = self.current_transactions.to_dicts()
+
+          # Reset the current list of transactions
+          self.current_transactions = mempool.Mempool()
+          self.save_pending()
 
-      # Make sure that our chain is the good one
-      self.resolve_conflicts_chain
+        block = {
+          'index': len(self.chain) + 1,
+          'timestamp': time(),
+          'transactions': transactions,
+          'merkle_root': merkle.root(transactions),
+          'proof': proof,
+          'difficulty': difficulty,
+          'previous_hash': previous_hash or self.chain.hash(-1)
+        }
+        if mining_started is not None:
+          block['mining_started'] = mining_started
 
-      self.chain.append(block)
+        # Make sure that our chain is the good one
+        self.resolve_conflicts_chain
 
-      # Broadcast to the other nodes that a block has been added and that current transactions must be reseted
-      neighbours = list(self.nodes)
-      for node in neighbours:
-        if node != urlparse(self.base_url).netloc:
-          requests.get(f"http://{node}/chain/resolve?reset_transactions=1")
+        self.chain.append(block)
+        self.events.publish('block_sealed', index=block['index'], hash=self.chain.hash(-1), transactions=len(transactions), block_timestamp=block['timestamp'])
 
       return block
 
@@ -116,23 +397,18 @@ class Blockchain:
       :return: The index of the Block that will hold this transaction
       """
       
-      self.current_transactions.append({
-            'index': len(self.current_transactions) + 1,
-            'doer': doer,
-            'task': task,
-            'duration': duration,
-            'status': 'pending',
-            'reviewer': '',
-            'timestamp': time()
-      })
+      # The index must be read and taken in one go, or two transactions could get the same one
+      with self.changing():
+        changes = []
+        self.append_transaction(doer, task, duration, changes)
+        self.save_pending(journaled=True)
+        message = self.gossip.message(changes)
+        index = self.next_block_index
 
-      # Broadcast transaction list to rest of nodes
-      neighbours = list(self.nodes)
-      for node in neighbours:
-        if node != urlparse(self.base_url).netloc:
-          requests.post(f"http://{node}/transactions/update", json = {"transactions": self.current_transactions})
+      # Broadcast the new transaction to rest of nodes
+      self.gossip_transactions(message)
       
-      return self.last_block['index'] + 1
+      return index
 
     def change_transaction_status(self, ix_list, status, reviewer):
       """
@@ -140,55 +416,188 @@ class Blockchain:
       
       :param ix_list: list of transactions indexes which status needs to be changed
       :param status: New status
-      :return: The index of the Block that will hold this transaction
+      :return: The index of the Block that will hold this transaction and the mining ticket of the last Block sealed, None if none is mined yet
       """
       
+      with self.changing():
+        changes = []
+        self.review_transactions(ix_list, status, reviewer, changes)
+          
+        # Mine new Blocks with the reviewed transactions, when the sealing policy lets them go
+        index = self.next_block_index
+        sealed = self.take_sealed(changes)
+        self.save_pending(journaled=True)
+        message = self.gossip.message(changes) if changes else None
+
+      # The Blocks are queued once the lock is left, a Block mined in the calling thread doesn't hold it
+      tickets = [self.mining_jobs.submit(transactions) for transactions in sealed]
+
+      # Broadcast the changes to rest of nodes
+      if message is not None:
+        self.gossip_transactions(message)
+             
+      return index, tickets[-1] if tickets else None
+
+    def apply_batch(self, items):
+      """
+      Add and review many transactions at once, as if every item was sent on its own, in order
+
+      The lock is taken once, the transactions are saved once and all the
+      changes go to the other nodes in a single gossip message.
+
+      :param items: <list> transactions to add, with a doer, a task and a duration, and reviews, with an ix_list, a status and a reviewer
+      :return: <list> For every item, the index of the transaction added or the number of transactions reviewed,
+               and the index of the Block that will hold them; and the mining tickets of the Blocks sealed
+      """
+
+      with self.changing():
+        changes = []
+        results = []
+        for item in items:
+          if 'ix_list' in item:
+            reviewed = self.review_transactions(item['ix_list'], item['status'], item['reviewer'], changes)
+            results.append({'reviewed': reviewed, 'block': self.next_block_index})
+          else:
+            index = self.append_transaction(item['doer'], item['task'], item['duration'], changes)
+            results.append({'index': index, 'block': self.next_block_index})
+
+        sealed = self.take_sealed(changes)
+        self.save_pending(journaled=True)
+        message = self.gossip.message(changes) if changes else None
+
+      tickets = [self.mining_jobs.submit(transactions) for transactions in sealed]
+      if message is not None:
+        self.gossip_transactions(message)
+
+      return results, tickets
+
+    def append_transaction(self, doer, task, duration, changes):
+      """
+      Add a new transaction to the current transactions, the lock of the node must be held
+
+      :param doer: identificator of the person who carried out the task
+      :param task: description of the task done
+      :param duration: duration spent in doing the task
+      :param changes: <list> Changes to gossip, the addition is added to it
+      :return: <int> The index of the transaction, used to review it
+      """
+
+      transaction = {
+            'id': uuid4().hex,
+            'index': self.current_transactions.next_index,
+            'doer': doer,
+            'task': task,
+            'duration': duration,
+            'status': 'pending',
+            'reviewer': '',
+            'timestamp': time()
+      }
+      self.current_transactions.append(transaction)
+      changes.append({'change': 'add', 'transaction': transaction})
+      self.journal.append(changes[-1])
+      self.events.publish('transaction_added', transaction=transaction)
+      return transaction['index']
+
+    def review_transactions(self, ix_list, status, reviewer, changes):
+      """
+      Change the status of the given transactions and credit the reviewer, the lock of the node must be held
+
+      :param ix_list: list of transactions indexes which status needs to be changed
+      :param status: New status
+      :param reviewer: identificator of the person who reviewed the transactions
+      :param changes: <list> Changes to gossip, the new statuses and the reward of the reviewer are added to it
+      :return: <int> Number of transactions whose status changed
+      """
+
+      # The records hold the status as a small int, compared as such
+      code = records.status_code(status)
+
       current_transactions = self.current_transactions
       reviewed_transactions = 0
-      for i in range (0, len(current_transactions)):
-        if ((current_transactions[i]['index'] in ix_list) and (current_transactions[i]['doer'] != reviewer) and (current_transactions[i]['status'] != status) and (current_transactions[i]['reviewer'] != reviewer)):
-          current_transactions[i]['status'] = status
-          reviewed_transactions += 1
-          current_transactions[i]['reviewer'] = reviewer
+      # Only the transactions with the given indexes are looked at, through the index of the list
+      for ix in dict.fromkeys(ix_list):
+        for transaction in current_transactions.with_index(ix):
+          if ((transaction.doer != reviewer) and (transaction.status != code) and (transaction.reviewer != reviewer)):
+            current_transactions.set_status(transaction, code, reviewer)
+            reviewed_transactions += 1
+            changes.append({'change': 'status', 'id': transaction.id, 'status': status, 'reviewer': reviewer})
+            self.journal.append({'change': 'status', 'position': current_transactions.position(transaction), 'status': records.status_name(code), 'reviewer': reviewer})
+            self.events.publish('status_changed', id=transaction.id, index=transaction.index, status=status, reviewer=reviewer)
                         
       # In this blockchain, instead of giving credits for the effort of mining, we give credits for the effort of reviewing the transactions
       if reviewed_transactions > 0:
-        self.current_transactions.append({
-          'index': len(self.current_transactions) + 1,
+        transaction = {
+          'id': uuid4().hex,
+          'index': current_transactions.next_index,
           'doer': reviewer,
           'status': "accepted",
-          'task': "Task list review",
+          'task': ledger.REVIEW_TASK,
           'duration': reviewed_transactions*REWARD,
           'reviewer': reviewer,
           'timestamp': time()
-        })
-        
-      # If all transactions have been accepted or rejected, mine a new block with all transactions
-      required_status = ['accepted', 'rejected']
-      count = 0
-      for i in range (0, len(current_transactions)):
-        if current_transactions[i]['status'] in required_status:
-          count = count + 1
-      if count == len(current_transactions):
-        last_block = self.last_block
-        proof = self.proof_of_work(last_block)
-        previous_hash = self.hash(last_block)
-        block = self.new_block(proof, previous_hash)
-      
-      # Broadcast transaction list to rest of nodes
-      neighbours = list(self.nodes)
-      for node in neighbours:
-        if node != urlparse(self.base_url).netloc:
-          requests.post(f"http://{node}/transactions/update", json = {"transactions": self.current_transactions})
-             
-      return self.last_block['index'] + 1
+        }
+        current_transactions.append(transaction)
+        changes.append({'change': 'add', 'transaction': transaction})
+        self.journal.append(changes[-1])
+        self.events.publish('transaction_added', transaction=transaction)
+
+      return reviewed_transactions
+
+    def take_sealed(self, changes):
+      """
+      Hand the transactions the sealing policy lets go over to the miner, the other ones staying for the next Block
+
+      The lock of the node must be held. The transactions handed over and the
+      ones left must then be saved at once, so that a crash can't lose them.
+
+      :param changes: <list> Changes to gossip, the transactions taken out of the list are added to it
+      :return: <list> The transactions of every Block to mine, to be queued once the lock is left
+      """
+
+      sealed = []
+      while True:
+        now = time()
+        selected = self.sealing_policy.select(self.current_transactions, now)
+        if not selected:
+          return sealed
+
+        transactions = [transaction.to_dict() for transaction in selected]
+        self.journal.append({'change': 'seal', 'positions': [self.current_transactions.position(transaction) for transaction in selected]})
+        self.current_transactions = self.current_transactions.excluding(selected)
+        self.sealing.append(transactions)
+        self.sealing_policy.sealed(now)
+        sealed.append(transactions)
+        changes.append({'change': 'seal', 'ids': [transaction.get('id') for transaction in transactions]})
+        self.events.publish('transactions_sealed', ids=changes[-1]['ids'], block=self.next_block_index - 1)
+
+    def seal_periodically(self):
+      """
+      Seal the reviewed transactions whenever the timer of the sealing policy is over, run by a background thread
+      """
+
+      while True:
+        sleep(self.sealing_policy.wait(time()))
+        with self.changing():
+          changes = []
+          sealed = self.take_sealed(changes)
+          message = None
+          if sealed:
+            self.save_pending(journaled=True)
+            message = self.gossip.message(changes)
+        for transactions in sealed:
+          self.mining_jobs.submit(transactions)
+        if message is not None:
+          self.gossip_transactions(message)
     
     def reset_transactions(self):
       """
       Reset transactions, for instance, when another node has mined a block
       """
 
-      self.current_transactions = []
+      with self.changing():
+        self.current_transactions = mempool.Mempool()
+        self.save_pending()
+        self.events.publish('transactions_replaced', length=0)
     
     def update_transaction_list(self, transactions):
       """
@@ -198,126 +607,575 @@ class Blockchain:
       :return: The index of the Block that will hold this transaction
       """
 
-      self.current_transactions = transactions
+      with self.changing():
+        self.replace_transactions(transactions)
+        return self.next_block_index
+
+    def replace_transactions(self, transactions):
+      """
+      Override current transactions, without reading the chain, which a joining node hasn't got yet
+      :param transactions: list of transactions
+      """
+
+      with self.changing():
+        self.current_transactions = mempool.Mempool(transactions)
+        self.save_pending()
+        self.events.publish('transactions_replaced', length=len(self.current_transactions))
+
+    def gossip_transactions(self, message):
+      """
+      Send the changes made to the current transactions to the rest of nodes
+
+      :param message: list of changes, each one adding a transaction, changing the status of one or taking
+                      out the ones handed over to the miner, numbered by self.gossip while the lock was held
+                      so that the numbers follow the order of the changes
+      """
+
+      nodes, reached = self.relay_targets([])
+      self.peers.broadcast(nodes, 'POST', '/transactions/delta', json = dict(message, reached=reached))
+
+    def relay_targets(self, reached):
+      """
+      Pick the nodes to send a message to, the broadcasts only reaching the neighbours of every node
+
+      :param reached: <list> Nodes the message already went to, as told by the node that sent it to us
+      :return: <list> Our neighbours the message still has to go to, and <list> the nodes it went to once sent to them
+      """
+
+      nodes = [node for node in self.neighbours() if node not in reached]
+      return nodes, list(dict.fromkeys(reached + [self.address] + nodes))
+
+    def apply_transaction_changes(self, message):
+      """
+      Apply the changes made to the current transactions by another node
+
+      Messages already applied are ignored and the ones arriving out of order
+      wait for the missing ones. When a message is missing for too long, the
+      current transactions are fetched again from the node.
+
+      :param message: message sent by gossip_transactions on the other node
+      :return: The index of the Block that will hold this transaction
+      """
+
+      # Messages are sorted out and applied in one go, so that two requests can't apply them out of order
+      with self.changing():
+        fresh = not self.gossip.known(message)
+        ready = self.gossip.receive(message)
+        if ready is not None:
+          for changes in ready:
+            self.apply_changes(changes)
+          self.save_pending(journaled=True)
+          index = self.next_block_index
+
+      # A message seen for the first time is passed on to the neighbours it didn't go to yet
+      if fresh:
+        nodes, reached = self.relay_targets(message.get('reached', [message['origin']]))
+        if nodes:
+          self.peers.send(nodes, 'POST', '/transactions/delta', json = dict(message, reached=reached))
+      if ready is not None:
+        return index
+
+      # A message went missing, the transactions of the node are fetched again without holding the lock
+      response = self.peers.request(message['origin'], 'GET', '/transactions')
+      with self.changing():
+        if response is not None and response.status_code == 200:
+          self.update_transaction_list(response.json()['transactions'])
+          for changes in self.follow_gossip(message['origin'], response.json()):
+            self.apply_changes(changes)
+          self.save_pending()
+
+        return self.next_block_index
+
+    def follow_gossip(self, node, state):
+      """
+      Start following the changes of a node from the transactions fetched from it
+
+      :param node: Address of the node
+      :param state: response of the node to GET /transactions
+      :return: <list> The changes of the node received meanwhile, ready to be applied
+      """
+
+      if 'session' not in state:
+        return []
+      return self.gossip.resynced(node, state['session'], state['seq'])
+
+    def apply_changes(self, changes):
+      """
+      :param changes: list of changes made to the current transactions by another node
+      """
+
+      for change in changes:
+        if change['change'] == 'add':
+          # Adding the same transaction twice does nothing
+          if self.current_transactions.with_id(change['transaction']['id']) is None:
+            self.current_transactions.append(change['transaction'])
+            self.journal.append(change)
+            self.events.publish('transaction_added', transaction=change['transaction'])
+        elif change['change'] == 'status':
+          transaction = self.current_transactions.with_id(change['id'])
+          if transaction is not None:
+            self.current_transactions.set_status(transaction, change['status'], change['reviewer'])
+            self.journal.append({'change': 'status', 'position': self.current_transactions.position(transaction), 'status': records.status_name(transaction.status), 'reviewer': change['reviewer']})
+            self.events.publish('status_changed', id=change['id'], index=transaction.index, status=change['status'], reviewer=change['reviewer'])
+        elif change['change'] == 'seal':
+          # Sealed by the other node, the transactions are only dropped from ours
+          dropped = [self.current_transactions.with_id(transaction_id) for transaction_id in change['ids']]
+          self.journal.append({'change': 'drop', 'positions': [self.current_transactions.position(transaction) for transaction in dropped if transaction is not None]})
+          self.current_transactions = self.current_transactions.without(change['ids'])
+          self.sealing_policy.sealed(time())
+          self.events.publish('transactions_sealed', ids=change['ids'])
+
+    def seal(self, transactions):
+      """
+      Queue a new Block holding the given transactions to be mined
+
+      :param transactions: list of reviewed transactions
+      :return: The mining ticket of the Block
+      """
+
+      with self.changing():
+        self.sealing.append(transactions)
+        self.save_pending()
+      return self.mining_jobs.submit(transactions)
+
+    def mine_block(self, transactions):
+      """
+      Find the proof of a new Block holding the given transactions and add it to the chain
+
+      :param transactions: list of reviewed transactions
+      :return: New Block
+      """
+
+      while True:
+        with self.changing():
+          last_block = self.last_block
+          difficulty = self.next_difficulty()
+          previous_hash = self.chain.hash(-1)
+
+        # The proof is searched for without holding the lock
+        mining_started = time()
+        proof = self.proof_of_work(last_block, difficulty, previous_hash)
+
+        with self.changing():
+          # A longer chain may have replaced ours while mining, the block then has to be mined again on top of it
+          if self.chain.hash(-1) != previous_hash:
+            continue
+
+          block = self.new_block(proof, previous_hash, difficulty, transactions, mining_started)
+          self.journal.append({'change': 'mined', 'positions': [position for position, sealing in enumerate(self.sealing) if sealing is transactions]})
+          self.sealing = [sealing for sealing in self.sealing if sealing is not transactions]
+          self.save_pending(journaled=True)
+          break
+
+      # Broadcast to the other nodes that a block has been added. Their transactions are not reseted: the
+      # transactions of the block were taken out of the list, and the new list sent, when the block was queued
+      nodes, reached = self.relay_targets([])
+      self.peers.broadcast(nodes, 'GET', '/chain/resolve', params={'node': self.address, 'reached': ','.join(reached)})
+
+      return block
+
+    def save_pending(self, journaled=False):
+      """
+      Save the transactions that are not in the chain yet, if the node keeps its data on disk
+
+      :param journaled: <bool> True if every change made to them since they were last saved is in self.journal, only
+                        the changes are then appended to the journal of the snapshot, unless it is full
+      """
 
-      return self.last_block['index'] + 1
+      journal, self.journal = self.journal, []
+      if self.pending_snapshot is None:
+        return
+      if not (journaled and self.pending_snapshot.record(journal)):
+        self.pending_snapshot.save({'transactions': self.current_transactions.to_dicts(), 'sealing': self.sealing})
 
     @property
     def last_block(self):
       return self.chain[-1]
 
+    @property
+    def next_block_index(self):
+      """
+      Index of the Block that will hold the current transactions, after the Blocks waiting to be mined
+      """
+
+      return self.chain.header(-1)['index'] + 1 + len(self.sealing)
+
+    def next_difficulty(self):
+      """
+      Difficulty for the next Block, retargeted from the time the recent Blocks took to mine, see mining.latencies
+
+      :return: <int>
+      """
+
+      return self.retargeted_difficulty(self.chain[-RETARGET_WINDOW:])
+
+    @staticmethod
+    def retargeted_difficulty(previous_blocks):
+      """
+      Difficulty of the Block following the given ones, the same on every node
+
+      :param previous_blocks: <list> The last RETARGET_WINDOW Blocks before it, oldest first, or their headers
+      :return: <int>
+      """
+
+      if not previous_blocks:
+        return max(MIN_DIFFICULTY, min(MAX_DIFFICULTY, mining.DIFFICULTY))
+
+      latencies = mining.latencies(previous_blocks)
+      difficulty = previous_blocks[-1].get('difficulty', mining.DIFFICULTY)
+      return mining.retarget(difficulty, latencies, BLOCK_INTERVAL, MIN_DIFFICULTY, MAX_DIFFICULTY)
+
+    def valid_difficulty(self, blocks, position):
+      """
+      Check the difficulty declared by a Block against the Blocks before it
+
+      It is retargeted again from them, the way next_difficulty does on the
+      node that mined it. The latencies are read from the headers, so a light
+      node checks it the same way. The start of the mining of the Block must
+      be a time before the Block, the Blocks after it are retargeted from it.
+
+      :param blocks: <list> Blocks of a chain, oldest first
+      :param position: <int> Position of the Block in the list, after the RETARGET_WINDOW Blocks before it when there are so many
+      :return: True if valid, False if not
+      """
+
+      block, previous_blocks = blocks[position], blocks[max(0, position - RETARGET_WINDOW):position]
+      last_difficulty = previous_blocks[-1].get('difficulty') if previous_blocks else None
+      if 'difficulty' not in block:
+        # Blocks mined before the difficulty was stored used the default one, they can only follow such blocks
+        return last_difficulty is None
+
+      difficulty, mining_started = block['difficulty'], block.get('mining_started')
+      if type(difficulty) is not int:
+        return False
+      if mining_started is not None:
+        if type(mining_started) not in (int, float) or type(block.get('timestamp')) not in (int, float) or mining_started > block['timestamp']:
+          return False
+
+      # The Blocks before it were checked the same way, their latencies can be computed
+      return difficulty == self.retargeted_difficulty(previous_blocks)
+
     @staticmethod
     def hash(block):
       """
-      Creates a SHA-256 hash of a Block
+      Creates a SHA-256 hash of a Block, of its header only if it has a Merkle root
       
       :param block: Block
       """
       
-      # We must make sure that the Dictionary is Ordered, or we'll have inconsistent hashes
-      block_string = json.dumps(block, sort_keys=True).encode()
-      return hashlib.sha256(block_string).hexdigest()
+      return encoding.block_hash(block)
     
-    def proof_of_work(self, last_block):
+    def proof_of_work(self, last_block, difficulty=None, last_hash=None):
       """
       Simple Proof of Work Algorithm:
       
-      - Find a number p' such that hash(pp') contains leading 4 zeroes
+      - Find a number p' such that hash(pp') contains as many leading zeroes as the difficulty
       - Where p is the previous proof, and p' is the new proof
       
       :param last_block: <dict> last Block
+      :param difficulty: <int> Number of leading zeroes, the next difficulty if not given
+      :param last_hash: <str> Hash of the last Block, computed again if not given
       :return: <int>
       """
       
+      if difficulty is None:
+        difficulty = self.next_difficulty()
+
       last_proof = last_block['proof']
-      last_hash = self.hash(last_block)
+      if last_hash is None:
+        last_hash = self.hash(last_block)
       
-      proof = 0
-      while self.valid_proof(last_proof, proof, last_hash) is False:
-        proof += 1
-        
+      with profiling.span('proof_of_work'), MINING_SECONDS.time():
+        proof, tried = self.miner.mine_counted(last_proof, last_hash, difficulty)
+
+      MINING_NONCES.observe(tried)
       return proof
       
     @staticmethod
-    def valid_proof(last_proof, proof, last_hash):
+    def valid_proof(last_proof, proof, last_hash, difficulty=mining.DIFFICULTY):
       """
       Validates the Proof
         
       :param last_proof: <int> Previous Proof
       :param proof: <int> Current Proof
       :param last_hash: <str> The hash of the Previous Block
+      :param difficulty: <int> Number of leading zeroes required
       :return: <bool> True if correct, False if not.
       """
         
-      guess = f'{last_proof}{proof}{last_hash}'.encode()
-      guess_hash = hashlib.sha256(guess).hexdigest()
-      return guess_hash[:4] == "0000"
+      return mining.valid_proof(last_proof, proof, last_hash, difficulty)
 
-    def valid_chain(self, chain):
+    @staticmethod
+    def valid_proof_many(last_proof, proofs, last_hash, difficulty=mining.DIFFICULTY):
+      """
+      Validates several Proofs against the same previous Block
+        
+      :param last_proof: <int> Previous Proof
+      :param proofs: <list> Proofs to check
+      :param last_hash: <str> The hash of the Previous Block
+      :param difficulty: <int> Number of leading zeroes required
+      :return: <list> One bool per proof, True if correct, False if not.
+      """
+        
+      return mining.valid_proof_many(last_proof, proofs, last_hash, difficulty)
+
+    def shared_prefix(self, chain, hashes):
+      """
+      Number of leading blocks of the given chain that are blocks of our chain
+
+      Our chain has already been validated and the hash of every block is
+      kept next to it. A block that hashes to the hash of our block at the
+      same height is that block, so the shared part can be found with a
+      binary search instead of hashing every block.
+
+      :param chain: A blockchain, or a part of one
+      :param hashes: <list> Hash of every block of the chain, None where not known yet, filled as they are computed
+      :return: <int>
+      """
+
+      low, high = 0, len(chain)
+      while low < high:
+        middle = (low + high + 1) // 2
+        block = chain[middle - 1]
+        height = block['index'] - 1
+        if 0 <= height < len(self.chain):
+          hashes[middle - 1] = hashes[middle - 1] or self.hash(block)
+          shared = hashes[middle - 1] == self.chain.hash(height)
+        else:
+          shared = False
+
+        if shared:
+          low = middle
+        else:
+          high = middle - 1
+
+      return low
+
+    def valid_chain(self, chain, hashes=None):
       """
       Determine if a given blockchain is valid
 
+      The leading blocks shared with our chain are not checked again, they
+      are ours and the caller keeps our copy of them, so a chain extending
+      ours only costs the validation of the new blocks.
+
       :param chain: A blockchain
+      :param hashes: <list> Hash of every block of the chain, None where not known yet, completed when the chain is valid
       :return: True if valid, False if not
       """
 
-      last_block = chain[0]
-      current_index = 1
+      with profiling.span('valid_chain'), VALID_CHAIN_SECONDS.time():
+        return self.check_chain(chain, hashes)
+
+    def check_chain(self, chain, hashes):
+      block_hashes = hashes if hashes is not None else [None] * len(chain)
+      shared = self.shared_prefix(chain, block_hashes)
+      VALID_CHAIN_BLOCKS.observe(len(chain) - shared)
+      current_index = max(1, shared)
+      last_block = chain[current_index - 1]
+
+      # The difficulty of the first blocks is retargeted from the blocks before the chain, the chain is built on ours
+      height = chain[0]['index'] - 1
+      ours = self.chain.header if self.light else self.chain.__getitem__
+      blocks = [ours(before) for before in range(max(0, height - RETARGET_WINDOW), height)]
+      offset = len(blocks)
+      blocks += chain
+
+      # The first block has no previous block to check, only its transactions and the difficulty of a genesis block when it isn't ours
+      if shared == 0 and not self.valid_merkle_root(last_block):
+        return False
+      if shared == 0 and height == 0 and not self.valid_difficulty(blocks, 0):
+        return False
 
       while current_index < len(chain):
         block = chain[current_index]
-        print(f'{last_block}')
-        print(f'{block}')
-        print("\n-----------\n")
         # Check that the hash of the block is correct
-        last_block_hash = self.hash(last_block)
+        last_block_hash = block_hashes[current_index - 1] or self.hash(last_block)
+        block_hashes[current_index - 1] = last_block_hash
         if block['previous_hash'] != last_block_hash:
           return False
 
-        # Check that the Proof of Work is correct
-        if not self.valid_proof(last_block['proof'], block['proof'], last_block_hash):
+        if not self.valid_merkle_root(block):
+          return False
+
+        # Check that the block declares the difficulty retargeted from the blocks before it, and that
+        # the Proof of Work is correct for it. Blocks mined before the difficulty was stored used the default one
+        if not self.valid_difficulty(blocks, offset + current_index):
+          return False
+        difficulty = block.get('difficulty', mining.DIFFICULTY)
+        if not self.valid_proof(last_block['proof'], block['proof'], last_block_hash, difficulty):
           return False
 
         last_block = block
         current_index += 1
 
+      if hashes is not None:
+        hashes[:] = [block_hash or self.hash(block) for block, block_hash in zip(chain, block_hashes)]
+
       return True
 
-    def resolve_conflicts_chain(self):
+    def valid_merkle_root(self, block):
+      """
+      The hash of a block with a Merkle root doesn't cover its transactions, the root does
+
+      :param block: Block
+      :return: True if the transactions of the block match its Merkle root, or if it has none
+      """
+
+      if 'merkle_root' not in block:
+        return True
+      if 'transactions' not in block:
+        # Only a light node takes the headers of the blocks for the blocks
+        return self.light
+      return block['merkle_root'] == merkle.root(block['transactions'])
+
+    def replace_chain(self, chain, start=0, hashes=None):
+      """
+      Replace our chain with the given one, on disk as well if the node keeps its data there
+
+      :param chain: A valid blockchain, or the part of it replacing our blocks from the given height
+      :param start: <int> Number of our blocks kept in front of the given ones
+      :param hashes: <list> Hash of every given block, computed again if not given
+      """
+
+      with self.changing():
+        self.chain.replace(chain, start, hashes)
+        self.events.publish('chain_replaced', start=start, length=len(self.chain), hash=self.chain.hash(-1))
+
+    def follow_ledger(self):
+      """
+      Count the new blocks of the chain in the ledger, before a balance or a history is read
+
+      The ledger is only brought in step with the chain when it is read, so
+      a node starting from a long chain doesn't count every block first,
+      and a light node only downloads the transactions of the blocks then.
+      """
+
+      while True:
+        try:
+          # The blocks are counted without holding the lock, a light node may have to download them
+          self.ledger.follow(self.chain.snapshot())
+          return
+        except storage.ChainChanged:
+          # The ledger takes out what it counted of the replaced blocks on the next try
+          continue
+
+    def block_copies(self, height):
+      """
+      Download a block of the chain for a light node
+
+      Only the master node is asked, since it is a full node and other
+      light nodes would have to download the block as well.
+
+      :param height: <int> Position of the block in the chain
+      :return: The copies of the block sent by the nodes
+      """
+
+      response = self.peers.request(self.master_node, 'GET', '/chain', params={'from': height + 1, 'limit': 1})
+      if response is not None and response.status_code == 200:
+        yield from response.json()['chain'][:1]
+
+    def fetch_fork(self, node):
+      """
+      Download the part of a node's chain that differs from ours
+
+      The download starts right after our last block; when the blocks don't
+      link to our chain the window goes back twice as far each time, so that
+      a node just a few blocks ahead only sends those blocks.
+
+      :param node: Address of the node
+      :return: The number of our blocks kept, the blocks replacing the rest and their hashes, None if the node's chain is not valid
+      """
+
+      window = 0
+      while True:
+        start = max(0, len(self.chain) - window)
+        # The blocks are streamed one per line, so that the node never builds the whole answer in memory
+        path = '/headers' if self.light else '/chain'
+        response = self.peers.request(node, 'GET', path, params={'from': start + 1, 'format': 'ndjson'}, stream=True)
+        if response is None or response.status_code != 200:
+          return None
+        blocks = [encoding.loads(line) for line in response.iter_lines() if line]
+        if not blocks or 'error' in blocks[-1]:
+          # The chain of the node was replaced while it was sent
+          return None
+
+        if start == 0:
+          # Keep our copy of the blocks shared with the node
+          hashes = [None] * len(blocks)
+          if not self.valid_chain(blocks, hashes):
+            return None
+          kept = self.shared_prefix(blocks, hashes)
+          return kept, blocks[kept:], hashes[kept:]
+
+        # A full node checks the difficulty of the new blocks against the transactions of ours
+        anchor = self.chain.header(start - 1) if self.light else self.chain[start - 1]
+        if blocks[0]['previous_hash'] == self.chain.hash(start - 1):
+          # Check the new blocks against our block they are built on
+          hashes = [self.chain.hash(start - 1)] + [None] * len(blocks)
+          if not self.valid_chain([anchor] + blocks, hashes):
+            return None
+          return start, blocks, hashes[1:]
+
+        window = max(1, window * 2)
+
+    def resolve_conflicts_chain(self, announcer=None):
       """
       This is our consensus algorithm, it resolves conflicts
       by replacing our chain with the longest one in the network.
 
+      :param announcer: Address of the node that told us about its new blocks, the only one asked then
       :return: True if our chain was replaced, False if not
       """
       
-      neighbours = list(self.nodes)
-      
-      new_chain = None
+      # Only one resolution at a time, the blocks of our chain are only dropped by it
+      with self._resolving:
+        new_chain = None
 
-      # We're only looking for chains longer than ours
-      max_length = len(self.chain)
+        # We're only looking for chains longer than ours
+        max_length = len(self.chain)
 
-      # Grab and verify the chains from all the nodes in our network
-      for node in neighbours:
-        if node != urlparse(self.base_url).netloc:
-          response = requests.get(f'http://{node}/chain')
+        # Grab the head of the chains from all the nodes we broadcast to at once
+        nodes = self.neighbours() if announcer is None else [announcer]
+        heads = self.peers.broadcast(nodes, 'GET', '/chain/head')
+        lengths = {}
+        for node, response in heads.items():
+          if response is not None and response.status_code == 200:
+            lengths[node] = response.json()['length']
 
-          if response.status_code == 200:
-            length = response.json()['length']
-            chain = response.json()['chain']
+        # Only download and verify the blocks we are missing, starting with the longest chain
+        for node in sorted(lengths, key=lengths.get, reverse=True):
+          # Check if the length is longer and the chain is valid
+          if lengths[node] > max_length:
+            with profiling.span(f'fetch_fork {node}'):
+              fork = self.fetch_fork(node)
+            if fork is not None and fork[0] + len(fork[1]) > max_length:
+              max_length = fork[0] + len(fork[1])
+              new_chain = fork
 
-            # Check if the length is longer and the chain is valid
-            if length > max_length and self.valid_chain(chain):
-              max_length = length
-              new_chain = chain
+        # Replace our chain if we discovered a new, valid chain longer than ours
+        if new_chain:
+          start, blocks, hashes = new_chain
+          with self.changing():
+            # Blocks may have been mined on our chain while the forks were fetched
+            if start + len(blocks) <= len(self.chain):
+              return False
+            with profiling.span('replace_chain'):
+              self.replace_chain(blocks, start, hashes)
+          return True
 
-      # Replace our chain if we discovered a new, valid chain longer than ours
-      if new_chain:
-        self.chain = new_chain
-        return True
+        return False
+
+    def pass_on_chain(self, reached):
+      """
+      Tell our neighbours about the new blocks we got from another node, without waiting for them
+
+      :param reached: <list> Nodes told about them already, as sent by the other node
+      """
 
-      return False
+      nodes, reached = self.relay_targets(reached)
+      if nodes:
+        self.peers.send(nodes, 'GET', '/chain/resolve', params={'node': self.address, 'reached': ','.join(reached)})
 
 
 # Instantiate our Node
@@ -326,8 +1184,125 @@ app = Flask(__name__)
 # Generate a globally unique address for this node
 node_identifier = str(uuid4()).replace('-', '')
 
-# Instantiate the Blockchain
-blockchain = Blockchain()
+# Recent profiles of the requests
+profiles = profiling.Profiles(PROFILE_HISTORY)
+
+# Instantiate the Blockchain, a node started from the command line is built once its port is read, see below
+own_blockchain = Blockchain() if __name__ != '__main__' else None
+
+# Node a request is sent to, the simulator runs several nodes in one process and sets the one it calls
+called_node = ContextVar('called_node', default=None)
+
+def answering_node():
+  """
+  :return: <Blockchain> The node answering the current request, ours unless another one was called
+  """
+
+  called = called_node.get()
+  return own_blockchain if called is None else called
+
+blockchain = LocalProxy(answering_node)
+
+def mempool_sizes():
+  """
+  :return: <dict> Number of transactions waiting to go into a Block in every status, read from the index of the pool
+  """
+
+  current_transactions = blockchain.current_transactions
+  return {(status,): current_transactions.count_status(status) for status in records.STATUSES}
+
+metrics.registry.gauge('chores_mempool_transactions', 'Transactions waiting to go into a block', mempool_sizes, ('status',))
+metrics.registry.gauge('chores_mining_jobs_pending', 'Blocks queued or being mined', lambda: blockchain.mining_jobs.pending())
+metrics.registry.gauge('chores_chain_length', 'Blocks in the chain', lambda: len(blockchain.chain))
+
+@app.before_request
+def start_request_timer():
+  if metrics.registry.enabled:
+    g.request_start = perf_counter()
+
+@app.after_request
+def observe_request(response):
+  # Streamed bodies are sent after this, their time is the time to the first byte
+  start = g.pop('request_start', None)
+  if start is not None:
+    route = request.url_rule.rule if request.url_rule is not None else 'unknown'
+    REQUEST_SECONDS.observe(perf_counter() - start, request.method, route, str(response.status_code))
+  return response
+
+@app.before_request
+def start_profile():
+  flag = request.headers.get('X-Profile', request.args.get('profile'))
+  if flag is None and PROFILE_SAMPLE_RATE and random() < PROFILE_SAMPLE_RATE:
+    flag = 'sample'
+  if not PROFILING or flag in (None, '0', 'false') or request.path.startswith('/debug/'):
+    return
+
+  # Any other flag, eg. 1, profiles every call
+  mode = flag if flag in profiling.MODES else 'cprofile'
+  profiling.Profile(request.method, request.full_path.rstrip('?'), mode).start()
+
+@app.after_request
+def stop_profile(response):
+  profile = profiling.current()
+  if profile is not None:
+    profile.stop(response.status_code)
+    profiles.add(profile)
+    response.headers['X-Profile-Id'] = profile.id
+  return response
+
+@app.teardown_request
+def drop_profile(error=None):
+  # A request that raised never went through stop_profile, its thread must not stay profiled
+  profile = profiling.current()
+  if profile is not None:
+    profile.stop(500)
+    profiles.add(profile)
+
+def page(length):
+  """
+  Read the page asked for with ?from=&limit=, the items being numbered from 1
+
+  :param length: <int> Number of items in the list
+  :return: <range> Positions of the items of the page, None if the limit is wrong
+  """
+
+  args = request.args
+  start = max(args.get("from", default=1, type=int), 1) - 1
+  limit = args.get("limit", type=int)
+  if limit is None:
+    return range(length)[start:]
+  if limit < 1:
+    return None
+  return range(length)[start:start + min(limit, PAGE_MAX_LIMIT)]
+
+def next_page(positions, length):
+  """
+  :return: <int> Value of ?from= for the page following the given one, None if it was the last one
+  """
+
+  return positions.stop + 1 if positions.stop < length else None
+
+def streamed(documents):
+  """
+  Send the given JSON documents one per line, as they are read, instead of building the whole list in memory
+
+  :param documents: encoded documents
+  """
+
+  def lines():
+    try:
+      for document in documents:
+        yield document + b'\n'
+    except storage.ChainChanged:
+      # The answer has started and can't turn into a 503, it ends with an error record instead
+      # so that the client doesn't take the blocks read before the chain was replaced for all of them
+      yield encoding.canonical({'error': 'The chain was replaced while it was read, please try again'}) + b'\n'
+
+  return Response(lines(), mimetype='application/x-ndjson')
+
+@app.errorhandler(storage.ChainChanged)
+def chain_changed(error):
+  return 'The chain was replaced while it was read, please try again', 503
   
 @app.route('/transactions/new', methods=['POST'])
 def new_transaction():
@@ -341,19 +1316,34 @@ def new_transaction():
   # Create a new Transaction
   index = blockchain.new_transaction(values['doer'], values['task'], values['duration'])
   
+  current_transactions = blockchain.transactions_snapshot()['transactions']
   response = {
-    'transactions': blockchain.current_transactions,
-    'length': len(blockchain.current_transactions),
+    'transactions': current_transactions,
+    'length': len(current_transactions),
     'message': f'Transaction will be added to Block {index}'
   }
   return jsonify(response), 201
 
 @app.route('/transactions', methods=['GET'])
 def transactions():
+  # The transactions and the number of the last change they hold are read together
+  snapshot = blockchain.transactions_snapshot()
+  current_transactions = snapshot['transactions']
+  positions = page(len(current_transactions))
+  if positions is None:
+    return 'Wrong limit value', 400
+
+  if request.args.get("format") == 'ndjson':
+    return streamed(encoding.canonical(transaction) for transaction in current_transactions[positions.start:positions.stop]), 200
+
   response = {
-    'transactions': blockchain.current_transactions,
-    'length': len(blockchain.current_transactions),
+    'transactions': current_transactions[positions.start:positions.stop],
+    'length': len(current_transactions),
+    'session': snapshot['session'],
+    'seq': snapshot['seq'],
   }
+  if request.args.get("limit") is not None:
+    response['next'] = next_page(positions, len(current_transactions))
   return jsonify(response), 200
 
 @app.route('/transactions/status/update', methods=['POST'])
@@ -370,30 +1360,268 @@ def change_transaction_status():
     return 'Wrong status value, please only use accepted, rejected or pending', 400
   
   # Change the status of the inputted transactions
-  index = blockchain.change_transaction_status(values['ix_list'], values['status'], values['reviewer'])
+  index, ticket = blockchain.change_transaction_status(values['ix_list'], values['status'], values['reviewer'])
+  current_transactions = blockchain.transactions_snapshot()['transactions']
   response = {
-    'transactions': blockchain.current_transactions,
-    'length': len(blockchain.current_transactions),
+    'transactions': current_transactions,
+    'length': len(current_transactions),
     'message': f'Transaction will be added to Block {index}'
   }
+
+  # All the transactions have been reviewed, tell how to follow the mining of the block
+  if ticket is not None:
+    response['mining'] = blockchain.mining_jobs.status(ticket)
   return jsonify(response), 201  
+
+def batch_item_error(item):
+  """
+  :param item: Item of a batch, a transaction to add or a review
+  :return: <str> What is wrong with the item, None if nothing is
+  """
+
+  if not isinstance(item, dict):
+    return 'Not an object'
+
+  if 'ix_list' in item:
+    if not all(k in item for k in ['ix_list', 'status', 'reviewer']):
+      return 'Missing values'
+    if not isinstance(item['ix_list'], list) or not all(isinstance(ix, int) for ix in item['ix_list']):
+      return 'Wrong ix_list value, please use a list of transaction indexes'
+    if not item['status'] in ['accepted', 'rejected', 'pending']:
+      return 'Wrong status value, please only use accepted, rejected or pending'
+    return None
+
+  if not all(k in item for k in ['doer', 'task', 'duration']):
+    return 'Missing values'
+  return None
+
+@app.route('/transactions/batch', methods=['POST'])
+def transactions_batch():
+  values = request.get_json()
+
+  items = values.get('items') if isinstance(values, dict) else None
+  if not isinstance(items, list) or not items:
+    return 'Missing items', 400
+  if len(items) > BATCH_MAX_ITEMS:
+    return f'Too many items, please send at most {BATCH_MAX_ITEMS}', 400
+
+  # Every item is checked before any is applied, so that a batch is applied whole or not at all
+  for position, item in enumerate(items):
+    error = batch_item_error(item)
+    if error is not None:
+      return f'Item {position}: {error}', 400
+
+  # Add and review the transactions, with a single gossip message for the whole batch
+  results, tickets = blockchain.apply_batch(items)
+  response = {
+    'results': results,
+    'length': len(blockchain.transactions_snapshot()['transactions']),
+  }
+
+  # Reviews sealed some blocks, tell how to follow their mining
+  if tickets:
+    response['mining'] = [blockchain.mining_jobs.status(ticket) for ticket in tickets]
+  return jsonify(response), 201
+
+@app.route('/mining/status', methods=['GET'])
+def mining_status():
+  args = request.args
+  ticket = args.get("ticket")
+  wait = args.get("wait", default=0, type=float)
+
+  if ticket is None:
+    response = {
+      'pending': blockchain.mining_jobs.pending(),
+      'jobs': blockchain.mining_jobs.status(),
+    }
+    return jsonify(response), 200
+
+  # Long-poll: hold the request until the block is mined or the wait is over
+  if wait > 0:
+    job = blockchain.mining_jobs.wait(ticket, min(wait, MINING_STATUS_MAX_WAIT))
+  else:
+    job = blockchain.mining_jobs.status(ticket)
+
+  if job is None:
+    return 'Unknown mining ticket', 404
+
+  return jsonify(job), 200
+
+@app.route('/events', methods=['GET'])
+def event_stream():
+  args = request.args
+  kinds = None
+  if args.get("types"):
+    kinds = set(args.get("types").split(','))
+    if not kinds <= set(events.KINDS):
+      return f'Wrong types value, please only use {", ".join(events.KINDS)}', 400
+
+  # A client coming back sends the cursor of the last event it got, the others get the events from now on
+  cursor = request.headers.get('Last-Event-ID', args.get("after"))
+  if cursor is None:
+    cursor = blockchain.events.cursor
+  session = blockchain.events.session
+
+  if 'text/event-stream' in request.headers.get('Accept', ''):
+    def stream(cursor):
+      while True:
+        found, cursor = blockchain.events.read(cursor, EVENTS_KEEPALIVE, kinds)
+        for event in found:
+          yield events.server_sent(event, session)
+        if not found:
+          # A comment, ignored by the client, keeps the connection from being closed by the proxies
+          yield b': keepalive\n\n'
+
+    # Sent as they come, without being cached or buffered on the way
+    return Response(stream(cursor), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'}), 200
+
+  # Long-poll: hold the request until an event comes or the wait is over
+  wait = min(max(args.get("wait", default=0, type=float), 0.0), EVENTS_MAX_WAIT)
+  found, cursor = blockchain.events.read(cursor, wait, kinds)
+  return jsonify({'events': found, 'cursor': cursor}), 200
   
+@app.route('/doers/<doer>/balance', methods=['GET'])
+def doer_balance(doer):
+  blockchain.follow_ledger()
+  return jsonify(blockchain.ledger.balance(doer)), 200
+
+@app.route('/doers/<doer>/history', methods=['GET'])
+def doer_history(doer):
+  args = request.args
+  cursor = args.get("cursor", default=0, type=int)
+  limit = args.get("limit", default=HISTORY_PAGE, type=int)
+  if cursor < 0 or limit < 1:
+    return 'Wrong cursor or limit value', 400
+  limit = min(limit, HISTORY_MAX_PAGE)
+
+  # Only the transactions of the page are read from the chain
+  blockchain.follow_ledger()
+  positions = blockchain.ledger.history(doer, cursor, limit)
+  chain = blockchain.chain_snapshot()
+  history = [{
+    'block': index,
+    'position': position,
+    'transaction': chain[index - 1]['transactions'][position],
+  } for index, position in positions]
+
+  response = {
+    'doer': doer,
+    'history': history,
+    'next_cursor': cursor + len(history) if len(history) == limit else None,
+  }
+  return jsonify(response), 200
+
+@app.route('/blocks/<int:index>/proof/<int:position>', methods=['GET'])
+def transaction_proof(index, position):
+  chain = blockchain.chain_snapshot()
+  if not 1 <= index <= len(chain):
+    return 'Unknown block', 404
+  block = chain[index - 1]
+  if 'merkle_root' not in block:
+    return 'Block mined without a Merkle root', 404
+  if not 0 <= position < len(block['transactions']):
+    return 'Unknown transaction', 404
+
+  # Enough for a client holding the headers to check that the transaction is in the chain
+  response = {
+    'block': index,
+    'position': position,
+    'transaction': block['transactions'][position],
+    'header': encoding.header(block),
+    'proof': merkle.proof(block['transactions'], position),
+  }
+  return jsonify(response), 200
+
 @app.route('/chain', methods=['GET'])
 def full_chain():
+  chain = blockchain.chain_snapshot()
+  # The chain only changes with its last block, whose hash tags the answer
+  tip = chain.tip
+  if request.if_none_match.contains(tip):
+    response = Response(status=304)
+    response.set_etag(tip)
+    return response
+
+  # Only send the blocks of the page asked for, from the given index to the end of the chain by default
+  positions = page(len(chain))
+  if positions is None:
+    return 'Wrong limit value', 400
+
+  # Blocks are sent as the canonical bytes they were stored with, without encoding them again
+  if request.args.get("format") == 'ndjson':
+    response = streamed(chain.raw(height) for height in positions)
+  else:
+    members = {'length': len(chain)}
+    if request.args.get("limit") is not None:
+      members['next'] = next_page(positions, len(chain))
+    blocks = [chain.raw(height) for height in positions]
+    response = Response(encoding.chain_document(blocks, **members), mimetype='application/json')
+
+  response.set_etag(tip)
+  return response, 200
+
+@app.route('/headers', methods=['GET'])
+def block_headers():
+  chain = blockchain.chain_snapshot()
+  # Same as /chain, without the transactions of the blocks that have a Merkle root
+  tip = chain.tip
+  if request.if_none_match.contains(tip):
+    response = Response(status=304)
+    response.set_etag(tip)
+    return response
+
+  positions = page(len(chain))
+  if positions is None:
+    return 'Wrong limit value', 400
+
+  if request.args.get("format") == 'ndjson':
+    response = streamed(encoding.canonical(chain.header(height)) for height in positions)
+  else:
+    response = {
+      'headers': [chain.header(height) for height in positions],
+      'length': len(chain)
+    }
+    if request.args.get("limit") is not None:
+      response['next'] = next_page(positions, len(chain))
+    response = jsonify(response)
+
+  response.set_etag(tip)
+  return response, 200
+
+@app.route('/chain/head', methods=['GET'])
+def chain_head():
+  # The header is enough, a light node doesn't download the transactions of the block
+  chain = blockchain.chain_snapshot()
   response = {
-    'chain': blockchain.chain,
-    'length': len(blockchain.chain)
+    'length': len(chain),
+    'index': chain.header(-1)['index'],
+    'hash': chain.tip,
   }
   return jsonify(response), 200
 
 @app.route('/nodes', methods=['GET'])
 def nodes():
+  # The version of the list of live nodes tells the clients when it changed
+  nodes = blockchain.nodes
   response = {
-    'nodes': list(blockchain.nodes),
-    'length': len(list(blockchain.nodes)),
+    'nodes': list(nodes),
+    'length': len(nodes),
+    'version': blockchain.membership.version,
   }
   return jsonify(response), 200
 
+@app.route('/nodes/gossip', methods=['POST'])
+def gossip_nodes():
+  values = request.get_json()
+
+  # Check that the required fields are in the POST'ed data
+  required = ['origin', 'members']
+  if not all(k in values for k in required):
+    return 'Missing values', 400
+
+  response = {'members': blockchain.merge_members(values)}
+  return jsonify(response), 200
+
 @app.route('/nodes/register', methods=['POST'])
 def register_nodes():
   values = request.get_json()
@@ -415,43 +1643,105 @@ def register_nodes():
 def consensus():
   args = request.args
   reset_transactions = args.get("reset_transactions", default=0, type=int)
-  replaced = blockchain.resolve_conflicts_chain()
+  # A node announcing its new blocks sends its address and the nodes it told about them
+  announcer = args.get("node")
+  with profiling.span('resolve_conflicts_chain'):
+    replaced = blockchain.resolve_conflicts_chain(announcer)
+  if replaced and announcer is not None:
+    blockchain.pass_on_chain(args.get("reached", default='').split(','))
 
-  if replaced:
-    response = {
-      'message': 'Our chain was replaced',
-      'new_chain': blockchain.chain
-    }
-    if reset_transactions == 1:
-      blockchain.reset_transactions()
-  else:
-    response = {
-      'message': 'Our chain is authoritative',
-      'chain': blockchain.chain
-    }
+  if replaced and reset_transactions == 1:
+    blockchain.reset_transactions()
+
+  # Only the head of our chain is sent back, announcements are frequent and GET /chain serves the blocks
+  snapshot = blockchain.chain_snapshot()
+  response = {
+    'message': 'Our chain was replaced' if replaced else 'Our chain is authoritative',
+    'length': len(snapshot),
+    'hash': snapshot.tip,
+  }
 
   return jsonify(response), 200
 
+@app.route('/transactions/delta', methods=['POST'])
+def apply_transaction_changes():
+  values = request.get_json()
+
+  # Check that the required fields are in the POST'ed data
+  required = ['origin', 'session', 'seq', 'changes']
+  if not all(k in values for k in required):
+    return 'Missing values', 400
+
+  index = blockchain.apply_transaction_changes(values)
+
+  response = {
+    'length': len(blockchain.current_transactions),
+    'message': f'Transaction will be added to Block {index}'
+  }
+
+  return jsonify(response), 201
+
 @app.route('/transactions/update', methods=['POST'])
 def update_transaction_list():
   values = request.get_json()
   
   index = blockchain.update_transaction_list(values['transactions'])
   
+  current_transactions = blockchain.transactions_snapshot()['transactions']
   response = {
-    'transactions': blockchain.current_transactions,
-    'length': len(blockchain.current_transactions),
+    'transactions': current_transactions,
+    'length': len(current_transactions),
     'message': f'Transaction will be added to Block {index}'
   }
   
   return jsonify(response), 201
 
+@app.route('/metrics', methods=['GET'])
+def export_metrics():
+  return Response(metrics.registry.expose(), content_type='text/plain; version=0.0.4; charset=utf-8'), 200
+
+@app.route('/debug/profiles', methods=['GET'])
+def list_profiles():
+  if not PROFILING:
+    return 'Profiling is off, start the node with --profiling', 404
+  return jsonify({'profiles': profiles.summaries()}), 200
+
+@app.route('/debug/profiles/<profile_id>', methods=['GET'])
+def show_profile(profile_id):
+  if not PROFILING:
+    return 'Profiling is off, start the node with --profiling', 404
+  profile = profiles.get(profile_id)
+  if profile is None:
+    return 'Unknown profile', 404
+
+  # The calls as printed by pstats, or the sampled stacks folded for flame graph tools
+  output = request.args.get("format")
+  if output == 'text':
+    text = profile.text()
+  elif output == 'folded':
+    text = profile.folded()
+  else:
+    return jsonify(profile.document()), 200
+
+  if text is None:
+    return f'No {output} output for a profile taken with {profile.mode}', 404
+  return Response(text, mimetype='text/plain'), 200
+
 if __name__ == '__main__':
   from argparse import ArgumentParser
   
   parser = ArgumentParser()
   parser.add_argument('-p', '--port', default=PORT, type=int, help='port to listen on')
+  parser.add_argument('-w', '--workers', default=MINER_WORKERS, type=int, help='number of mining processes, 0 for one per core')
+  parser.add_argument('--no-metrics', action='store_true', help='stop recording the measures served on /metrics')
+  parser.add_argument('--profiling', action='store_true', help='profile the requests asking for it, served on /debug/profiles')
   args = parser.parse_args()
   port = args.port
   
+  # The address and the data directory follow the port, two nodes of the same host don't share their chain
+  own_blockchain = Blockchain(miner=mining.make_miner(args.workers), data_dir=f"data/{port}", port=str(port))
+  if args.no_metrics:
+    metrics.registry.enabled = False
+  PROFILING = args.profiling
+  
   app.run(host=HOST, port=port)
\ No newline at end of file
@@ -0,0 +1,170 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from time import sleep
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from common import metrics, profiling
+
+logger = logging.getLogger(__name__)
+
+# Measures of the calls to every peer, failed calls included
+PEER_SECONDS = metrics.registry.histogram('chores_peer_request_seconds', 'Seconds spent calling another node', ('peer', 'method'))
+PEER_ERRORS = metrics.registry.counter('chores_peer_errors_total', 'Calls to another node that failed', ('peer', 'method', 'kind'))
+
+
+class HTTPTransport:
+    """
+    Calls the other nodes over HTTP, with a keep-alive session per node
+    """
+
+    def __init__(self, pool_size=8):
+      """
+      :param pool_size: <int> Number of connections kept open to every node
+      """
+
+      self.pool_size = pool_size
+      self._sessions = {}
+      self._lock = threading.Lock()
+
+    def _session(self, node):
+      with self._lock:
+        session = self._sessions.get(node)
+        if session is None:
+          session = requests.Session()
+          session.mount('http://', HTTPAdapter(pool_maxsize=self.pool_size))
+          self._sessions[node] = session
+        return session
+
+    def request(self, node, method, path, **kwargs):
+      """
+      :param node: Address of the node. Eg. '192.168.0.5:5000'
+      :param method: HTTP method
+      :param path: Path of the endpoint. Eg. '/chain'
+      :return: The response of the node, raises ConnectionError or requests.RequestException if it can't be reached
+      """
+
+      return self._session(node).request(method, f'http://{node}{path}', **kwargs)
+
+    def forget(self, node):
+      with self._lock:
+        session = self._sessions.pop(node, None)
+      if session is not None:
+        session.close()
+
+    def close(self):
+      with self._lock:
+        sessions, self._sessions = list(self._sessions.values()), {}
+      for session in sessions:
+        session.close()
+
+
+class Broadcaster:
+    """
+    Sends requests to the other nodes of the network
+
+    Calls go through a transport, HTTP with a keep-alive session per peer
+    unless another one is given. Calls time out instead of hanging, failed
+    calls are retried with an exponential backoff, and a broadcast reaches
+    all the peers at the same time from a thread pool, so it takes as long
+    as the slowest peer and a dead peer can't hold the rest.
+    """
+
+    def __init__(self, timeout=5, retries=2, backoff=0.2, workers=8, transport=None):
+      """
+      :param timeout: <float> Seconds to wait for a peer to answer
+      :param retries: <int> Number of times a failed call is tried again
+      :param backoff: <float> Seconds to wait before the first retry, doubled on every retry
+      :param workers: <int> Number of peers called at the same time
+      :param transport: Object whose request method calls a node, HTTP if not given
+      """
+
+      self.timeout = timeout
+      self.retries = retries
+      self.backoff = backoff
+      self.workers = workers
+      self.transport = transport or HTTPTransport(workers)
+      self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='broadcast')
+      self.closed = False
+
+    def request(self, node, method, path, required=False, **kwargs):
+      """
+      Call a single node
+
+      :param node: Address of the node. Eg. '192.168.0.5:5000'
+      :param method: HTTP method
+      :param path: Path of the endpoint. Eg. '/chain'
+      :param required: True to raise the error when the node can't be reached, instead of returning None
+      :return: The response, None if the node could not be reached
+      """
+
+      kwargs.setdefault('timeout', self.timeout)
+      delay = self.backoff
+
+      for attempt in range(self.retries + 1):
+        try:
+          with profiling.span(f'{method} {node}{path}'), PEER_SECONDS.time(node, method):
+            response = self.transport.request(node, method, path, **kwargs)
+        except (requests.RequestException, ConnectionError) as error:
+          PEER_ERRORS.inc(node, method, 'unreachable')
+          if attempt == self.retries:
+            logger.warning('%s %s on %s failed: %s', method, path, node, error)
+            if required:
+              raise
+            return None
+        else:
+          # Errors on the node side may go away, the other answers are final
+          if response.status_code >= 500:
+            PEER_ERRORS.inc(node, method, 'server')
+          if response.status_code < 500 or attempt == self.retries:
+            return response
+
+        sleep(delay)
+        delay *= 2
+
+    def broadcast(self, nodes, method, path, **kwargs):
+      """
+      Call several nodes at the same time and wait for all of them
+
+      :param nodes: Addresses of the nodes
+      :param method: HTTP method
+      :param path: Path of the endpoint
+      :return: <dict> The response of every node, None for the nodes that could not be reached
+      """
+
+      # The background threads of the node may still broadcast once it is closed
+      if self.closed:
+        return dict.fromkeys(nodes)
+
+      # The calls made by the pool count in the profile of the request broadcasting
+      request = profiling.bind(self.request)
+      futures = {node: self._executor.submit(request, node, method, path, **kwargs) for node in nodes}
+      return {node: future.result() for node, future in futures.items()}
+
+    def send(self, nodes, method, path, **kwargs):
+      """
+      Call several nodes at the same time without waiting for them, eg. to pass on a message
+
+      :param nodes: Addresses of the nodes
+      :param method: HTTP method
+      :param path: Path of the endpoint
+      """
+
+      if self.closed:
+        return
+      for node in nodes:
+        self._executor.submit(self.request, node, method, path, **kwargs)
+
+    def forget(self, node):
+      """
+      Close the connections to a node that left the network
+      """
+
+      self.transport.forget(node)
+
+    def close(self):
+      self.closed = True
+      self.transport.close()
+      self._executor.shutdown(wait=False)
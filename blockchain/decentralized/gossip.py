@@ -0,0 +1,121 @@
+import threading
+from uuid import uuid4
+
+
+class TransactionGossip:
+    """
+    Numbering of the changes to the current transactions sent between nodes
+
+    Instead of the whole list of transactions, nodes send the changes they
+    make to it. Every node numbers its messages from 1 in a session that
+    starts when the node starts, so that the receivers can drop the messages
+    they have already applied, put back in order the ones that arrive out of
+    order, and notice when one is missing.
+    """
+
+    def __init__(self, origin, max_gap=16):
+      """
+      :param origin: Address of our node
+      :param max_gap: Number of messages kept waiting for a missing one before giving up on it
+      """
+
+      self.origin = origin
+      self.session = uuid4().hex
+      self.seq = 0
+      self.max_gap = max_gap
+      # Last message applied and messages waiting for a missing one, by origin and session
+      self._applied = {}
+      self._waiting = {}
+      self._lock = threading.Lock()
+
+    def message(self, changes):
+      """
+      Number the changes made by our node
+
+      :param changes: <list> Changes to the current transactions
+      :return: <dict> The message to send to the other nodes
+      """
+
+      with self._lock:
+        self.seq += 1
+        return {
+          'origin': self.origin,
+          'session': self.session,
+          'seq': self.seq,
+          'changes': changes,
+        }
+
+    def known(self, message):
+      """
+      :param message: <dict> Message built by message() on another node
+      :return: True if the message was already applied or is waiting for a missing one,
+               a message relayed by several nodes arrives more than once
+      """
+
+      key = (message['origin'], message['session'])
+      with self._lock:
+        return message['seq'] <= self._applied.get(key, 0) or message['seq'] in self._waiting.get(key, ())
+
+    def receive(self, message):
+      """
+      Sort out a message sent by another node
+
+      :param message: <dict> Message built by message() on the other node
+      :return: <list> The lists of changes ready to be applied, in order, None if the
+               current transactions must be fetched again from the origin of the message
+      """
+
+      key = (message['origin'], message['session'])
+      seq = message['seq']
+
+      with self._lock:
+        last = self._applied.get(key)
+        if last is None:
+          # The first message of a session can only be checked when it is the very first one
+          if seq != 1:
+            return None
+          last = 0
+
+        if seq <= last:
+          return []
+
+        waiting = self._waiting.setdefault(key, {})
+        waiting[seq] = message['changes']
+
+        ready = []
+        while last + 1 in waiting:
+          last += 1
+          ready.append(waiting.pop(last))
+        self._applied[key] = last
+
+        if len(waiting) >= self.max_gap:
+          return None
+
+        return ready
+
+    def resynced(self, origin, session, seq):
+      """
+      Record that the current transactions were fetched from a node
+
+      :param origin: Address of the node
+      :param session: Session of the node
+      :param seq: <int> Last message sent by the node when its transactions were fetched
+      """
+
+      key = (origin, session)
+      with self._lock:
+        self._applied[key] = max(seq, self._applied.get(key, 0))
+        waiting = self._waiting.pop(key, {})
+
+        # The messages sent after the fetch still have to be applied
+        ready = []
+        last = self._applied[key]
+        for later in sorted(number for number in waiting if number > last):
+          if later != last + 1:
+            self._waiting[key] = {number: waiting[number] for number in waiting if number >= later}
+            break
+          ready.append(waiting[later])
+          last = later
+        self._applied[key] = last
+
+        return ready
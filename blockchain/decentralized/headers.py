@@ -0,0 +1,152 @@
+import threading
+from collections import OrderedDict
+from collections.abc import Sequence
+
+from common import encoding, merkle, records, storage
+
+# Number of downloaded block bodies kept in memory
+CACHE_SIZE = 64
+
+
+class HeaderChain(Sequence):
+    """
+    Chain of a light node, that only holds the headers of the blocks
+
+    The transactions of a block are downloaded from another node when the
+    block is accessed, and checked against the Merkle root of its header.
+    Only the last ones read are kept, as Transaction records, along with
+    the transactions of the blocks mined by our node. Blocks without a
+    Merkle root are hashed whole, so they are kept whole.
+    """
+
+    def __init__(self, fetch):
+      """
+      :param fetch: Function returning the copies of the block at a given height held by other nodes
+      """
+
+      self._fetch = fetch
+      self._headers = []
+      self._hashes = []
+      self._mined = {}
+      self._cache = OrderedDict()
+      self._lock = threading.RLock()
+      # Bumped whenever blocks are dropped, see storage.ChainSnapshot
+      self.generation = 0
+
+    def __len__(self):
+      return len(self._headers)
+
+    def snapshot(self):
+      """
+      :return: <ChainSnapshot> The chain as it is now
+      """
+
+      return storage.ChainSnapshot(self)
+
+    def hash(self, height):
+      """
+      :param height: <int> Position of the block in the chain
+      :return: <str> The hash of the block
+      """
+
+      return self._hashes[height]
+
+    def header(self, height):
+      """
+      :param height: <int> Position of the block in the chain
+      :return: <dict> The part of the block covered by its hash
+      """
+
+      return self._headers[height]
+
+    def __getitem__(self, height):
+      if isinstance(height, slice):
+        return [self[i] for i in range(*height.indices(len(self)))]
+
+      with self._lock:
+        if height < 0:
+          height += len(self)
+        if not 0 <= height < len(self):
+          raise IndexError('block index out of range')
+
+        header = self._headers[height]
+        if 'merkle_root' not in header:
+          return header
+
+        transactions = self._mined.get(height)
+        if transactions is None:
+          transactions = self._cache.get(height)
+          if transactions is not None:
+            self._cache.move_to_end(height)
+        if transactions is not None:
+          return dict(header, transactions=[transaction.to_dict() for transaction in transactions])
+
+      return dict(header, transactions=self._download(height, header))
+
+    def _download(self, height, header):
+      block_hash = self._hashes[height]
+      for block in self._fetch(height):
+        if encoding.block_hash(block) == block_hash and merkle.root(block.get('transactions', [])) == header['merkle_root']:
+          with self._lock:
+            # The chain may have been replaced meanwhile
+            if height < len(self) and self._hashes[height] == block_hash:
+              self._cache[height] = records.transactions_from(block['transactions'])
+              while len(self._cache) > CACHE_SIZE:
+                self._cache.popitem(last=False)
+          return block['transactions']
+
+      raise LookupError(f'No node sent the transactions of block {height + 1}')
+
+    def raw(self, height):
+      """
+      :param height: <int> Position of the block in the chain
+      :return: <bytes> The canonical bytes of the block
+      """
+
+      return encoding.canonical(self[height])
+
+    def append(self, block, block_hash=None):
+      """
+      Add a block, or the header of a block, at the end of the chain
+
+      :param block: <dict> Block, the transactions are kept if given
+      :param block_hash: <str> Hash of the block, computed if not given
+      """
+
+      with self._lock:
+        # The length is read from the headers without the lock, see storage.ChainSnapshot, the header
+        # is only counted once its hash and its transactions can be read
+        self._hashes.append(block_hash or encoding.block_hash(block))
+        if 'merkle_root' in block and 'transactions' in block:
+          self._mined[len(self)] = records.transactions_from(block['transactions'])
+        self._headers.append(encoding.hashed(block))
+
+    def extend(self, blocks, hashes=None):
+      for position, block in enumerate(blocks):
+        self.append(block, hashes[position] if hashes else None)
+
+    def truncate(self, height):
+      with self._lock:
+        if height >= len(self):
+          return
+        # Bumped before and after, see storage.ChainSnapshot
+        self.generation += 1
+        del self._headers[height:]
+        del self._hashes[height:]
+        for kept in (self._mined, self._cache):
+          for dropped in [dropped for dropped in kept if dropped >= height]:
+            del kept[dropped]
+        self.generation += 1
+
+    def replace(self, blocks, start=0, hashes=None):
+      """
+      Replace the chain from the given height on
+
+      :param blocks: Headers of a valid blockchain, or of the part of it starting at the given height
+      :param start: <int> Height of the first of the given blocks
+      :param hashes: <list> Hash of every given block, computed again if not given
+      """
+
+      with self._lock:
+        self.truncate(start)
+        self.extend(blocks, hashes)
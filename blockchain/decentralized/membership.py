@@ -0,0 +1,166 @@
+import random
+import threading
+from time import time
+
+
+class Membership:
+    """
+    Nodes of the network known to our node, kept up to date by gossip
+
+    Every node counts its own heartbeats, one more on every round of gossip,
+    in a generation that starts when the node starts, so that a restarted
+    node is newer than it was. Every round, a node sends the version of
+    every live member it knows, [generation, heartbeat], to a few peers picked
+    at random, and takes the newer versions of the ones they send back.
+
+    A member whose version hasn't moved for fail_after seconds is taken for
+    dead: it is no longer called nor sent to the peers, and it is forgotten
+    after remove_after seconds unless a newer version of it comes meanwhile.
+
+    Broadcasts only reach the active peers, at most max_active of the live
+    members picked at random. One of them is swapped every round, so that
+    every node ends up called by some others.
+    """
+
+    def __init__(self, address, fanout=3, max_active=8, fail_after=10, remove_after=30, now=0.0):
+      """
+      :param address: Address of our node. Eg. '192.168.0.5:5000'
+      :param fanout: <int> Number of peers sent our members every round
+      :param max_active: <int> Most peers a broadcast reaches
+      :param fail_after: <float> Seconds without a newer version before a member is taken for dead
+      :param remove_after: <float> Seconds without a newer version before a member is forgotten
+      :param now: <float> Current time, on a clock that only goes forward
+      """
+
+      self.address = address
+      self.fanout = fanout
+      self.max_active = max_active
+      self.fail_after = fail_after
+      self.remove_after = remove_after
+
+      # Version of every member, and when it last changed on our clock
+      self._versions = {address: (int(time() * 1000), 0)}
+      self._updated = {address: now}
+      self._dead = set()
+      self._active = []
+      # Number of the list of live members, one more every time a member joins, dies or comes back
+      self.version = 1
+      self._random = random.Random()
+      self._lock = threading.Lock()
+
+    def add(self, address, now):
+      """
+      Add a node registering with ours, it is called right away by the broadcasts
+
+      :param address: Address of the node
+      :param now: <float> Current time
+      :return: True if the node wasn't known
+      """
+
+      with self._lock:
+        if address in self._versions:
+          return False
+        # Any version the node sends is newer
+        self._versions[address] = (0, 0)
+        self._updated[address] = now
+        self.version += 1
+
+        if len(self._active) >= self.max_active:
+          self._active.pop(self._random.randrange(len(self._active)))
+        self._active.append(address)
+        return True
+
+    def live(self):
+      """
+      :return: <frozenset> Addresses of the members taken for alive, ours included
+      """
+
+      with self._lock:
+        return frozenset(self._versions.keys() - self._dead)
+
+    def digest(self):
+      """
+      :return: <dict> Version of every live member, as sent to the peers
+      """
+
+      with self._lock:
+        return {address: list(version) for address, version in self._versions.items() if address not in self._dead}
+
+    def merge(self, members, now):
+      """
+      Take the newer versions of the members sent by a peer
+
+      :param members: <dict> Version of every member, built by digest on the peer
+      :param now: <float> Current time
+      """
+
+      with self._lock:
+        for address, version in members.items():
+          version = tuple(version)
+          if address == self.address or version <= self._versions.get(address, (-1, -1)):
+            continue
+          if address not in self._versions or address in self._dead:
+            self._dead.discard(address)
+            self.version += 1
+          self._versions[address] = version
+          self._updated[address] = now
+
+    def beat(self, now):
+      """
+      Count a heartbeat of our node and look for the members that stopped beating
+
+      :param now: <float> Current time
+      :return: <list> Addresses of the members forgotten
+      """
+
+      with self._lock:
+        generation, heartbeat = self._versions[self.address]
+        self._versions[self.address] = (generation, heartbeat + 1)
+        self._updated[self.address] = now
+
+        removed = []
+        for address, updated in list(self._updated.items()):
+          if now - updated >= self.remove_after:
+            del self._versions[address], self._updated[address]
+            self._dead.discard(address)
+            removed.append(address)
+          elif now - updated >= self.fail_after and address not in self._dead:
+            self._dead.add(address)
+            self.version += 1
+        return removed
+
+    def pick(self):
+      """
+      :return: <list> Peers to send our members to this round, fanout live ones and a dead one,
+               in case it only was out of reach
+      """
+
+      with self._lock:
+        live = [address for address in self._versions if address not in self._dead and address != self.address]
+        peers = self._random.sample(live, min(self.fanout, len(live)))
+        if self._dead:
+          peers.append(self._random.choice(sorted(self._dead)))
+        return peers
+
+    def active(self):
+      """
+      :return: <list> The peers broadcasts reach, filled up with live members when some died
+      """
+
+      with self._lock:
+        self._active = [address for address in self._active if address in self._versions and address not in self._dead]
+        spare = [address for address in self._versions if address not in self._dead and address != self.address and address not in self._active]
+        if len(self._active) < self.max_active and spare:
+          self._active += self._random.sample(spare, min(self.max_active - len(self._active), len(spare)))
+        return list(self._active)
+
+    def shuffle(self):
+      """
+      Swap one of the active peers for a live member that isn't one, if there is any
+      """
+
+      active = self.active()
+      with self._lock:
+        spare = [address for address in self._versions if address not in self._dead and address != self.address and address not in active]
+        if spare and self._active:
+          self._active[self._random.randrange(len(self._active))] = self._random.choice(spare)
@@ -0,0 +1,348 @@
+"""
+Simulation of a network of decentralized nodes in a single process
+
+The nodes are real Blockchain instances; the calls between them go to the
+routes of the node called through the Flask test client instead of HTTP,
+with a configurable latency, drop rate and partitions. A chore workload
+is replayed on the nodes while the heads of their chains are watched, and
+the propagation delay of the blocks, the fork rate, the time the nodes take
+to agree on a chain and the bytes sent between them are reported as JSON:
+
+    python -m decentralized.simulator --nodes 5 --chores 200 --latency 0.01 --drop-rate 0.02
+"""
+import contextvars
+import json
+import logging
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import threading
+from argparse import ArgumentParser
+from time import monotonic, sleep
+
+# The node creates its data directory and its Blockchain when it is imported, away from the real data
+_cwd = os.getcwd()
+_workdir = tempfile.mkdtemp(prefix='chores-simulator-')
+os.chdir(_workdir)
+
+from common import encoding, mining, sealing
+
+from . import blockchain as node
+
+TASKS = ['Dishes', 'Laundry', 'Vacuum the living room', 'Take out the trash', 'Water the plants']
+DURATIONS = [0.25, 0.5, 1, 1.5, 2]
+
+
+class SimulatedResponse:
+    """
+    Answer of a simulated node, with the parts of requests.Response the nodes use
+    """
+
+    def __init__(self, status_code, content):
+      self.status_code = status_code
+      self.content = content
+
+    def json(self):
+      return encoding.loads(self.content)
+
+    def iter_lines(self):
+      return iter(self.content.split(b'\n'))
+
+
+class Network:
+    """
+    Delivers the calls between the simulated nodes
+
+    Every call waits for the latency on the way there and on the way back.
+    Calls to a node that is not attached, in another partition or dropped
+    fail the way a node that can't be reached does.
+    """
+
+    def __init__(self, latency=0.0, jitter=0.0, drop_rate=0.0, seed=None):
+      """
+      :param latency: <float> Seconds a message takes to reach a node
+      :param jitter: <float> Largest number of seconds added to or taken from the latency
+      :param drop_rate: <float> Probability of a call being lost
+      :param seed: Seed of the random drops and delays
+      """
+
+      self.latency = latency
+      self.jitter = jitter
+      self.drop_rate = drop_rate
+      self.nodes = {}
+      self.messages = 0
+      self.bytes = 0
+      self.dropped = 0
+      self.client = node.app.test_client(use_cookies=False)
+      self._groups = None
+      self._random = random.Random(seed)
+      self._lock = threading.Lock()
+
+    def attach(self, address, blockchain):
+      self.nodes[address] = blockchain
+
+    def detach(self, address):
+      self.nodes.pop(address, None)
+
+    def partition(self, *groups):
+      """
+      Split the network, the nodes only reach the nodes of their own group
+
+      :param groups: Lists of addresses
+      """
+
+      self._groups = {address: number for number, group in enumerate(groups) for address in group}
+
+    def heal(self):
+      self._groups = None
+
+    def transport(self, address):
+      """
+      :param address: Address of the calling node
+      :return: <Transport> The transport the node calls the other ones with
+      """
+
+      return Transport(self, address)
+
+    def _wait(self):
+      with self._lock:
+        delay = self.latency + self._random.uniform(-self.jitter, self.jitter)
+      if delay > 0:
+        sleep(delay)
+
+    def deliver(self, source, target, method, path, params=None, json=None, **kwargs):
+      """
+      :return: <SimulatedResponse> The answer of the target node
+      """
+
+      with self._lock:
+        lost = self._random.random() < self.drop_rate
+        separated = self._groups is not None and self._groups.get(source) != self._groups.get(target)
+
+      self._wait()
+      blockchain = self.nodes.get(target)
+      if blockchain is None or lost or separated:
+        with self._lock:
+          self.dropped += 1
+        raise ConnectionError(f'{target} can not be reached from {source}')
+
+      body = encoding.canonical(json) if json is not None else b''
+
+      def call():
+        # The routes answer for the node called, a route failing answers 500 as the server of a node does
+        node.called_node.set(blockchain)
+        response = self.client.open(path, method=method, query_string=params, data=body,
+                                    content_type='application/json' if json is not None else None)
+        return response.status_code, response.get_data()
+
+      # A call made while answering another one starts afresh, outside the Flask context of the caller
+      status, content = contextvars.Context().run(call)
+
+      with self._lock:
+        self.messages += 1
+        self.bytes += len(body) + len(content)
+      self._wait()
+      return SimulatedResponse(status, content)
+
+
+class Transport:
+    """
+    Transport of a simulated node, see broadcast.HTTPTransport
+    """
+
+    def __init__(self, network, address):
+      self.network = network
+      self.address = address
+
+    def request(self, node, method, path, **kwargs):
+      return self.network.deliver(self.address, node, method, path, **kwargs)
+
+    def forget(self, node):
+      pass
+
+    def close(self):
+      pass
+
+
+class Simulation:
+    """
+    A network of nodes replaying a chore workload, and what was seen of their chains
+    """
+
+    def __init__(self, nodes=4, light=0, latency=0.0, jitter=0.0, drop_rate=0.0, seed=None, poll=0.005):
+      """
+      :param nodes: <int> Number of nodes, the first one is the master node
+      :param light: <int> Number of those nodes running in light mode
+      :param poll: <float> Seconds between two looks at the chains of the nodes
+      """
+
+      self.network = Network(latency, jitter, drop_rate, seed)
+      self.addresses = [f'10.0.0.{number + 1}:5000' for number in range(nodes)]
+      self.poll = poll
+      self._random = random.Random(seed)
+
+      # A node only answers once it is built, like a node whose server is not started yet
+      self.nodes = []
+      for number, address in enumerate(self.addresses):
+        host, port = address.split(':')
+        blockchain = node.Blockchain(
+          miner=mining.SerialMiner(),
+          data_dir=None,
+          light=number >= nodes - light,
+          host=host,
+          port=port,
+          master_node=self.addresses[0],
+          transport=self.network.transport(address),
+        )
+        self.network.attach(address, blockchain)
+        self.nodes.append(blockchain)
+
+      # When every node first held every block, by hash of the block
+      self.seen = {}
+      self._watching = threading.Event()
+      self._watcher = threading.Thread(target=self._watch, name='simulation-watcher', daemon=True)
+      self._watching.set()
+      self._watcher.start()
+
+    def _watch(self):
+      while self._watching.is_set():
+        self.look()
+        sleep(self.poll)
+
+    def look(self):
+      now = monotonic()
+      for address, blockchain in zip(self.addresses, self.nodes):
+        length = len(blockchain.chain)
+        for height in range(max(0, length - 8), length):
+          try:
+            block_hash = blockchain.chain.hash(height)
+          except IndexError:
+            # The chain was replaced meanwhile
+            break
+          self.seen.setdefault(block_hash, {}).setdefault(address, now)
+
+    def replay(self, chores, doers=5, review_every=10, pace=0.0, partition_chores=0):
+      """
+      Add chores on random nodes, and review all the pending ones on a random node every few chores
+
+      :param chores: <int> Number of chores
+      :param doers: <int> Number of people doing them
+      :param review_every: <int> Number of chores between two reviews, every review seals a Block
+      :param pace: <float> Seconds between two chores
+      :param partition_chores: <int> Number of chores replayed with the network split in two halves
+      """
+
+      if partition_chores:
+        half = len(self.addresses) // 2
+        self.network.partition(self.addresses[:half], self.addresses[half:])
+
+      for number in range(chores):
+        if number == partition_chores:
+          self.network.heal()
+
+        blockchain = self._random.choice(self.nodes)
+        blockchain.new_transaction(f'doer {self._random.randrange(doers)}', self._random.choice(TASKS), self._random.choice(DURATIONS))
+
+        if (number + 1) % review_every == 0:
+          reviewer = self._random.choice(self.nodes)
+          pending = [transaction['index'] for transaction in reviewer.transactions_snapshot()['transactions'] if transaction['status'] == 'pending']
+          reviewer.change_transaction_status(pending, 'accepted', 'reviewer')
+
+        if pace:
+          sleep(pace)
+
+      self.network.heal()
+
+    def converge(self, timeout=30):
+      """
+      Wait for the blocks being mined and for every node to hold the same chain
+
+      :return: <float> Seconds the nodes took to agree once the mining was over, None if they didn't within the timeout
+      """
+
+      deadline = monotonic() + timeout
+      while any(blockchain.mining_jobs.pending() for blockchain in self.nodes) and monotonic() < deadline:
+        sleep(self.poll)
+
+      start = monotonic()
+      while monotonic() < deadline:
+        if len({blockchain.chain.hash(-1) for blockchain in self.nodes}) == 1:
+          return monotonic() - start
+        sleep(self.poll)
+      return None
+
+    def report(self, convergence):
+      self._watching.clear()
+      self._watcher.join()
+      self.look()
+
+      # The chain of the master node is the one the network ended with
+      master = self.nodes[0]
+      final = {master.chain.hash(height) for height in range(1, len(master.chain))}
+      delays = [max(times.values()) - min(times.values()) for block_hash, times in self.seen.items() if block_hash in final and len(times) == len(self.nodes)]
+      mined = [block_hash for block_hash in self.seen if block_hash != master.chain.hash(0)]
+
+      return {
+        'nodes': len(self.nodes),
+        'blocks': len(final),
+        'blocks_seen': len(mined),
+        'fork_rate': (len(mined) - len(final)) / len(mined) if mined else 0.0,
+        'propagation_delay_mean': statistics.mean(delays) if delays else None,
+        'propagation_delay_max': max(delays) if delays else None,
+        'convergence_time': convergence,
+        'converged': convergence is not None,
+        'messages': self.network.messages,
+        'bytes': self.network.bytes,
+        'dropped': self.network.dropped,
+      }
+
+    def close(self):
+      self._watching.clear()
+      for blockchain in self.nodes:
+        blockchain.close()
+
+
+if __name__ == '__main__':
+  parser = ArgumentParser()
+  parser.add_argument('--nodes', default=4, type=int, help='number of nodes, the first one is the master node')
+  parser.add_argument('--light', default=0, type=int, help='number of light nodes among them')
+  parser.add_argument('--chores', default=100, type=int, help='number of chores replayed')
+  parser.add_argument('--doers', default=5, type=int, help='number of people doing the chores')
+  parser.add_argument('--review-every', default=10, type=int, help='chores between two reviews')
+  parser.add_argument('--pace', default=0.0, type=float, help='seconds between two chores')
+  parser.add_argument('--latency', default=0.005, type=float, help='seconds a message takes to reach a node')
+  parser.add_argument('--jitter', default=0.0, type=float, help='largest change of the latency, in seconds')
+  parser.add_argument('--drop-rate', default=0.0, type=float, help='probability of a call being lost')
+  parser.add_argument('--partition-chores', default=0, type=int, help='chores replayed with the network split in two')
+  parser.add_argument('--timeout', default=60, type=float, help='seconds to wait for the nodes to agree')
+  parser.add_argument('--seed', default=None, type=int, help='seed of the workload and of the network')
+  parser.add_argument('--max-difficulty', default=3, type=int, help='highest difficulty the nodes retarget to')
+  parser.add_argument('--sealing', default=node.SEALING_POLICY, choices=sealing.POLICIES, help='when the nodes hand the reviewed chores over to the miner')
+  parser.add_argument('--seal-max-transactions', default=node.SEAL_MAX_TRANSACTIONS, type=int, help='most chores in a block sealed by the count policy')
+  parser.add_argument('--seal-interval', default=node.SEAL_INTERVAL, type=float, help='seconds between two blocks sealed by the timer policy')
+  args = parser.parse_args()
+
+  # Blocks come much faster than in a household, a real difficulty would have the nodes mining all the time
+  node.MAX_DIFFICULTY = args.max_difficulty
+  node.SEALING_POLICY = args.sealing
+  node.SEAL_MAX_TRANSACTIONS = args.seal_max_transactions
+  node.SEAL_INTERVAL = args.seal_interval
+
+  # Calls lost on purpose are expected
+  logging.basicConfig(level=logging.ERROR)
+
+  try:
+    simulation = Simulation(args.nodes, args.light, args.latency, args.jitter, args.drop_rate, args.seed)
+    start = monotonic()
+    simulation.replay(args.chores, args.doers, args.review_every, args.pace, args.partition_chores)
+    convergence = simulation.converge(args.timeout)
+    report = simulation.report(convergence)
+    report['duration'] = monotonic() - start
+    simulation.close()
+  finally:
+    os.chdir(_cwd)
+    shutil.rmtree(_workdir, ignore_errors=True)
+
+  print(json.dumps(report, indent=2, sort_keys=True))
@@ -0,0 +1,195 @@
+import unittest
+from time import sleep, time
+
+# The benchmark moves to a directory of its own before the node is imported, the node creates its data directory there
+from common import benchmark, encoding, mining, sealing, storage
+
+node = benchmark.load_node('decentralized')
+from decentralized import headers, simulator
+from tests.test_storage import read_while_appending
+
+
+class DecentralizedTest(unittest.TestCase):
+
+    def setUp(self):
+      self.miner = mining.SerialMiner()
+      self.blockchain = node.Blockchain(miner=self.miner, data_dir=None, host='10.0.0.1', port='5000', master_node='10.0.0.1:5000')
+      self.other = node.Blockchain(miner=self.miner, data_dir=None, host='10.0.0.2', port='5000', master_node='10.0.0.2:5000')
+
+    def tearDown(self):
+      self.blockchain.close()
+      self.other.close()
+
+    def block(self, difficulty):
+      genesis = self.blockchain.chain[0]
+      last_hash = self.blockchain.chain.hash(0)
+      return {
+        'index': 2,
+        'timestamp': genesis['timestamp'] + 1,
+        'transactions': [],
+        'proof': self.miner.mine(genesis['proof'], last_hash, difficulty),
+        'previous_hash': last_hash,
+        'difficulty': difficulty,
+      }
+
+
+class DifficultyTest(DecentralizedTest):
+
+    def test_retargeted_difficulty_is_valid(self):
+      self.blockchain.mine_block([])
+      self.assertTrue(self.other.valid_chain(list(self.blockchain.chain)))
+
+    def test_benchmark_chain_is_valid(self):
+      benchmark.node = node
+      chain = list(benchmark.build_chain(20).chain)
+      self.assertEqual([block['difficulty'] for block in chain[-3:]], [node.MIN_DIFFICULTY] * 3)
+      self.assertTrue(self.other.valid_chain(chain))
+
+    def test_other_difficulty_is_invalid(self):
+      expected = self.blockchain.next_difficulty()
+      self.assertTrue(self.other.valid_chain([self.blockchain.chain[0], self.block(expected)]))
+      for difficulty in (expected - 1, expected + 1):
+        chain = [self.blockchain.chain[0], self.block(difficulty)]
+        self.assertFalse(self.other.valid_chain(chain), difficulty)
+
+    def test_mining_must_start_before_the_block(self):
+      block = self.block(self.blockchain.next_difficulty())
+      block['mining_started'] = block['timestamp'] + 1
+      self.assertFalse(self.other.valid_chain([self.blockchain.chain[0], block]))
+
+    def test_waiting_for_the_timer_doesnt_lower_the_difficulty(self):
+      blockchain = node.Blockchain(miner=self.miner, data_dir=None, host='10.0.0.3', port='5000', master_node='10.0.0.3:5000',
+                                   sealing_policy=sealing.make_policy('timer', interval=0.2, now=time()))
+      try:
+        blockchain.new_transaction('doer', 'Dishes', 0.5)
+        blockchain.change_transaction_status([1], 'accepted', 'reviewer')
+        # The reviewed transaction waits for the timer, for an hour as far as the block can tell
+        for transaction in blockchain.current_transactions:
+          transaction.timestamp -= 3600
+        difficulty = blockchain.last_block['difficulty']
+
+        deadline = time() + 10
+        while len(blockchain.chain) < 2 and time() < deadline:
+          sleep(0.05)
+        self.assertEqual(len(blockchain.chain), 2)
+        self.assertEqual(blockchain.last_block['difficulty'], difficulty)
+        # Finding the proof took less than the interval, the difficulty goes up
+        self.assertGreater(blockchain.next_difficulty(), difficulty)
+        self.assertTrue(self.other.valid_chain(list(blockchain.chain)))
+      finally:
+        blockchain.close()
+
+    def test_difficulty_must_be_an_int(self):
+      block = self.block(self.blockchain.next_difficulty())
+      block['difficulty'] = float(block['difficulty'])
+      self.assertFalse(self.other.valid_chain([self.blockchain.chain[0], block]))
+
+
+class LedgerTest(DecentralizedTest):
+
+    def test_blocks_are_counted_when_a_balance_is_read(self):
+      self.blockchain.new_transaction('doer', 'Dishes', 0.5)
+      _, ticket = self.blockchain.change_transaction_status([1], 'accepted', 'reviewer')
+      self.blockchain.mining_jobs.wait(ticket, 10)
+      self.assertEqual(len(self.blockchain.chain), 2)
+      self.assertEqual(len(self.blockchain.ledger), 0)
+
+      self.blockchain.follow_ledger()
+      self.assertEqual(len(self.blockchain.ledger), len(self.blockchain.chain))
+      self.assertEqual(self.blockchain.ledger.balance('doer')['accepted'], 0.5)
+
+
+class JoinTest(unittest.TestCase):
+
+    def test_joining_node_takes_the_chain_and_transactions(self):
+      network = simulator.Network()
+      master = node.Blockchain(miner=mining.SerialMiner(), data_dir=None, host='10.0.0.1', port='5000', master_node='10.0.0.1:5000', transport=network.transport('10.0.0.1:5000'))
+      network.attach('10.0.0.1:5000', master)
+      master.new_transaction('doer', 'Dishes', 0.5)
+
+      joining = node.Blockchain(miner=mining.SerialMiner(), data_dir=None, host='10.0.0.2', port='5000', master_node='10.0.0.1:5000', transport=network.transport('10.0.0.2:5000'))
+      try:
+        self.assertEqual(joining.chain.hash(-1), master.chain.hash(-1))
+        self.assertEqual(joining.current_transactions.to_dicts(), master.current_transactions.to_dicts())
+      finally:
+        joining.close()
+        master.close()
+
+
+class TimerSealingTest(unittest.TestCase):
+
+    def setUp(self):
+      for name, value in (('SEALING_POLICY', 'timer'), ('SEAL_INTERVAL', 0.3), ('MAX_DIFFICULTY', 2)):
+        self.addCleanup(setattr, node, name, getattr(node, name))
+        setattr(node, name, value)
+
+    def test_only_the_master_node_seals_on_the_timer(self):
+      simulation = simulator.Simulation(nodes=4, latency=0.001, seed=1)
+      try:
+        for review in range(4):
+          for number, blockchain in enumerate(simulation.nodes):
+            blockchain.new_transaction(f'doer {number}', 'Dishes', 0.5)
+          # The last chore stays pending, the reviewed ones wait for the timer
+          reviewer = simulation.nodes[review]
+          pending = [transaction['index'] for transaction in reviewer.transactions_snapshot()['transactions'] if transaction['status'] == 'pending']
+          reviewer.change_transaction_status(pending[:-1], 'accepted', 'reviewer')
+          sleep(0.5)
+        report = simulation.report(simulation.converge(30))
+      finally:
+        simulation.close()
+
+      self.assertTrue(report['converged'])
+      self.assertGreater(report['blocks'], 0)
+      self.assertEqual(report['fork_rate'], 0.0)
+
+
+class HeaderChainTest(unittest.TestCase):
+
+    def test_snapshots_taken_while_appending_are_whole(self):
+      read_while_appending(self, headers.HeaderChain(lambda height: []))
+
+
+class StreamTest(unittest.TestCase):
+
+    def test_replaced_chain_ends_with_an_error_record(self):
+      def documents():
+        yield b'{"index": 1}'
+        raise storage.ChainChanged('The chain was replaced while it was read')
+
+      with node.app.test_request_context():
+        lines = b''.join(node.streamed(documents()).response).splitlines()
+      self.assertEqual(lines[0], b'{"index": 1}')
+      self.assertIn('error', encoding.loads(lines[1]))
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def test_requests_are_not_profiled_by_default(self):
+      client = node.app.test_client()
+      response = client.get('/chain/resolve?profile=1')
+      self.assertEqual(response.status_code, 200)
+      self.assertNotIn('X-Profile-Id', response.headers)
+      self.assertEqual(client.get('/debug/profiles').status_code, 404)
+
+    def test_profiled_request_is_listed(self):
+      node.PROFILING = True
+      try:
+        client = node.app.test_client()
+        profile_id = client.get('/chain/resolve', headers={'X-Profile': 'cprofile'}).headers['X-Profile-Id']
+        ids = [profile['id'] for profile in client.get('/debug/profiles').get_json()['profiles']]
+      finally:
+        node.PROFILING = False
+      self.assertIn(profile_id, ids)
+
+
+class ResolveTest(unittest.TestCase):
+
+    def test_answers_with_the_head_only(self):
+      response = node.app.test_client().get('/chain/resolve')
+      chain = node.blockchain.chain_snapshot()
+      self.assertEqual(response.status_code, 200)
+      self.assertEqual(response.get_json(), {'message': 'Our chain is authoritative', 'length': len(chain), 'hash': chain.tip})
+
+
+if __name__ == '__main__':
+  unittest.main()
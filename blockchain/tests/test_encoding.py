@@ -0,0 +1,56 @@
+import hashlib
+import json
+import unittest
+
+from common import encoding
+
+
+def chore(index):
+  return {
+    'index': index,
+    'doer': f'doer {index % 7}',
+    'task': 'Dishes, laundry & ça été ✓ \U0001f9f9',
+    'duration': index * 0.25,
+    'status': 'accepted',
+    'reviewer': f'doer {index % 5}',
+    'timestamp': 1700000000.123456 + index,
+  }
+
+
+# Blocks as the nodes hash them, and documents with the values json.dumps is the most particular about
+SAMPLES = [
+  {'index': 1, 'timestamp': 1e16, 'transactions': [], 'proof': 100, 'previous_hash': '1'},
+  {'index': 42, 'timestamp': 1700000123.5, 'transactions': [chore(index) for index in range(100)], 'proof': 123456, 'difficulty': 4, 'previous_hash': '0' * 64},
+  {'floats': [0.1, -0.0, 1e-7, 1.5e300, 2 ** 53 + 1.0, 1 / 3], 'ints': [0, -1, 2 ** 64]},
+  {'z': {'b': {'d': 1, 'c': [{'y': 2, 'x': 1}]}, 'a': None}, 'A': [None, True, False], 'é': 'ü', '10': 1, '9': 2},
+  {'reviewer': None, 'note': None, 'status': 'pending', 'control': '\x00\t\n"\\/'},
+]
+
+
+class CanonicalTest(unittest.TestCase):
+
+    def test_bytes_are_the_ones_of_json_dumps(self):
+      for sample in SAMPLES:
+        self.assertEqual(encoding.canonical(sample), json.dumps(sample, sort_keys=True).encode())
+
+    def test_blocks_hash_as_before(self):
+      block = SAMPLES[1]
+      self.assertEqual(encoding.block_hash(block), hashlib.sha256(json.dumps(block, sort_keys=True).encode()).hexdigest())
+
+      header = dict(block, merkle_root='f' * 64)
+      del header['transactions']
+      self.assertEqual(encoding.block_hash(dict(header, transactions=block['transactions'])),
+                       hashlib.sha256(json.dumps(header, sort_keys=True).encode()).hexdigest())
+
+    def test_bytes_decode_to_the_document(self):
+      for sample in SAMPLES:
+        self.assertEqual(encoding.loads(encoding.canonical(sample)), sample)
+
+    def test_chain_document_is_the_one_of_json_dumps(self):
+      blocks = SAMPLES[:2]
+      document = encoding.chain_document([encoding.canonical(block) for block in blocks], length=len(blocks))
+      self.assertEqual(document, json.dumps({'chain': blocks, 'length': len(blocks)}, sort_keys=True).encode())
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,43 @@
+import unittest
+
+from common import mempool, records
+
+
+def chore(index, doer='doer'):
+  return {'id': f'{index:032x}', 'index': index, 'doer': doer, 'task': 'Dishes', 'duration': 0.5,
+          'timestamp': 1.0, 'status': 'pending', 'reviewer': ''}
+
+
+class MempoolTest(unittest.TestCase):
+
+    def setUp(self):
+      self.pool = mempool.Mempool(chore(index, doer=f'doer {index % 2}') for index in range(1, 5))
+
+    def test_only_changes_keeping_the_indexes_are_exposed(self):
+      for name in ('insert', 'extend', 'remove', 'pop', 'clear', '__setitem__', '__delitem__', '__iadd__'):
+        self.assertFalse(hasattr(self.pool, name), name)
+
+    def test_indexes_follow_the_list(self):
+      self.assertEqual(len(self.pool), 4)
+      self.assertEqual([transaction.index for transaction in self.pool], [1, 2, 3, 4])
+      self.assertEqual(len(self.pool.of_doer('doer 1')), 2)
+      self.assertEqual(self.pool.next_index, 5)
+
+      transaction = self.pool.with_id(f'{2:032x}')
+      self.pool.set_status(transaction, 'accepted', 'reviewer')
+      self.assertEqual(self.pool.count_status(records.ACCEPTED), 1)
+      self.assertEqual(self.pool.count_status('pending'), 3)
+      self.assertEqual(self.pool.reviewed_transactions(), [transaction])
+      self.assertFalse(self.pool.reviewed())
+
+    def test_taking_out_builds_a_new_pool(self):
+      left = self.pool.without([f'{1:032x}']).excluding(self.pool.with_index(2))
+      self.assertEqual([transaction['index'] for transaction in left.to_dicts()], [3, 4])
+      self.assertIsNone(left.with_id(f'{1:032x}'))
+      self.assertEqual(left.with_index(2), [])
+      self.assertEqual(len(self.pool), 4)
+      self.assertFalse(mempool.Mempool())
+
+
+if __name__ == '__main__':
+  unittest.main()
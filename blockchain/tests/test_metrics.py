@@ -0,0 +1,54 @@
+import unittest
+
+from common import encoding, metrics
+from tests.test_storage import block, hashes_counted
+
+
+class RegistryTest(unittest.TestCase):
+
+    def setUp(self):
+      self.registry = metrics.Registry()
+      self.histogram = self.registry.histogram('example_seconds', 'Example', buckets=(0.1, 1))
+
+    def test_histogram_buckets_are_cumulative(self):
+      self.histogram.observe(0.05)
+      self.histogram.observe(0.5)
+      self.histogram.observe(5)
+      lines = self.registry.expose().splitlines()
+      self.assertIn('example_seconds_bucket{le="0.1"} 1', lines)
+      self.assertIn('example_seconds_bucket{le="1"} 2', lines)
+      self.assertIn('example_seconds_bucket{le="+Inf"} 3', lines)
+      self.assertIn('example_seconds_sum 5.55', lines)
+      self.assertIn('example_seconds_count 3', lines)
+
+    def test_disabled_registry_records_nothing(self):
+      with self.histogram.time():
+        pass
+      self.registry.enabled = False
+      with self.histogram.time():
+        pass
+      self.histogram.observe(0.5)
+      self.assertIs(self.histogram.time(), metrics._NO_TIMER)
+      self.assertIn('example_seconds_count 1', self.registry.expose().splitlines())
+
+
+class HashTimingTest(unittest.TestCase):
+
+    def test_every_hash_is_timed_once(self):
+      counted = hashes_counted()
+      encoding.block_hash(block(1))
+      encoding.block_hash(dict(block(2), merkle_root='f' * 64))
+      self.assertEqual(hashes_counted(), counted + 2)
+
+    def test_hashes_are_not_timed_while_disabled(self):
+      counted = hashes_counted()
+      metrics.registry.enabled = False
+      try:
+        encoding.block_hash(block(1))
+      finally:
+        metrics.registry.enabled = True
+      self.assertEqual(hashes_counted(), counted)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,76 @@
+import unittest
+
+from common import mining
+
+
+class ProofValidatorTest(unittest.TestCase):
+
+    def test_same_answers_as_valid_proof(self):
+      last_hash = 'ab' * 32
+      for difficulty in (-65, -1, 0, 1, 2, 64, 65):
+        validator = mining.ProofValidator(100, last_hash, difficulty)
+        for proof in range(3000):
+          self.assertEqual(validator(proof), mining.valid_proof(100, proof, last_hash, difficulty), (difficulty, proof))
+
+    def test_long_previous_proof(self):
+      # A previous proof filling a whole SHA-256 block of the guess on its own
+      last_proof, last_hash = 10 ** 70, 'ab' * 32
+      validator = mining.ProofValidator(last_proof, last_hash, 2)
+      answers = [mining.valid_proof(last_proof, proof, last_hash, 2) for proof in range(3000)]
+      self.assertEqual([validator(proof) for proof in range(3000)], answers)
+      self.assertEqual(validator.find(0, 3000), answers.index(True))
+
+    def test_negative_difficulty_accepts_no_proof(self):
+      self.assertEqual(mining.valid_proof_many(100, range(3000), '1', -1), [False] * 3000)
+      self.assertIsNone(mining.ProofValidator(100, '1', -1).find(0, 3000))
+
+
+class MinerTest(unittest.TestCase):
+
+    def test_serial_miner_counts_the_nonces_up_to_the_proof(self):
+      proof, tried = mining.SerialMiner().mine_counted(100, 'ab' * 32, 2)
+      self.assertTrue(mining.valid_proof(100, proof, 'ab' * 32, 2))
+      self.assertEqual(tried, proof + 1)
+
+    def test_search_counts_the_nonces_of_its_range(self):
+      validator = mining.ProofValidator(100, 'ab' * 32, 2)
+      proof = validator.find(1000, 100000)
+      self.assertEqual(mining.search(100, 'ab' * 32, 2, 1000, 100000), (proof, proof - 1000 + 1))
+      self.assertEqual(mining.search(100, 'ab' * 32, 2, 1000, proof), (None, proof - 1000))
+
+    def test_pool_counts_the_nonces_of_every_chunk(self):
+      miner = mining.ProcessPoolMiner(workers=1, chunk_size=64)
+      try:
+        proof, tried = miner.mine_counted(100, 'ab' * 32, 2)
+      finally:
+        miner.close()
+      self.assertEqual(proof, mining.SerialMiner().mine(100, 'ab' * 32, 2))
+      # The chunks are scanned in order, the ones before the proof whole
+      self.assertGreaterEqual(tried, proof + 1)
+
+
+class MiningJobsTest(unittest.TestCase):
+
+    @staticmethod
+    def seal(index):
+      if index is None:
+        raise ValueError('Nothing to seal')
+      return {'index': index}
+
+    def test_failed_job_is_reported(self):
+      jobs = mining.MiningJobs(self.seal, background=False)
+      job = jobs.status(jobs.submit(None))
+      self.assertEqual((job['status'], job['block'], job['error']), ('failed', None, 'Nothing to seal'))
+      self.assertEqual(jobs.pending(), 0)
+
+    def test_jobs_after_a_failed_one_are_sealed(self):
+      jobs = mining.MiningJobs(self.seal)
+      failed, sealed = jobs.submit(None), jobs.submit(2)
+      self.assertEqual(jobs.wait(failed, 5)['status'], 'failed')
+      job = jobs.wait(sealed, 5)
+      self.assertEqual((job['status'], job['block']), ('sealed', 2))
+      self.assertNotIn('error', job)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,42 @@
+import unittest
+
+from common import records
+
+
+def chore(index):
+  return {
+    'index': index,
+    'doer': f'doer {index % 7}',
+    'task': 'Clean the kitchen',
+    'duration': index * 0.25,
+    'status': records.STATUSES[index % 3],
+    'reviewer': f'doer {index % 5}',
+    'timestamp': 1700000000.123456 + index,
+  }
+
+
+# Chores as the API sends them, with an id, with values the records don't know and with the status as a small int
+SAMPLES = [
+  chore(1),
+  dict(chore(2), id='a' * 32),
+  dict(chore(3), reviewer=None, status='unknown', note=[1]),
+  dict(chore(4), status=1),
+  {'index': 5, 'doer': 'doer', 'status': 'accepted', 'task': 'Task list review', 'duration': 0.5, 'timestamp': 1.5},
+]
+
+
+class RecordsTest(unittest.TestCase):
+
+    def test_transactions_give_back_their_documents(self):
+      for sample in SAMPLES:
+        self.assertEqual(records.Transaction.from_dict(sample).to_dict(), sample)
+
+    def test_blocks_give_back_their_documents(self):
+      block = {'index': 2, 'timestamp': 1.5, 'transactions': SAMPLES, 'merkle_root': 'f' * 64, 'proof': 7, 'difficulty': 4,
+               'mining_started': 1.0, 'previous_hash': '0' * 64}
+      for sample in (block, {'index': 1, 'timestamp': 1.0, 'transactions': [], 'proof': 100, 'previous_hash': '1'}):
+        self.assertEqual(records.Block.from_dict(sample).to_dict(), sample)
+
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,181 @@
+import tempfile
+import threading
+import unittest
+
+from common import metrics, storage
+
+
+def block(index):
+  return {'index': index, 'timestamp': float(index), 'transactions': [], 'proof': index, 'previous_hash': f'{index - 1:064x}'}
+
+
+def hashes_counted():
+  for line in metrics.registry.expose().splitlines():
+    if line.startswith('chores_block_hash_seconds_count '):
+      return int(line.split()[1])
+  return 0
+
+
+def read_while_appending(test, chain, blocks=20000):
+  """
+  Take snapshots of the chain and read their last block while another thread appends blocks to it
+  """
+
+  errors = []
+
+  def append():
+    for index in range(len(chain) + 1, len(chain) + blocks + 1):
+      chain.append(block(index))
+
+  appender = threading.Thread(target=append)
+  appender.start()
+  while appender.is_alive():
+    try:
+      snapshot = chain.snapshot()
+      if len(snapshot):
+        test.assertEqual(snapshot.hash(-1), snapshot.tip)
+        test.assertEqual(snapshot.header(-1)['index'], len(snapshot))
+    except IndexError as error:
+      errors.append(error)
+  appender.join()
+  test.assertEqual(errors, [])
+
+
+class MemoryChainTest(unittest.TestCase):
+
+    def test_snapshots_taken_while_appending_are_whole(self):
+      read_while_appending(self, storage.MemoryChain())
+
+    def test_dropped_blocks_are_a_changed_chain(self):
+      chain = storage.MemoryChain([block(index) for index in range(1, 6)])
+      snapshot = chain.snapshot()
+      chain.truncate(2)
+      for read in (snapshot.hash, snapshot.header, snapshot.raw, snapshot.__getitem__):
+        with self.assertRaises(storage.ChainChanged):
+          read(4)
+
+    def test_hashes_of_the_blocks_are_counted(self):
+      counted = hashes_counted()
+      storage.MemoryChain([block(1), block(2)])
+      self.assertEqual(hashes_counted(), counted + 2)
+
+
+@unittest.skipIf(storage.fcntl is None, 'the OS has no flock')
+class ChainLogTest(unittest.TestCase):
+
+    def setUp(self):
+      self.directory = tempfile.mkdtemp(prefix='chores-test-')
+
+    def test_log_is_kept_by_one_process(self):
+      chain = storage.ChainLog(self.directory)
+      try:
+        with self.assertRaises(storage.DataInUse):
+          storage.ChainLog(self.directory)
+      finally:
+        chain.close()
+      storage.ChainLog(self.directory).close()
+
+    def test_dropped_blocks_are_a_changed_chain(self):
+      chain = storage.ChainLog(self.directory)
+      self.addCleanup(chain.close)
+      chain.extend([block(index) for index in range(1, 6)])
+      snapshot = chain.snapshot()
+      chain.truncate(2)
+      for read in (snapshot.hash, snapshot.header, snapshot.raw, snapshot.__getitem__):
+        with self.assertRaises(storage.ChainChanged):
+          read(4)
+
+    def test_reads_while_truncating_are_whole_or_changed(self):
+      chain = storage.ChainLog(self.directory)
+      self.addCleanup(chain.close)
+      chain.extend([block(index) for index in range(1, 101)])
+      done = threading.Event()
+
+      def truncate():
+        for _ in range(50):
+          chain.truncate(50)
+          chain.extend([block(index) for index in range(51, 101)])
+        done.set()
+
+      truncating = threading.Thread(target=truncate)
+      truncating.start()
+      read = changed = 0
+      while not done.is_set():
+        snapshot = chain.snapshot()
+        try:
+          self.assertEqual(snapshot[-1]['index'], len(snapshot))
+          self.assertEqual(len(snapshot.hash(len(snapshot) - 1)), 64)
+          read += 1
+        except storage.ChainChanged:
+          changed += 1
+      truncating.join()
+      self.assertGreater(read + changed, 0)
+
+    def test_shared_log_is_opened_by_many(self):
+      first, second = storage.ChainLog(self.directory, shared=True), storage.ChainLog(self.directory, shared=True)
+      try:
+        with self.assertRaises(storage.DataInUse):
+          storage.ChainLog(self.directory)
+      finally:
+        first.close()
+        second.close()
+
+
+class PendingSnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+      self.directory = tempfile.mkdtemp(prefix='chores-test-')
+      self.snapshot = storage.PendingSnapshot(self.directory)
+      self.addCleanup(self.snapshot.close)
+
+    def transaction(self, index):
+      return {'index': index, 'doer': 'ana', 'task': 'dishes', 'duration': 1, 'status': 'pending', 'reviewer': '', 'timestamp': float(index)}
+
+    def test_changes_are_replayed_on_the_snapshot(self):
+      self.snapshot.save({'transactions': [self.transaction(1)], 'sealing': [[self.transaction(0)]]})
+      self.assertTrue(self.snapshot.record([
+        {'change': 'add', 'transaction': self.transaction(2)},
+        {'change': 'add', 'transaction': self.transaction(3)},
+        {'change': 'status', 'position': 1, 'status': 'accepted', 'reviewer': 'bea'},
+        {'change': 'seal', 'positions': [1]},
+        {'change': 'drop', 'positions': [1]},
+        {'change': 'mined', 'positions': [0]},
+      ]))
+
+      pending = storage.PendingSnapshot(self.directory).load()
+      self.assertEqual(pending['transactions'], [self.transaction(1)])
+      self.assertEqual(pending['sealing'], [[dict(self.transaction(2), status='accepted', reviewer='bea')]])
+
+    def test_changes_of_an_older_snapshot_are_not_replayed(self):
+      self.snapshot.save({'transactions': [], 'sealing': []})
+      self.snapshot.record([{'change': 'add', 'transaction': self.transaction(1)}])
+      with open(f'{self.directory}/pending.log', 'rb') as journal:
+        lines = journal.read()
+
+      # A crash right after saving a new snapshot leaves the journal of the old one behind
+      self.snapshot.save({'transactions': [self.transaction(1)], 'sealing': []})
+      with open(f'{self.directory}/pending.log', 'ab') as journal:
+        journal.write(lines)
+
+      self.assertEqual(storage.PendingSnapshot(self.directory).load()['transactions'], [self.transaction(1)])
+
+    def test_full_journal_asks_for_the_whole_list(self):
+      self.snapshot.save({'transactions': [], 'sealing': []})
+      changes = [{'change': 'add', 'transaction': self.transaction(1)}] * storage.JOURNAL_LIMIT
+      self.assertTrue(self.snapshot.record(changes))
+      self.assertFalse(self.snapshot.record(changes[:1]))
+
+    def test_cut_line_asks_for_the_whole_list(self):
+      self.snapshot.save({'transactions': [], 'sealing': []})
+      self.snapshot.record([{'change': 'add', 'transaction': self.transaction(1)}])
+      with open(f'{self.directory}/pending.log', 'ab') as journal:
+        journal.write(b'{"change": "add", "transa')
+
+      snapshot = storage.PendingSnapshot(self.directory)
+      self.addCleanup(snapshot.close)
+      self.assertEqual(snapshot.load()['transactions'], [self.transaction(1)])
+      self.assertFalse(snapshot.record([{'change': 'add', 'transaction': self.transaction(2)}]))
+
+
+if __name__ == '__main__':
+  unittest.main()